@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+''' compares the per-parameter and the multi-tensor AdamNormGrad against optim.Adam
+
+    usage (from the repo root): python -m benchmarks.adamnormgrad_benchmark '''
+
+from __future__ import print_function
+
+import time
+import argparse
+import torch
+import torch.nn as nn
+import torch.optim as optim
+
+from optimizers.adamnormgrad import AdamNormGrad
+
+
+parser = argparse.ArgumentParser(description='AdamNormGrad benchmark')
+parser.add_argument('--num-steps', type=int, default=200,
+                    help="number of timed optimizer steps (default: 200)")
+parser.add_argument('--filter-depth', type=int, default=32,
+                    help='number of initial conv filter maps (default: 32)')
+parser.add_argument('--num-layers', type=int, default=12,
+                    help='number of conv blocks in the synthetic model (default: 12)')
+parser.add_argument('--no-cuda', action='store_true', default=False,
+                    help='disables CUDA')
+args = parser.parse_args()
+args.cuda = not args.no_cuda and torch.cuda.is_available()
+
+
+def build_model():
+    ''' a conv stack with many small tensors, similar to the gated conv VAE '''
+    layers = []
+    for i in range(args.num_layers):
+        layers += [nn.Conv2d(1 if i == 0 else args.filter_depth, args.filter_depth, 3, padding=1),
+                   nn.GroupNorm(4, args.filter_depth),
+                   nn.ELU()]
+
+    layers += [nn.Flatten(), nn.Linear(args.filter_depth * 28 * 28, 64)]
+    model = nn.Sequential(*layers)
+    return model.cuda() if args.cuda else model
+
+
+def make_grads(model, num_steps):
+    ''' pre-draws the gradients so that every optimizer sees the same ones '''
+    return [[torch.randn_like(p) for p in model.parameters()]
+            for _ in range(num_steps)]
+
+
+def run(optimizer_fn, init_state, grads):
+    model = build_model()
+    model.load_state_dict(init_state)
+    optimizer = optimizer_fn(model.parameters())
+
+    def _step(grad_list):
+        for p, g in zip(model.parameters(), grad_list):
+            p.grad = g
+
+        optimizer.step()
+
+    _step(grads[0]) # warm up
+    if args.cuda:
+        torch.cuda.synchronize()
+
+    begin = time.time()
+    for grad_list in grads[1:]:
+        _step(grad_list)
+
+    if args.cuda:
+        torch.cuda.synchronize()
+
+    ms_per_step = 1000.0 * (time.time() - begin) / (len(grads) - 1)
+    return ms_per_step, [p.detach().clone() for p in model.parameters()]
+
+
+if __name__ == "__main__":
+    reference = build_model()
+    init_state = reference.state_dict()
+    grads = make_grads(reference, args.num_steps + 1)
+    print("{} params with {} elements".format(
+        len(list(reference.parameters())),
+        sum(p.numel() for p in reference.parameters())))
+
+    loop_ms, loop_params = run(lambda p: AdamNormGrad(p, foreach=False), init_state, grads)
+    foreach_ms, foreach_params = run(lambda p: AdamNormGrad(p, foreach=True), init_state, grads)
+    adam_ms, _ = run(lambda p: optim.Adam(p), init_state, grads)
+
+    max_diff = max(torch.max(torch.abs(a - b)).item()
+                   for a, b in zip(loop_params, foreach_params))
+    print("AdamNormGrad (loop)    : {:.3f} ms / step".format(loop_ms))
+    print("AdamNormGrad (foreach) : {:.3f} ms / step".format(foreach_ms))
+    print("optim.Adam             : {:.3f} ms / step".format(adam_ms))
+    print("max |loop - foreach| after {} steps: {:.3e}".format(args.num_steps + 1, max_diff))
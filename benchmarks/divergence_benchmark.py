@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+''' micro-benchmarks the closed-form divergence kernels against the
+    torch.distributions based code they replace and checks their grads
+
+    usage (from the repo root): python -m benchmarks.divergence_benchmark '''
+
+from __future__ import print_function
+
+import time
+import argparse
+import torch
+import torch.nn.functional as F
+import torch.distributions as D
+
+from models.reparameterizers import divergences
+
+
+parser = argparse.ArgumentParser(description='divergence kernel benchmark')
+parser.add_argument('--batch-size', type=int, default=300,
+                    help="batch size of the synthetic latents (default: 300)")
+parser.add_argument('--continuous-size', type=int, default=40,
+                    help='#gaussian latents (default: 40)')
+parser.add_argument('--discrete-size', type=int, default=100,
+                    help='#categories of the student, the teacher has half (default: 100)')
+parser.add_argument('--num-iters', type=int, default=500,
+                    help='number of timed iterations (default: 500)')
+parser.add_argument('--no-cuda', action='store_true', default=False,
+                    help='disables CUDA')
+args = parser.parse_args()
+args.cuda = not args.no_cuda and torch.cuda.is_available()
+
+
+# the previous implementations, kept here as the reference
+def reference_kl_gaussian_standard_normal(mu, scale):
+    standard_normal = D.Normal(torch.zeros_like(mu), torch.ones_like(scale), validate_args=False)
+    normal = D.Normal(mu, scale, validate_args=False)
+    return torch.sum(D.kl_divergence(normal, standard_normal), -1)
+
+
+def reference_kl_gaussian_gaussian(mu0, scale0, mu1, scale1):
+    n0 = D.Normal(mu0, scale0, validate_args=False)
+    n1 = D.Normal(mu1, scale1, validate_args=False)
+    return torch.sum(D.kl_divergence(n0, n1), dim=-1)
+
+
+def reference_categorical_entropy(logits):
+    return D.OneHotCategorical(logits=logits, validate_args=False).entropy()
+
+
+def _zero_pad_smaller_cat(cat1, cat2):
+    diff = cat1.size(-1) - cat2.size(-1)
+    if diff > 0:
+        cat2 = F.pad(cat2, (0, diff))
+    elif diff < 0:
+        cat1 = F.pad(cat1, (0, -diff))
+
+    return cat1, cat2
+
+
+def reference_kl_categorical_categorical(logits_a, logits_b):
+    log_a = F.log_softmax(logits_a, dim=-1)
+    softmax_a = F.softmax(logits_a, dim=-1)
+    log_b = F.log_softmax(logits_b, dim=-1)
+    log_a, log_b = _zero_pad_smaller_cat(log_a, log_b)
+    softmax_a, log_b = _zero_pad_smaller_cat(softmax_a, log_b)
+    return torch.sum(softmax_a * (log_a - log_b), dim=-1)
+
+
+def _rand(*size, positive=False):
+    t = torch.randn(*size)
+    t = t.abs() + 0.1 if positive else t
+    t = t.cuda() if args.cuda else t
+    return t.requires_grad_()
+
+
+def time_fn(fn, inputs):
+    fn(*inputs).sum().backward() # warm up
+    if args.cuda:
+        torch.cuda.synchronize()
+
+    begin = time.time()
+    for _ in range(args.num_iters):
+        fn(*inputs).sum().backward()
+
+    if args.cuda:
+        torch.cuda.synchronize()
+
+    return 1e6 * (time.time() - begin) / args.num_iters
+
+
+def max_grad_diff(ref_fn, fn, inputs):
+    ref_grads = torch.autograd.grad(ref_fn(*inputs).sum(), inputs)
+    grads = torch.autograd.grad(fn(*inputs).sum(), inputs)
+    value_diff = torch.max(torch.abs(ref_fn(*inputs) - fn(*inputs))).item()
+    grad_diff = max(torch.max(torch.abs(a - b)).item() for a, b in zip(ref_grads, grads))
+    return value_diff, grad_diff
+
+
+if __name__ == "__main__":
+    b, c, d = args.batch_size, args.continuous_size // 2, args.discrete_size
+    cases = [
+        ('kl gauss || N(0, 1)', reference_kl_gaussian_standard_normal,
+         lambda mu, s: torch.sum(divergences.kl_gaussian_standard_normal(mu, s), -1),
+         [_rand(b, c), _rand(b, c, positive=True)]),
+        ('kl gauss || gauss', reference_kl_gaussian_gaussian,
+         lambda *p: torch.sum(divergences.kl_gaussian_gaussian(*p), -1),
+         [_rand(b, c), _rand(b, c, positive=True), _rand(b, c), _rand(b, c, positive=True)]),
+        ('categorical entropy', reference_categorical_entropy,
+         divergences.categorical_entropy, [_rand(b, d)]),
+        ('kl cat || cat (same size)', reference_kl_categorical_categorical,
+         divergences.kl_categorical_categorical, [_rand(b, d), _rand(b, d)]),
+        ('kl cat || cat (grown)', reference_kl_categorical_categorical,
+         divergences.kl_categorical_categorical, [_rand(b, d), _rand(b, d // 2)]),
+    ]
+
+    print("{:<28}{:>14}{:>14}{:>10}{:>12}{:>12}".format(
+        'kernel', 'reference us', 'kernel us', 'speedup', 'max |dv|', 'max |dg|'))
+    for name, ref_fn, fn, inputs in cases:
+        ref_us, kernel_us = time_fn(ref_fn, inputs), time_fn(fn, inputs)
+        value_diff, grad_diff = max_grad_diff(ref_fn, fn, inputs)
+        print("{:<28}{:>14.1f}{:>14.1f}{:>9.2f}x{:>12.2e}{:>12.2e}".format(
+            name, ref_us, kernel_us, ref_us / kernel_us, value_diff, grad_diff))
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+''' compares the double-loop pair construction of the RelationalNetwork
+    against the broadcast and the chunked versions (forward + backward)
+
+    usage (from the repo root): python -m benchmarks.relational_network_benchmark '''
+
+from __future__ import print_function
+
+import time
+import argparse
+import torch
+
+from helpers.utils import expand_dims
+from models.relational_network import RelationalNetwork
+
+
+parser = argparse.ArgumentParser(description='RelationalNetwork benchmark')
+parser.add_argument('--batch-size', type=int, default=100,
+                    help="batch size of the synthetic conv maps (default: 100)")
+parser.add_argument('--conv-channels', type=int, default=24,
+                    help='#channels of the conv map (default: 24)')
+parser.add_argument('--conv-size', type=int, default=7,
+                    help='spatial size of the (square) conv map (default: 7)')
+parser.add_argument('--hidden-size', type=int, default=128,
+                    help='hidden size of the relation network (default: 128)')
+parser.add_argument('--pair-chunk-size', type=int, default=256,
+                    help='#pairs per chunk for the chunked mode (default: 256)')
+parser.add_argument('--num-iters', type=int, default=20,
+                    help='number of timed iterations (default: 20)')
+parser.add_argument('--no-cuda', action='store_true', default=False,
+                    help='disables CUDA')
+args = parser.parse_args()
+args.cuda = not args.no_cuda and torch.cuda.is_available()
+
+
+def loop_forward(model, conv_output):
+    ''' the previous forward pass, kept here as the reference '''
+    batch_size, conv_chan_size, _, _ = list(conv_output.size())
+    conv_output = conv_output.view(batch_size, conv_chan_size, -1)
+    num_feat = conv_output.size(-1)
+
+    rn_buffer = []
+    for i in range(num_feat):
+        chunk_i = conv_output[:, :, i].contiguous().view(batch_size, 1, -1)
+        for j in range(num_feat):
+            chunk_j = conv_output[:, :, j].contiguous().view(batch_size, 1, -1)
+            rn_buffer.append(torch.cat([chunk_i, chunk_j], -1))
+
+    rn_buffer = expand_dims(torch.cat(rn_buffer, 1), 2)
+    rbo = model.rn(rn_buffer).squeeze(2)
+    return model.proj(torch.sum(rbo, 1))
+
+
+def time_fn(fn, conv_output):
+    fn(conv_output).sum().backward() # warm up
+    if args.cuda:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+
+    begin = time.time()
+    for _ in range(args.num_iters):
+        fn(conv_output).sum().backward()
+
+    if args.cuda:
+        torch.cuda.synchronize()
+
+    peak_mb = torch.cuda.max_memory_allocated() / 2.0**20 if args.cuda else float('nan')
+    return 1000.0 * (time.time() - begin) / args.num_iters, peak_mb
+
+
+if __name__ == "__main__":
+    model = RelationalNetwork(args.hidden_size, 2, cuda=args.cuda)
+    conv_output = torch.randn(args.batch_size, args.conv_channels,
+                              args.conv_size, args.conv_size)
+    conv_output = conv_output.cuda() if args.cuda else conv_output
+    conv_output.requires_grad_()
+    model(conv_output) # builds the relation network
+
+    def chunked_forward(x):
+        model.pair_chunk_size = args.pair_chunk_size
+        out = model(x)
+        model.pair_chunk_size = None
+        return out
+
+    cases = [('loop', lambda x: loop_forward(model, x)),
+             ('broadcast', model),
+             ('chunked ({})'.format(args.pair_chunk_size), chunked_forward)]
+
+    # train mode uses the batch stats, so all three must agree
+    reference = loop_forward(model, conv_output)
+    print("{:<20}{:>12}{:>14}{:>12}".format('pairs', 'ms / iter', 'peak MB', 'max |dv|'))
+    for name, fn in cases:
+        ms, peak_mb = time_fn(fn, conv_output)
+        diff = torch.max(torch.abs(reference - fn(conv_output))).item()
+        print("{:<20}{:>12.2f}{:>14.1f}{:>12.2e}".format(name, ms, peak_mb, diff))
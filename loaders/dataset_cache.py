@@ -0,0 +1,218 @@
+from __future__ import print_function
+import os
+import re
+import json
+import hashlib
+import importlib
+import numpy as np
+import torch
+from torch.utils.data import Dataset, DataLoader, SubsetRandomSampler
+
+
+# read by the loaders but only change how the cached content is iterated
+ITERATION_ARGS = ['batch_size', 'cuda']
+
+
+def loader_arg_names(package='datasets'):
+    ''' the args.<name> attributes read anywhere in the loader package,
+        None if its sources can't be found '''
+    try:
+        module = importlib.import_module(package)
+    except ImportError:
+        return None
+
+    sources = [getattr(module, '__file__', None)]
+    for path in getattr(module, '__path__', []):
+        for root, _, files in os.walk(path):
+            sources += [os.path.join(root, f) for f in files if f.endswith('.py')]
+
+    names = set()
+    for source in set(s for s in sources if s is not None and s.endswith('.py')):
+        with open(source, 'r') as f:
+            names.update(re.findall(r'\bargs\.(\w+)', f.read()))
+
+    return names if names else None
+
+
+def cache_key(args, arg_names=None):
+    ''' hash of every argument that can decide the content of the task
+        loaders: the ones the loader package reads (arg_names, found with
+        loader_arg_names() by default) or all of args if they are unknown.
+        The task / split / seed args are always part of it. '''
+    arg_names = loader_arg_names() if arg_names is None else arg_names
+    arg_names = set(vars(args).keys()) if arg_names is None else set(arg_names)
+    arg_names |= {'task', 'disable_sequential', 'seed'}
+    arg_names -= set(ITERATION_ARGS)
+    key = json.dumps({k: getattr(args, k, None) for k in sorted(arg_names)},
+                     sort_keys=True, default=str)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[0:16]
+
+
+def _atomic_save(path, array):
+    ''' np.save to a temporary file that is moved in place, so that
+        concurrent readers never see a partially written shard '''
+    tmp_path = "{}.tmp{}".format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        np.save(f, array)
+
+    os.replace(tmp_path, path)
+
+
+def _atomic_save_json(path, obj):
+    tmp_path = "{}.tmp{}".format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f, indent=2)
+
+    os.replace(tmp_path, path)
+
+
+def to_storage_dtype(x):
+    ''' images in [0, 1] that are multiples of 1/255 are stored as uint8,
+        anything else (eg: normalized inputs) stays float32 '''
+    scaled = x * 255.0
+    if x.size > 0 and x.min() >= 0 and x.max() <= 1 \
+       and np.allclose(scaled, np.round(scaled), atol=1e-3):
+        return np.round(scaled).astype(np.uint8)
+
+    return x.astype(np.float32)
+
+
+def _decode(dataset, num_workers=0, batch_size=1024):
+    ''' decodes every sample of the dataset (ie: runs its transforms) once '''
+    xs, ys = [], []
+    for minibatch in DataLoader(dataset, batch_size=batch_size,
+                                shuffle=False, num_workers=num_workers):
+        xs.append(minibatch[0].numpy())
+        ys.append(np.asarray(minibatch[1]))
+
+    return to_storage_dtype(np.concatenate(xs, 0)), np.concatenate(ys, 0)
+
+
+def _loader_attrs(loader):
+    ''' the plain (json-able) attributes of a loader object, eg: img_shp '''
+    attrs = {}
+    for k, v in vars(loader).items():
+        try:
+            json.dumps(v)
+            attrs[k] = v
+        except TypeError:
+            continue
+
+    return attrs
+
+
+def write_cache(loaders, cache_dir):
+    ''' decodes the datasets behind the loaders into shards; each distinct
+        dataset is stored once and every split only keeps its indices '''
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+
+    shards, manifest = {}, {'shards': [], 'tasks': []}
+
+    def _split(data_loader, name):
+        dataset = data_loader.dataset
+        if id(dataset) not in shards:
+            shard = len(manifest['shards'])
+            print("caching dataset shard {} [{} samples]".format(shard, len(dataset)))
+            x, y = _decode(dataset, num_workers=data_loader.num_workers)
+            shard_files = {'x': 'shard{}_x.npy'.format(shard), 'y': 'shard{}_y.npy'.format(shard)}
+            _atomic_save(os.path.join(cache_dir, shard_files['x']), x)
+            _atomic_save(os.path.join(cache_dir, shard_files['y']), y)
+            manifest['shards'].append(shard_files)
+            shards[id(dataset)] = shard
+
+        # class splits sample a subset of a shared dataset
+        indices = getattr(data_loader.sampler, 'indices', None)
+        indices = np.arange(len(dataset)) if indices is None else np.asarray(indices)
+        _atomic_save(os.path.join(cache_dir, name), indices.astype(np.int64))
+        return {
+            'shard': shards[id(dataset)],
+            'indices': name,
+            'drop_last': data_loader.drop_last,
+            'num_workers': data_loader.num_workers
+        }
+
+    for i, loader in enumerate(loaders):
+        manifest['tasks'].append({
+            'train': _split(loader.train_loader, 'task{}_train_idx.npy'.format(i)),
+            'test': _split(loader.test_loader, 'task{}_test_idx.npy'.format(i)),
+            'attrs': _loader_attrs(loader)
+        })
+
+    # the manifest is written last, it marks the cache as complete
+    _atomic_save_json(os.path.join(cache_dir, 'manifest.json'), manifest)
+
+
+class CachedDataset(Dataset):
+    ''' a memory-mapped shard, opened lazily so that every
+        loader worker maps the (page-cached) files itself '''
+    def __init__(self, x_path, y_path):
+        self.x_path, self.y_path = x_path, y_path
+        self.x, self.y = None, None
+        self.num_samples = int(np.load(y_path, mmap_mode='r').shape[0])
+
+    def _open(self):
+        if self.x is None:
+            self.x = np.load(self.x_path, mmap_mode='r')
+            self.y = np.load(self.y_path, mmap_mode='r')
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['x'], state['y'] = None, None
+        return state
+
+    def __len__(self):
+        return self.num_samples
+
+    def __getitem__(self, index):
+        self._open()
+        x = torch.from_numpy(np.array(self.x[index]))
+        x = x.float().div_(255.0) if x.dtype == torch.uint8 else x
+        y = self.y[index]
+        return x, (y.item() if np.ndim(y) == 0 else torch.from_numpy(np.array(y)))
+
+
+class CachedLoader(object):
+    ''' same interface as the dataset loaders: train_loader, test_loader,
+        img_shp & co, backed by the shards of the cache '''
+    def __init__(self, task, datasets, cache_dir, batch_size, cuda=False):
+        for k, v in task['attrs'].items():
+            setattr(self, k, v)
+
+        self.train_indices = np.load(os.path.join(cache_dir, task['train']['indices']))
+        self.test_indices = np.load(os.path.join(cache_dir, task['test']['indices']))
+        self.train_loader = DataLoader(datasets[task['train']['shard']],
+                                       batch_size=batch_size,
+                                       sampler=SubsetRandomSampler(self.train_indices.tolist()),
+                                       num_workers=task['train']['num_workers'],
+                                       drop_last=task['train']['drop_last'],
+                                       pin_memory=cuda)
+        self.test_loader = DataLoader(datasets[task['test']['shard']],
+                                      batch_size=batch_size,
+                                      sampler=self.test_indices.tolist(),
+                                      num_workers=task['test']['num_workers'],
+                                      drop_last=task['test']['drop_last'],
+                                      pin_memory=cuda)
+
+
+def read_cache(cache_dir, batch_size, cuda=False):
+    ''' returns the list of CachedLoader of a complete cache '''
+    with open(os.path.join(cache_dir, 'manifest.json'), 'r') as f:
+        manifest = json.load(f)
+
+    datasets = [CachedDataset(os.path.join(cache_dir, shard['x']),
+                              os.path.join(cache_dir, shard['y']))
+                for shard in manifest['shards']]
+    return [CachedLoader(task, datasets, cache_dir, batch_size, cuda=cuda)
+            for task in manifest['tasks']]
+
+
+def cached_loaders(args, build_fn):
+    ''' returns the task loaders from the cache under args.data_dir;
+        on a miss the loaders are built once with build_fn() and cached '''
+    cache_dir = os.path.join(args.data_dir, 'cache', cache_key(args))
+    if not os.path.isfile(os.path.join(cache_dir, 'manifest.json')):
+        print("building the dataset cache in {}".format(cache_dir))
+        write_cache(build_fn(), cache_dir)
+
+    return read_cache(cache_dir, args.batch_size, cuda=args.cuda)
@@ -0,0 +1,30 @@
+from __future__ import print_function
+from torch.utils.data import Dataset, DataLoader
+
+
+class IndexedDataset(Dataset):
+    ''' wraps a dataset so that every sample also returns its index,
+        ie: (x, y, idx) instead of (x, y) '''
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        x, y = self.dataset[index][0:2]
+        return x, y, index
+
+
+def with_sample_indices(data_loader):
+    ''' rebuilds data_loader over an IndexedDataset, keeping its sampler
+        (and thus the class split / shuffling) and batching settings '''
+    if hasattr(data_loader, 'with_indices'): # eg: resident loaders
+        return data_loader.with_indices()
+
+    return DataLoader(IndexedDataset(data_loader.dataset),
+                      batch_size=data_loader.batch_size,
+                      sampler=data_loader.sampler,
+                      num_workers=data_loader.num_workers,
+                      pin_memory=data_loader.pin_memory,
+                      drop_last=data_loader.drop_last)
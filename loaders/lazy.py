@@ -0,0 +1,89 @@
+from __future__ import print_function
+from functools import partial
+
+
+class LazyLoaderList(object):
+    ''' a list of task loaders where every task is built by its builder the
+        first time it is indexed; release(i) drops a built task so that only
+        the active tasks are held in memory. on_build(i, loader) is called
+        once per build, eg: to report the sample counts.
+
+        Slicing returns a view: it builds and releases through the list it
+        was sliced from, so a released task is never held by the parent. '''
+    def __init__(self, builders, on_build=None):
+        self.builders = list(builders)
+        self.on_build = on_build
+        self.built = {}
+        self.group_builder, self.group_pending = None, {}
+        self.root, self._indices = self, list(range(len(self.builders)))
+
+    @staticmethod
+    def from_group_builder(group_builder, on_build=None):
+        ''' tasks that can only be built together, eg: the class splits of a
+            dataset; the group is built when the list is first used (not at
+            construction), on_build runs when a task is first indexed and a
+            released task is rebuilt by rebuilding its group '''
+        lazy = LazyLoaderList([], on_build=on_build)
+        lazy.group_builder = group_builder
+        lazy._indices = None
+        return lazy
+
+    def _build_group(self):
+        loaders = self.group_builder()
+        self.group_pending = {i: l for i, l in enumerate(loaders)}
+        self.builders = [partial(self._rebuild_from_group, i) for i in range(len(loaders))]
+        self._indices = list(range(len(loaders)))
+
+    def _rebuild_from_group(self, i):
+        if i in self.group_pending: # handed out once from the first group build
+            return self.group_pending.pop(i)
+
+        return self.group_builder()[i]
+
+    @property
+    def indices(self):
+        if self._indices is None:
+            self.root._build_group()
+
+        return self._indices
+
+    @indices.setter
+    def indices(self, indices):
+        self._indices = indices
+
+    def __len__(self):
+        return len(self.indices)
+
+    def _index(self, i):
+        ''' the index of task i in the root list '''
+        if i < 0:
+            i += len(self)
+
+        if i < 0 or i >= len(self):
+            raise IndexError("task {} out of range for {} tasks".format(i, len(self)))
+
+        return self.indices[i]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            view = LazyLoaderList.__new__(LazyLoaderList)
+            view.root, view._indices = self.root, self.indices[i]
+            return view
+
+        root, i = self.root, self._index(i)
+        if i not in root.built:
+            root.built[i] = root.builders[i]()
+            if root.on_build is not None:
+                root.on_build(i, root.built[i])
+
+        return root.built[i]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def release(self, i):
+        ''' drops the loader of task i, it is rebuilt if indexed again '''
+        i = self._index(i)
+        self.root.built.pop(i, None)
+        self.root.group_pending.pop(i, None)
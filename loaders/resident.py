@@ -0,0 +1,101 @@
+from __future__ import print_function
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Subset
+
+from loaders.dataset_cache import CachedDataset, to_storage_dtype
+
+
+class ResidentBatchLoader(object):
+    ''' iterates a split that is held as one contiguous (device) tensor by
+        slicing a shuffled index, ie: no per-sample collation.
+        uint8 images are scaled to [0, 1] floats one minibatch at a time '''
+    def __init__(self, x, y, batch_size, shuffle=True, drop_last=False, return_indices=False):
+        self.x, self.y = x, y
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.return_indices = return_indices
+
+        # mimic the DataLoader attributes that the helpers rely on
+        self.dataset = torch.utils.data.TensorDataset(x, y)
+        self.sampler = range(x.size(0))
+        self.num_workers = 0
+        self.pin_memory = False
+
+    def with_indices(self):
+        ''' the same split, also yielding the indices of the samples '''
+        return ResidentBatchLoader(self.x, self.y, self.batch_size,
+                                   shuffle=self.shuffle, drop_last=self.drop_last,
+                                   return_indices=True)
+
+    def __len__(self):
+        num_samples = self.x.size(0)
+        if self.drop_last:
+            return num_samples // self.batch_size
+
+        return (num_samples + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        num_samples = self.x.size(0)
+        order = torch.randperm(num_samples, device=self.x.device) if self.shuffle \
+            else torch.arange(num_samples, device=self.x.device)
+        for begin in range(0, len(self) * self.batch_size, self.batch_size):
+            indices = order[begin:begin + self.batch_size]
+            x = self.x.index_select(0, indices)
+            x = x.float().div_(255.0) if x.dtype == torch.uint8 else x
+            y = self.y.index_select(0, indices)
+            yield (x, y, indices) if self.return_indices else (x, y)
+
+
+def _split_indices(data_loader):
+    ''' the dataset indices a DataLoader draws from, in sampling order '''
+    sampler = data_loader.sampler
+    if isinstance(sampler, (list, range)):
+        return np.asarray(sampler)
+
+    indices = getattr(sampler, 'indices', None)
+    return np.arange(len(data_loader.dataset)) if indices is None else np.asarray(indices)
+
+
+def split_tensors(data_loader):
+    ''' materializes the samples of a DataLoader's split as (x, y) tensors;
+        cached shards are sliced directly, other datasets are decoded once '''
+    indices = _split_indices(data_loader)
+    dataset = data_loader.dataset
+    if isinstance(dataset, CachedDataset):
+        dataset._open()
+        x, y = np.asarray(dataset.x[indices]), np.asarray(dataset.y[indices])
+    else:
+        xs, ys = [], []
+        for minibatch in DataLoader(Subset(dataset, indices.tolist()), batch_size=1024,
+                                    shuffle=False, num_workers=data_loader.num_workers):
+            xs.append(minibatch[0].numpy())
+            ys.append(np.asarray(minibatch[1]))
+
+        x, y = to_storage_dtype(np.concatenate(xs, 0)), np.concatenate(ys, 0)
+
+    return torch.from_numpy(np.ascontiguousarray(x)), torch.from_numpy(np.ascontiguousarray(y))
+
+
+class ResidentLoader(object):
+    ''' same interface as the dataset loaders: train_loader, test_loader,
+        img_shp & co, with each split resident on the device '''
+    def __init__(self, loader, batch_size, cuda=False):
+        for k, v in vars(loader).items():
+            if not isinstance(v, DataLoader):
+                setattr(self, k, v)
+
+        def _resident(data_loader, shuffle):
+            x, y = split_tensors(data_loader)
+            x, y = (x.cuda(), y.cuda()) if cuda else (x, y)
+            return ResidentBatchLoader(x, y, batch_size, shuffle=shuffle,
+                                       drop_last=data_loader.drop_last)
+
+        self.train_loader = _resident(loader.train_loader, shuffle=True)
+        self.test_loader = _resident(loader.test_loader, shuffle=False)
+
+
+def resident_loaders(loaders, batch_size, cuda=False):
+    ''' converts a list of task loaders into ResidentLoaders '''
+    return [ResidentLoader(loader, batch_size, cuda=cuda) for loader in loaders]
@@ -0,0 +1,64 @@
+from __future__ import print_function
+import itertools
+import torch
+
+from loaders.lazy import LazyLoaderList
+from loaders.indexed import with_sample_indices
+
+
+class TaskSamples(torch.utils.data.IterableDataset):
+    ''' the training samples of one streamed task: num_passes passes over
+        the minibatches of the task's train split; the minibatches are
+        yielded as is, wrap it in a DataLoader with batch_size=None '''
+    def __init__(self, data_loader, num_passes=1):
+        super(TaskSamples, self).__init__()
+        self.data_loader = data_loader
+        self.num_passes = num_passes
+
+    def __iter__(self):
+        for _ in range(self.num_passes):
+            for minibatch in self.data_loader:
+                yield minibatch
+
+
+class StreamTask(object):
+    ''' a task announced by the stream: its position in the stream, the
+        loader of the task (test split & metrics) and its training samples '''
+    def __init__(self, index, task_index, loaders, num_passes=1, with_indices=False):
+        self.index = index
+        self.task_index = task_index
+        self.loaders = loaders
+        self.loader = loaders[task_index]
+        train_loader = with_sample_indices(self.loader.train_loader) \
+            if with_indices else self.loader.train_loader
+        self.samples = TaskSamples(train_loader, num_passes=num_passes)
+
+    @property
+    def num_samples(self):
+        return len(self.loader.train_loader.dataset)
+
+    def train_loader(self):
+        return torch.utils.data.DataLoader(self.samples, batch_size=None)
+
+    def release(self):
+        ''' drops the task's data, it is rebuilt if the stream revisits it '''
+        self.loaders.release(self.task_index)
+        self.loader, self.samples = None, None
+
+
+def task_stream(loaders, num_passes=1, cycle=False, max_tasks=None, with_indices=False):
+    ''' yields a StreamTask per task of the (lazy) loaders; every new task is
+        a task boundary. With cycle the loaders are revisited forever (or
+        until max_tasks tasks were announced), only the tasks that are not
+        released are held in memory, so the loaders must be a LazyLoaderList '''
+    if not isinstance(loaders, LazyLoaderList):
+        raise Exception("streaming releases the finished tasks, it needs a "
+                        "LazyLoaderList, got {}".format(type(loaders).__name__))
+
+    task_indices = itertools.cycle(range(len(loaders))) if cycle else range(len(loaders))
+    for index, task_index in enumerate(task_indices):
+        if max_tasks is not None and index >= max_tasks:
+            break
+
+        yield StreamTask(index, task_index, loaders,
+                         num_passes=num_passes, with_indices=with_indices)
@@ -0,0 +1,142 @@
+from __future__ import print_function
+import math
+import torch
+import torch.nn.functional as F
+
+from loaders.indexed import with_sample_indices
+from loaders.resident import ResidentBatchLoader, split_tensors
+
+
+def is_transform_task(task):
+    ''' True for the tasks that are derived from mnist by a per-task transform '''
+    return task in ['permuted', 'permuted_mnist', 'rotated', 'rotated_mnist']
+
+
+class PixelPermutation(object):
+    ''' permutes the pixels of a [B, C, H, W] minibatch with a single gather;
+        every task draws its (fixed) permutation from seed + task index,
+        the first task keeps the identity '''
+    def __init__(self, img_shp, task_index, seed=None):
+        num_pixels = int(img_shp[-2] * img_shp[-1])
+        if task_index == 0:
+            self.perm = torch.arange(num_pixels)
+        else:
+            generator = torch.Generator()
+            generator.manual_seed((seed or 0) + task_index)
+            self.perm = torch.randperm(num_pixels, generator=generator)
+
+    def __call__(self, x):
+        if self.perm.device != x.device:
+            self.perm = self.perm.to(x.device)
+
+        batch_size, chans = x.size(0), x.size(1)
+        return x.view(batch_size, chans, -1).index_select(2, self.perm).view_as(x)
+
+
+class Rotation(object):
+    ''' rotates a [B, C, H, W] minibatch by task_index * step degrees with
+        one batched affine_grid / grid_sample; the grid of every minibatch
+        shape is computed once '''
+    def __init__(self, task_index, step=30.0):
+        self.angle = math.radians(task_index * step)
+        self.grids = {}
+
+    def __call__(self, x):
+        x = x.float().div_(255.0) if x.dtype == torch.uint8 else x
+        if self.angle == 0:
+            return x
+
+        key = (tuple(x.size()), x.device)
+        if key not in self.grids:
+            cos, sin = math.cos(self.angle), math.sin(self.angle)
+            theta = torch.tensor([[cos, -sin, 0.0], [sin, cos, 0.0]],
+                                 dtype=x.dtype, device=x.device)
+            self.grids[key] = F.affine_grid(theta.unsqueeze(0).expand(x.size(0), 2, 3),
+                                            x.size(), align_corners=False)
+
+        return F.grid_sample(x, self.grids[key], align_corners=False)
+
+
+def build_task_transform(task, task_index, img_shp, seed=None, rotation_step=30.0):
+    if task.startswith('permuted'):
+        return PixelPermutation(img_shp, task_index, seed=seed)
+    elif task.startswith('rotated'):
+        return Rotation(task_index, step=rotation_step)
+
+    raise Exception("unknown transform task {}".format(task))
+
+
+class TransformedBatchLoader(object):
+    ''' applies a task transform to every minibatch of a batch iterable
+        (DataLoader / ResidentBatchLoader); any other attribute is the
+        wrapped loader's '''
+    def __init__(self, loader, transform):
+        self.loader = loader
+        self.transform = transform
+
+    def __getattr__(self, name):
+        if name in ['loader', 'transform']: # not set yet, eg: when unpickling
+            raise AttributeError(name)
+
+        return getattr(self.loader, name)
+
+    def with_indices(self):
+        return TransformedBatchLoader(with_sample_indices(self.loader), self.transform)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        for minibatch in self.loader:
+            yield (self.transform(minibatch[0]),) + tuple(minibatch[1:])
+
+
+def _materialize(data_loader, transform, batch_size, shuffle, cuda=False, chunk_size=1024):
+    ''' applies the transform once to the whole split, in chunks, and
+        returns a resident loader over the result '''
+    if isinstance(data_loader, ResidentBatchLoader):
+        x, y = data_loader.x, data_loader.y
+    else:
+        x, y = split_tensors(data_loader)
+
+    x, y = (x.cuda(), y.cuda()) if cuda else (x, y)
+    x = torch.cat([transform(chunk) for chunk in torch.split(x, chunk_size)], 0)
+    return ResidentBatchLoader(x.contiguous(), y, batch_size, shuffle=shuffle,
+                               drop_last=data_loader.drop_last)
+
+
+class TransformedLoader(object):
+    ''' one task of a permuted / rotated sequence over a shared base loader,
+        with the train_loader / test_loader / img_shp interface '''
+    def __init__(self, base_loader, transform, batch_size, materialize=False, cuda=False):
+        for k, v in vars(base_loader).items():
+            if k not in ['train_loader', 'test_loader']:
+                setattr(self, k, v)
+
+        if materialize:
+            self.train_loader = _materialize(base_loader.train_loader, transform, batch_size,
+                                             shuffle=True, cuda=cuda)
+            self.test_loader = _materialize(base_loader.test_loader, transform, batch_size,
+                                            shuffle=False, cuda=cuda)
+        else:
+            self.train_loader = TransformedBatchLoader(base_loader.train_loader, transform)
+            self.test_loader = TransformedBatchLoader(base_loader.test_loader, transform)
+
+
+def transformed_loader(base_loader, task, task_index, batch_size, seed=None,
+                       rotation_step=30.0, materialize=False, cuda=False):
+    ''' the loader of task task_index of a permuted / rotated sequence '''
+    transform = build_task_transform(task, task_index, base_loader.img_shp,
+                                     seed=seed, rotation_step=rotation_step)
+    return TransformedLoader(base_loader, transform, batch_size,
+                             materialize=materialize, cuda=cuda)
+
+
+def transformed_loaders(base_loader, task, num_tasks, batch_size, seed=None,
+                        rotation_step=30.0, materialize=False, cuda=False):
+    ''' derives num_tasks loaders of a permuted / rotated task from the
+        loader of its base dataset, transforming whole minibatches '''
+    return [transformed_loader(base_loader, task, i, batch_size, seed=seed,
+                               rotation_step=rotation_step,
+                               materialize=materialize, cuda=cuda)
+            for i in range(num_tasks)]
@@ -1,4 +1,5 @@
 import os
+import time
 import json
 import argparse
 import numpy as np
@@ -9,17 +10,26 @@ import torch.optim as optim
 
 from torch.autograd import Variable
 from copy import deepcopy
+from functools import partial
 
 from models.vae.parallelly_reparameterized_vae import ParallellyReparameterizedVAE
 from models.vae.sequentially_reparameterized_vae import SequentiallyReparameterizedVAE
 from models.student_teacher import StudentTeacher
+from models.ewc import ElasticWeightConsolidation, estimate_fisher
 from helpers.layers import EarlyStopping, init_weights
 from datasets.loader import get_split_data_loaders, get_loader
 from optimizers.adamnormgrad import AdamNormGrad
+from optimizers.state_transfer import transfer_optimizer_state
+from loaders.indexed import with_sample_indices
+from loaders.dataset_cache import cached_loaders
+from loaders.resident import resident_loaders
+from loaders.task_transforms import is_transform_task, transformed_loader
+from loaders.lazy import LazyLoaderList
+from loaders.stream import task_stream
 from helpers.grapher import Grapher
 from helpers.fid import train_fid_model
-from helpers.metrics import calculate_consistency, calculate_fid, estimate_fisher
-from helpers.utils import float_type, ones_like, \
+from helpers.metrics import calculate_consistency, calculate_fid
+from helpers.utils import ones_like, \
     append_to_csv, num_samples_in_loader, check_or_create_dir, \
     dummy_context, number_of_parameters
 
@@ -41,6 +51,30 @@ parser.add_argument('--download', type=int, default=1,
                     help='download dataset from s3 (default: 1)')
 parser.add_argument('--data-dir', type=str, default='./.datasets', metavar='DD',
                     help='directory which contains input data')
+parser.add_argument('--dataset-cache', action='store_true',
+                    help='decodes the task datasets once into memory-mapped shards under data-dir (default: False)')
+parser.add_argument('--resident-loaders', action='store_true',
+                    help='holds each split as one tensor on the device and batches by slicing (default: False)')
+parser.add_argument('--lazy-task-sequence', action='store_true',
+                    help='with --disable-sequential builds each dataset of a + task sequence on its own when it is reached; skips any cross-sequence handling of the dataset loader (default: False)')
+parser.add_argument('--streaming', action='store_true',
+                    help='trains over a stream of tasks and forks at its task boundaries instead of fixed epochs per task (default: False)')
+parser.add_argument('--stream-passes', type=int, default=1,
+                    help='passes over the samples of a streamed task before the next boundary (default: 1)')
+parser.add_argument('--stream-cycle', action='store_true',
+                    help='revisits the tasks forever (or until --stream-max-tasks) in streaming mode (default: False)')
+parser.add_argument('--stream-max-tasks', type=int, default=None,
+                    help='number of tasks after which the stream ends (default: None)')
+parser.add_argument('--max-discrete-size', type=int, default=None,
+                    help='caps the growth of the discrete latent across forks (default: None)')
+parser.add_argument('--batched-task-transforms', action='store_true',
+                    help='derives permuted / rotated tasks from mnist by transforming whole minibatches (default: False)')
+parser.add_argument('--num-transform-tasks', type=int, default=5,
+                    help='number of permuted / rotated tasks with --batched-task-transforms (default: 5)')
+parser.add_argument('--rotation-step', type=float, default=30.0,
+                    help='degrees between consecutive rotated tasks (default: 30)')
+parser.add_argument('--materialize-task-transforms', action='store_true',
+                    help='applies the batched task transforms once and keeps the results resident (default: False)')
 parser.add_argument('--output-dir', type=str, default='./experiments', metavar='OD',
                     help='directory which contains csv results')
 parser.add_argument('--model-dir', type=str, default='.models', metavar='MD',
@@ -51,6 +85,14 @@ parser.add_argument('--calculate-fid-with', type=str, default=None,
                     help='enables FID calc & uses model conv/inceptionv3  (default: None)')
 parser.add_argument('--disable-augmentation', action='store_true',
                     help='disables student-teacher data augmentation')
+parser.add_argument('--replay-buffer-size', type=int, default=0,
+                    help='size of the background teacher replay ring, 0 generates every step (default: 0)')
+parser.add_argument('--replay-generation-batch-size', type=int, default=None,
+                    help='#samples the replay worker generates at once (default: batch-size)')
+parser.add_argument('--replay-refresh-policy', type=str, default='fifo',
+                    help='replay eviction policy: fifo / random (default: fifo)')
+parser.add_argument('--replay-reuse', type=float, default=1.0,
+                    help='expected #draws of a replay sample before it is refreshed (default: 1.0)')
 
 # train / eval or resume modes
 parser.add_argument('--resume-training-with', type=int, default=None,
@@ -83,8 +125,14 @@ parser.add_argument('--shuffle-minibatches', action='store_true',
                     help='shuffles the student\'s minibatch (default: False)')
 parser.add_argument('--use-relational-encoder', action='store_true',
                     help='uses a relational network as the encoder projection layer')
+parser.add_argument('--relational-pair-chunk', type=int, default=1024,
+                    help='#feature pairs the relational encoder processes at once (default: 1024)')
+parser.add_argument('--relational-hidden-size', type=int, default=512,
+                    help='hidden size of the relational encoder (default: 512)')
 parser.add_argument('--use-pixel-cnn-decoder', action='store_true',
                     help='uses a pixel CNN decoder (default: False)')
+parser.add_argument('--sparse-latent-decoding', action='store_true',
+                    help='decodes hard one-hot latents by category index at eval / generation (default: False)')
 parser.add_argument('--disable-gated-conv', action='store_true',
                     help='disables gated convolutional structure (default: False)')
 parser.add_argument('--disable-student-teacher', action='store_true',
@@ -97,8 +145,20 @@ parser.add_argument('--lr', type=float, default=1e-3, metavar='LR',
                     help='learning rate (default: 1e-3)')
 parser.add_argument('--early-stop', action='store_true',
                     help='enable early stopping (default: False)')
+parser.add_argument('--freeze-encoder-blocks', type=int, default=0,
+                    help='freezes the first N encoder blocks of the student after a fork and caches them per train sample (default: 0)')
+parser.add_argument('--encoder-prefix-cache-mb', type=float, default=1024,
+                    help='device memory budget of the frozen encoder prefix cache, above it the prefix is recomputed (default: 1024)')
+parser.add_argument('--compact-teacher', type=str, default='none',
+                    help='converts the teacher on fork: none, int8 (CPU, linear layers) or bf16 (default: none)')
+parser.add_argument('--reset-optimizer-on-fork', action='store_true',
+                    help='do not carry the optimizer state over to the new student (default: False)')
 parser.add_argument('--batch-size', type=int, default=64, metavar='N',
                     help='input batch size for training (default: 64)')
+parser.add_argument('--real-batch-size', type=int, default=None,
+                    help='#real samples per step, synthetic samples are appended to these (default: None)')
+parser.add_argument('--replay-batch-size', type=int, default=None,
+                    help='max #synthetic samples per step when decoupled from the real ones (default: real-batch-size)')
 
 # Regularizer related
 parser.add_argument('--disable-regularizers', action='store_true',
@@ -121,8 +181,22 @@ parser.add_argument('--mut-clamp-strategy', type=str, default="clamp",
                     help='clamp mut info by norm / clamp / none (default: clamp)')
 parser.add_argument('--mut-clamp-value', type=float, default=100.0,
                     help='max / min clamp value if above strategy is clamp (default: 100.0)')
+parser.add_argument('--prune-dead-categories', action='store_true',
+                    help='reuse the teacher\'s unused categories instead of growing the discrete latent on fork (default: False)')
+parser.add_argument('--dead-category-threshold', type=float, default=1e-3,
+                    help='categories picked for less than this fraction of the samples are dead (default: 1e-3)')
 parser.add_argument('--ewc-gamma', type=float, default=0,
                     help='any value greater than 0 enables EWC with this hyper-parameter (default: 0)')
+parser.add_argument('--ewc-fisher-dtype', type=str, default='float32',
+                    help='storage precision of the EWC fisher: float32 / float16 / bfloat16 (default: float32)')
+parser.add_argument('--fisher-max-samples', type=int, default=None,
+                    help='max #samples used to estimate the EWC fisher, None uses the full loader (default: None)')
+parser.add_argument('--fisher-tol', type=float, default=0.0,
+                    help='stop the fisher estimate once its relative change is below this, 0 disables (default: 0.0)')
+parser.add_argument('--fisher-chunk-size', type=int, default=32,
+                    help='#samples whose per-sample grads are computed at once (default: 32)')
+parser.add_argument('--ewc-online-decay', type=float, default=1.0,
+                    help='decay of the previous fisher when consolidating a new task, 1 sums them (default: 1.0)')
 
 # Visdom parameters
 parser.add_argument('--visdom-url', type=str, default="http://localhost",
@@ -133,22 +207,37 @@ parser.add_argument('--visdom-port', type=int, default="8097",
 # Device parameters
 parser.add_argument('--seed', type=int, default=None,
                     help='seed for numpy and pytorch (default: None)')
+parser.add_argument('--noise-pool-steps', type=int, default=16,
+                    help='#steps of reparameterization noise drawn ahead of time (default: 16)')
 parser.add_argument('--ngpu', type=int, default=1,
                     help='number of gpus available (default: 1)')
 parser.add_argument('--no-cuda', action='store_true', default=False,
                     help='disables CUDA training')
 args = parser.parse_args()
 args.cuda = not args.no_cuda and torch.cuda.is_available()
+if args.real_batch_size is not None and args.replay_batch_size is None:
+    # otherwise the synthetic part grows with every task
+    args.replay_batch_size = args.real_batch_size
+
+if args.stream_cycle and args.stream_max_tasks is None and args.max_discrete_size is None \
+   and args.ewc_gamma <= 0 and args.discrete_size > 0 and args.reparam_type in ['discrete', 'mixture']:
+    parser.error("--stream-cycle grows the discrete latent at every fork, bound it with --max-discrete-size or --stream-max-tasks")
+
+if args.lazy_task_sequence and not args.disable_sequential:
+    parser.error("--lazy-task-sequence only splits the vanilla get_loader path, add --disable-sequential")
 
 
 # handle randomness / non-randomness
 if args.seed is not None:
     print("setting seed %d" % args.seed)
-    numpy.random.seed(args.seed)
-    torch.manual_seed_all(args.seed)
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    torch.cuda.manual_seed_all(args.seed)
 
 
-def build_optimizer(model):
+def build_optimizer(model, prev_optimizer=None, param_map=None):
+    ''' builds the optimizer for the model, optionally carrying over the state
+        of prev_optimizer through the fork's param_map'''
     optim_map = {
         "rmsprop": optim.RMSprop,
         "adam": optim.Adam,
@@ -159,10 +248,17 @@ def build_optimizer(model):
     }
     # filt = filter(lambda p: p.requires_grad, model.parameters())
     # return optim_map[args.optimizer.lower().strip()](filt, lr=args.lr)
-    return optim_map[args.optimizer.lower().strip()](
+    optimizer = optim_map[args.optimizer.lower().strip()](
         model.parameters(), lr=args.lr
     )
 
+    if prev_optimizer is not None and param_map is not None \
+       and not args.reset_optimizer_on_fork:
+        num_transferred = transfer_optimizer_state(prev_optimizer, optimizer, param_map)
+        print("carried over optimizer state of {} params".format(num_transferred))
+
+    return optimizer
+
 
 def register_plots(loss, grapher, epoch, prefix='train'):
     for k, v in loss.items():
@@ -234,7 +330,9 @@ def execute_graph(epoch, model, fisher, data_loader, grapher, optimizer=None, pr
     assert optimizer is not None if 'train' in prefix else optimizer is None
     loss_map, params, num_samples = {}, {}, 0
 
-    for data, _ in data_loader:
+    for minibatch in data_loader:
+        # indexed loaders also return the dataset indices of the samples
+        data, indices = minibatch[0], minibatch[2] if len(minibatch) > 2 else None
         data = Variable(data).cuda() if args.cuda else Variable(data)
 
         if 'train' in prefix:
@@ -244,7 +342,7 @@ def execute_graph(epoch, model, fisher, data_loader, grapher, optimizer=None, pr
 
         with torch.no_grad() if 'train' not in prefix else dummy_context():
             # run the VAE and extract loss
-            output_map = model(data)
+            output_map = model(data, indices)
             loss_t = model.loss_function(output_map, fisher)
 
         if 'train' in prefix:
@@ -310,27 +408,84 @@ def generate(student_teacher, grapher, name='teacher'):
 
 def get_model_and_loader():
     ''' helper to return the model and the loader '''
-    if args.disable_sequential: # vanilla batch training
-        loaders = get_loader(args)
-        loaders = [loaders] if not isinstance(loaders, list) else loaders
-    else: # classes split
-        loaders = get_split_data_loaders(args, num_classes=10)
-
-    for l in loaders:
-        print("train = ", num_samples_in_loader(l.train_loader),
+    # the loaders only provide the real part of a step's minibatch
+    loader_args = args
+    if args.real_batch_size is not None:
+        loader_args = deepcopy(args)
+        loader_args.batch_size = args.real_batch_size
+
+    def _build_task_loaders(task_args):
+        ''' builds (or reads back from the dataset cache) the loaders of task_args '''
+        def _build_loaders():
+            if task_args.disable_sequential: # vanilla batch training
+                loaders = get_loader(task_args)
+                return [loaders] if not isinstance(loaders, list) else loaders
+
+            # classes split
+            return get_split_data_loaders(task_args, num_classes=10)
+
+        loaders = cached_loaders(task_args, _build_loaders) \
+            if args.dataset_cache else _build_loaders()
+        if args.resident_loaders: # keep every split as one tensor on the device
+            loaders = resident_loaders(loaders, task_args.batch_size, cuda=args.cuda)
+
+        return loaders
+
+    def _print_num_samples(task_index, l):
+        print("task {}: train = ".format(task_index), num_samples_in_loader(l.train_loader),
               " | test = ", num_samples_in_loader(l.test_loader))
 
+    tasks = args.task.split('+')
+    if args.batched_task_transforms and is_transform_task(args.task):
+        # every task is a transform of the one mnist loader
+        base_args = deepcopy(loader_args)
+        base_args.task, base_args.disable_sequential = 'mnist', True
+        base_loader = []
+
+        def _build_transformed(task_index):
+            if not base_loader:
+                base_loader.append(_build_task_loaders(base_args)[0])
+
+            return transformed_loader(base_loader[0], args.task, task_index,
+                                      base_args.batch_size, seed=args.seed,
+                                      rotation_step=args.rotation_step,
+                                      materialize=args.materialize_task_transforms,
+                                      cuda=args.cuda and args.resident_loaders)
+
+        loaders = LazyLoaderList([partial(_build_transformed, i)
+                                  for i in range(args.num_transform_tasks)],
+                                 on_build=_print_num_samples)
+    elif len(tasks) > 1 and args.lazy_task_sequence:
+        # opt-in: a dataset sequence, eg: mnist+svhn+mnist, built one dataset
+        # per task with the same get_loader call the vanilla path makes
+        def _build_dataset_task(task):
+            task_args = deepcopy(loader_args)
+            task_args.task, task_args.disable_sequential = task, True
+            return _build_task_loaders(task_args)[0]
+
+        loaders = LazyLoaderList([partial(_build_dataset_task, t) for t in tasks],
+                                 on_build=_print_num_samples)
+    else:
+        # the splits of one get_*loader call are built together when first
+        # used and only counted when their task is reached
+        loaders = LazyLoaderList.from_group_builder(partial(_build_task_loaders, loader_args),
+                                                    on_build=_print_num_samples)
+
     # append the image shape to the config & build the VAE
-    args.img_shp =  loaders[0].img_shp,
+    # only the first task that is used gets built here
+    first_task = args.eval_with_loader if args.eval_with is not None \
+        and args.eval_with_loader is not None else args.resume_training_with or 0
+    img_shp = loaders[first_task].img_shp
+    args.img_shp =  img_shp,
     if args.vae_type == 'sequential':
         # Sequential : P(y|x) --> P(z|y, x) --> P(x|z)
         # Keep a separate VAE spawn here in case we want
         # to parameterize the sequence of reparameterizers
-        vae = SequentiallyReparameterizedVAE(loaders[0].img_shp,
+        vae = SequentiallyReparameterizedVAE(img_shp,
                                              kwargs=vars(args))
     elif args.vae_type == 'parallel':
         # Ours: [P(y|x), P(z|x)] --> P(x | z)
-        vae = ParallellyReparameterizedVAE(loaders[0].img_shp,
+        vae = ParallellyReparameterizedVAE(img_shp,
                                            kwargs=vars(args))
     else:
         raise Exception("unknown VAE type requested")
@@ -348,13 +503,6 @@ def get_model_and_loader():
     return [student_teacher, loaders, grapher]
 
 
-def lazy_generate_modules(model, img_shp):
-    ''' Super hax, but needed for building lazy modules '''
-    model.eval()
-    data = float_type(args.cuda)(args.batch_size, *img_shp).normal_()
-    model(Variable(data))
-
-
 def test_and_generate(epoch, model, fisher, loader, grapher):
     test_loss = test(epoch=epoch, model=model,
                      fisher=fisher, loader=loader.test_loader,
@@ -365,8 +513,8 @@ def test_and_generate(epoch, model, fisher, loader, grapher):
 
 
 def eval_model(data_loaders, model, fid_model, args):
-    ''' simple helper to evaluate the model over all the loaders'''
-    for loader in data_loaders:
+    ''' simple helper to evaluate the model over all the (lazy) loaders'''
+    for i, loader in enumerate(data_loaders):
         test_loss = test(epoch=-1, model=model, fisher=None,
                          loader=loader.test_loader, grapher=None, prefix='test')
 
@@ -388,9 +536,95 @@ def eval_model(data_loaders, model, fid_model, args):
                                         cuda=args.cuda),
                           os.path.join(args.output_dir, "{}_fid.csv".format(args.uid)))
 
+        data_loaders.release(i) # the metrics of this task are written
+
+
+def _time_teacher_step(model, teacher, data, num_iters=10):
+    ''' ms of the teacher's work in a step: Q(z|x) and a replay batch '''
+    with torch.no_grad():
+        def _step():
+            teacher.posterior(data)
+            model.generate_synthetic_samples(teacher, data.size(0))
+
+        _step() # warm up
+        if args.cuda:
+            torch.cuda.synchronize()
+
+        begin = time.time()
+        for _ in range(num_iters):
+            _step()
+
+        if args.cuda:
+            torch.cuda.synchronize()
+
+        return 1000.0 * (time.time() - begin) / num_iters
+
+
+def report_compact_teacher(model, fp32_teacher, loader, args):
+    ''' compares the compacted teacher against its float32 version;
+        writes the teacher step speedup and the consistency drift '''
+    compact_teacher = model.teacher
+    data = next(iter(loader.test_loader))[0]
+    data = data.cuda() if args.cuda else data
+    fp32_ms = _time_teacher_step(model, fp32_teacher, data)
+    compact_ms = _time_teacher_step(model, compact_teacher, data)
+
+    model.teacher = fp32_teacher
+    fp32_consistency = np.asarray(calculate_consistency(model, loader, args.reparam_type,
+                                                        args.vae_type, args.cuda)).reshape(-1)
+    model.teacher = compact_teacher
+    compact_consistency = np.asarray(calculate_consistency(model, loader, args.reparam_type,
+                                                           args.vae_type, args.cuda)).reshape(-1)
+    drift = compact_consistency - fp32_consistency
+    print("{} teacher step: {:.2f}ms vs {:.2f}ms float32 ({:.2f}x), consistency drift: {}".format(
+        args.compact_teacher, compact_ms, fp32_ms, fp32_ms / compact_ms, drift.tolist()))
+    append_to_csv([fp32_ms, compact_ms, fp32_ms / compact_ms],
+                  os.path.join(args.output_dir, "{}_compact_teacher_ms.csv".format(args.uid)))
+    append_to_csv(drift.tolist(),
+                  os.path.join(args.output_dir, "{}_compact_teacher_drift.csv".format(args.uid)))
+
+
+def write_task_metrics(model, loader, previous_loader, test_loss, epoch, fid_model, grapher, args):
+    ''' writes the one-time metrics of the task of loader; the consistency
+        is computed on the previous task's loader (if any) '''
+    # evaluate and save away one-time metrics, these include:
+    #    1. test elbo
+    #    2. FID
+    #    3. consistency
+    #    4. num synth + num true samples
+    #    5. dump config to visdom
+    check_or_create_dir(os.path.join(args.output_dir))
+    append_to_csv([test_loss['elbo_mean']], os.path.join(args.output_dir, "{}_test_elbo.csv".format(args.uid)))
+    append_to_csv([test_loss['elbo_mean']], os.path.join(args.output_dir, "{}_test_elbo.csv".format(args.uid)))
+    num_synth_samples = model.num_synthetic_seen
+    num_true_samples = model.num_real_seen
+    append_to_csv([num_synth_samples],os.path.join(args.output_dir, "{}_numsynth.csv".format(args.uid)))
+    append_to_csv([num_true_samples], os.path.join(args.output_dir, "{}_numtrue.csv".format(args.uid)))
+    append_to_csv([epoch], os.path.join(args.output_dir, "{}_epochs.csv".format(args.uid)))
+    grapher.vis.text(num_synth_samples, opts=dict(title="num_synthetic_samples"))
+    grapher.vis.text(num_true_samples, opts=dict(title="num_true_samples"))
+    grapher.vis.text(pprint.PrettyPrinter(indent=4).pformat(model.student.config),
+                     opts=dict(title="config"))
+
+    # calc the consistency using the **PREVIOUS** loader
+    if previous_loader is not None:
+        append_to_csv(calculate_consistency(model, previous_loader, args.reparam_type, args.vae_type, args.cuda),
+                      os.path.join(args.output_dir, "{}_consistency.csv".format(args.uid)))
+
+    if args.calculate_fid_with is not None:
+        # TODO: parameterize num fid samples, currently use less for inceptionv3 as it's COSTLY
+        num_fid_samples = 4000 if args.calculate_fid_with != 'inceptionv3' else 1000
+        append_to_csv(calculate_fid(fid_model=fid_model,
+                                    model=model,
+                                    loader=loader, grapher=grapher,
+                                    num_samples=num_fid_samples,
+                                    cuda=args.cuda),
+                      os.path.join(args.output_dir, "{}_fid.csv".format(args.uid)))
+
 
 def train_loop(data_loaders, model, fid_model, grapher, args):
-    ''' simple helper to run the entire train loop; not needed for eval modes'''
+    ''' simple helper to run the entire train loop over the (lazy) loaders;
+        not needed for eval modes'''
     optimizer = build_optimizer(model.student)     # collect our optimizer
     print("there are {} params with {} elems in the st-model and {} params in the student with {} elems".format(
         len(list(model.parameters())), number_of_parameters(model),
@@ -402,12 +636,20 @@ def train_loop(data_loaders, model, fid_model, grapher, args):
     for j, loader in enumerate(data_loaders):
         num_epochs = args.epochs # TODO: randomize epochs by something like: + np.random.randint(0, 13)
         print("training current distribution for {} epochs".format(num_epochs))
+        model.reset_sample_counts()
+
+        # the frozen encoder prefix of the student is cached per train sample
+        train_loader = loader.train_loader
+        if args.freeze_encoder_blocks > 0:
+            train_loader = with_sample_indices(loader.train_loader)
+            model.reset_encoder_prefix_cache(len(train_loader.dataset))
+
         early = EarlyStopping(model, max_steps=50, burn_in_interval=None) if args.early_stop else None
                               #burn_in_interval=int(num_epochs*0.2)) if args.early_stop else None
 
         test_loss = None
         for epoch in range(1, num_epochs + 1):
-            train(epoch, model, fisher, optimizer, loader.train_loader, grapher)
+            train(epoch, model, fisher, optimizer, train_loader, grapher)
             test_loss = test(epoch, model, fisher, loader.test_loader, grapher)
             if args.early_stop and early(test_loss['loss_mean']):
                 early.restore() # restore and test+generate again
@@ -417,75 +659,115 @@ def train_loop(data_loaders, model, fid_model, grapher, args):
             generate(model, grapher, 'student') # generate student samples
             generate(model, grapher, 'teacher') # generate teacher samples
 
-        # evaluate and save away one-time metrics, these include:
-        #    1. test elbo
-        #    2. FID
-        #    3. consistency
-        #    4. num synth + num true samples
-        #    5. dump config to visdom
-        check_or_create_dir(os.path.join(args.output_dir))
-        append_to_csv([test_loss['elbo_mean']], os.path.join(args.output_dir, "{}_test_elbo.csv".format(args.uid)))
-        append_to_csv([test_loss['elbo_mean']], os.path.join(args.output_dir, "{}_test_elbo.csv".format(args.uid)))
-        num_synth_samples = np.ceil(epoch * args.batch_size * model.ratio)
-        num_true_samples = np.ceil(epoch * (args.batch_size - (args.batch_size * model.ratio)))
-        append_to_csv([num_synth_samples],os.path.join(args.output_dir, "{}_numsynth.csv".format(args.uid)))
-        append_to_csv([num_true_samples], os.path.join(args.output_dir, "{}_numtrue.csv".format(args.uid)))
-        append_to_csv([epoch], os.path.join(args.output_dir, "{}_epochs.csv".format(args.uid)))
-        grapher.vis.text(num_synth_samples, opts=dict(title="num_synthetic_samples"))
-        grapher.vis.text(num_true_samples, opts=dict(title="num_true_samples"))
-        grapher.vis.text(pprint.PrettyPrinter(indent=4).pformat(model.student.config),
-                         opts=dict(title="config"))
-
-        # calc the consistency using the **PREVIOUS** loader
+        # evaluate and save away one-time metrics
+        write_task_metrics(model, loader, data_loaders[j - 1] if j > 0 else None,
+                           test_loss, epoch, fid_model, grapher, args)
         if j > 0:
-            append_to_csv(calculate_consistency(model, data_loaders[j - 1], args.reparam_type, args.vae_type, args.cuda),
-                          os.path.join(args.output_dir, "{}_consistency.csv".format(args.uid)))
+            data_loaders.release(j - 1) # no longer needed by any metric
 
+        grapher.save() # save the remote visdom graphs
+        if j == len(data_loaders) - 1:
+            data_loaders.release(j)
+        else:
+            fisher, optimizer, grapher = fork_student(model, fisher, optimizer, loader, args)
 
-        if args.calculate_fid_with is not None:
-            # TODO: parameterize num fid samples, currently use less for inceptionv3 as it's COSTLY
-            num_fid_samples = 4000 if args.calculate_fid_with != 'inceptionv3' else 1000
-            append_to_csv(calculate_fid(fid_model=fid_model,
-                                        model=model,
-                                        loader=loader, grapher=grapher,
-                                        num_samples=num_fid_samples,
-                                        cuda=args.cuda),
-                          os.path.join(args.output_dir, "{}_fid.csv".format(args.uid)))
 
+def stream_train_loop(data_loaders, model, fid_model, grapher, args):
+    ''' trains over a stream of tasks instead of a fixed number of epochs
+        per task: every task boundary announced by the stream forks a new
+        student. Only the active task and the previous one (consistency)
+        are held in memory, regardless of the length of the stream. '''
+    optimizer = build_optimizer(model.student)     # collect our optimizer
+    stream = task_stream(data_loaders,
+                         num_passes=args.stream_passes,
+                         cycle=args.stream_cycle,
+                         max_tasks=args.stream_max_tasks,
+                         with_indices=args.freeze_encoder_blocks > 0)
+
+    fisher, previous = None, None
+    for task in stream:
+        if previous is not None: # a task boundary, the previous task is over
+            fisher, optimizer, grapher = fork_student(model, fisher, optimizer,
+                                                      previous.loader, args)
+
+        print("streaming task {} (loader {}) for {} passes".format(
+            task.index, task.task_index, args.stream_passes))
+        model.reset_sample_counts()
+        if args.freeze_encoder_blocks > 0:
+            model.reset_encoder_prefix_cache(task.num_samples)
+
+        epoch = task.index + 1
+        train(epoch, model, fisher, optimizer, task.train_loader(), grapher)
+        test_loss = test(epoch, model, fisher, task.loader.test_loader, grapher)
+        generate(model, grapher, 'student') # generate student samples
+        generate(model, grapher, 'teacher') # generate teacher samples
+
+        write_task_metrics(model, task.loader,
+                           previous.loader if previous is not None else None,
+                           test_loss, epoch, fid_model, grapher, args)
         grapher.save() # save the remote visdom graphs
-        if j != len(data_loaders) - 1:
-            if args.ewc_gamma > 0:
-                # calculate the fisher from the previous data loader
-                print("computing fisher info matrix....")
-                fisher_tmp = estimate_fisher(model.student, # this is pre-fork
-                                             loader, args.batch_size,
-                                             cuda=args.cuda)
-                if fisher is not None:
-                    assert len(fisher) == len(fisher_tmp), "#fisher params != #new fisher params"
-                    for (kf, vf), (kft, vft) in zip(fisher.items(), fisher_tmp.items()):
-                        fisher[kf] += fisher_tmp[kft]
-                else:
-                    fisher = fisher_tmp
-
-            # spawn a new student & rebuild grapher; we also pass
-            # the new model's parameters through a new optimizer.
-            if not args.disable_student_teacher:
-                model.fork()
-                lazy_generate_modules(model, data_loaders[0].img_shp)
-                optimizer = build_optimizer(model.student)
-                print("there are {} params with {} elems in the st-model and {} params in the student with {} elems".format(
-                    len(list(model.parameters())), number_of_parameters(model),
-                    len(list(model.student.parameters())), number_of_parameters(model.student))
-                )
+        if previous is not None:
+            previous.release() # no longer needed by any metric
+
+        previous = task
+
+    if previous is not None:
+        previous.release()
+
+
+def fork_student(model, fisher, optimizer, loader, args):
+    ''' ends the task of loader: consolidates the EWC fisher, forks a new
+        student off the current one and rebuilds the optimizer & grapher;
+        returns the (fisher, optimizer, grapher) of the next task '''
+    if args.ewc_gamma > 0:
+        # calculate the fisher from the previous data loader
+        print("computing fisher info matrix....")
+        fisher_tmp = estimate_fisher(model.student, # this is pre-fork
+                                     loader,
+                                     max_samples=args.fisher_max_samples,
+                                     tol=args.fisher_tol,
+                                     chunk_size=args.fisher_chunk_size,
+                                     cuda=args.cuda)
+        if fisher is None:
+            fisher = ElasticWeightConsolidation(args.ewc_gamma,
+                                                fisher_dtype=args.ewc_fisher_dtype,
+                                                online_decay=args.ewc_online_decay)
+
+        # anchor at the pre-fork student, ie: the next teacher
+        fisher.consolidate(model.student, fisher_tmp)
+
+    # spawn a new student & rebuild grapher; we also pass
+    # the new model's parameters through a new optimizer.
+    if not args.disable_student_teacher:
+        category_usage = model.category_usage(loader.train_loader) \
+            if args.prune_dead_categories else None
+        if category_usage is not None:
+            append_to_csv(category_usage.tolist(),
+                          os.path.join(args.output_dir, "{}_category_usage.csv".format(args.uid)))
+
+        # keep a float32 copy of the next teacher to report the compaction
+        fp32_teacher = deepcopy(model.student).eval() if args.compact_teacher != 'none' else None
+        param_map = model.fork(category_usage)
+        if fp32_teacher is not None:
+            report_compact_teacher(model, fp32_teacher, loader, args)
+            del fp32_teacher
+
+        optimizer = build_optimizer(model.student, optimizer, param_map)
+        print("there are {} params with {} elems in the st-model and {} params in the student with {} elems".format(
+            len(list(model.parameters())), number_of_parameters(model),
+            len(list(model.student.parameters())), number_of_parameters(model.student))
+        )
 
-            else:
-                # increment anyway for vanilla models
-                # so that we can have a separate visdom env
-                model.current_model += 1
+    else:
+        # increment anyway for vanilla models
+        # so that we can have a separate visdom env
+        model.current_model += 1
 
-            grapher = Grapher(env=model.get_name(),
-                              server=args.visdom_url,
-                              port=args.visdom_port)
+    grapher = Grapher(env=model.get_name(),
+                      server=args.visdom_url,
+                      port=args.visdom_port)
+
+    return fisher, optimizer, grapher
 
 
 def _set_model_indices(model, grapher, idx, args):
@@ -509,8 +791,9 @@ def _set_model_indices(model, grapher, idx, args):
         model.current_model = idx
         if not args.disable_augmentation:
             model.ratio = idx / (idx + 1.0)
-            num_teacher_samples = int(args.batch_size * model.ratio)
-            num_student_samples = max(args.batch_size - num_teacher_samples, 1)
+            num_student_samples, num_teacher_samples = model.samples_per_step(
+                args.real_batch_size or args.batch_size
+            )
             print("#teacher_samples: ", num_teacher_samples,
                   " | #student_samples: ", num_student_samples)
 
@@ -520,6 +803,17 @@ def _set_model_indices(model, grapher, idx, args):
             config_student = deepcopy(config_base)
             config_teacher['discrete_size'] += idx - 1
             config_student['discrete_size'] += idx
+
+            # pruned / capped forks grow by less, use the sizes saved with the checkpoints
+            discrete_sizes = StudentTeacher.load_discrete_sizes(config_base)
+            uniform_growth = not args.prune_dead_categories and args.max_discrete_size is None
+            if idx in discrete_sizes and idx - 1 in discrete_sizes:
+                config_teacher['discrete_size'] = discrete_sizes[idx - 1]
+                config_student['discrete_size'] = discrete_sizes[idx]
+            elif not uniform_growth:
+                raise Exception("{} has no discrete sizes for model {} and the run does not grow "
+                                "uniformly (--prune-dead-categories / --max-discrete-size)".format(
+                                    StudentTeacher.discrete_sizes_filename(config_base), idx))
             model.student = _init_vae(model.student.input_shape, config_student)
             if not args.disable_student_teacher:
                 model.teacher = _init_vae(model.student.input_shape, config_teacher)
@@ -536,10 +830,6 @@ def run(args):
     # collect our model and data loader
     model, data_loaders, grapher = get_model_and_loader()
 
-    # since some modules are lazy generated
-    # we want to run a single fwd pass
-    lazy_generate_modules(model, data_loaders[0].img_shp)
-
     # build a classifier to use for FID
     fid_model = None
     if args.calculate_fid_with is not None:
@@ -551,24 +841,25 @@ def run(args):
     # handle logic on whether to start /resume training or to eval
     if args.eval_with is None and args.resume_training_with is None:              # normal train loop
         print("starting main training loop from scratch...")
-        train_loop(data_loaders, model, fid_model, grapher, args)
+        loop = stream_train_loop if args.streaming else train_loop
+        loop(data_loaders, model, fid_model, grapher, args)
     elif args.eval_with is None and args.resume_training_with is not None:    # resume training from latest model
         print("resuming training on model {}...".format(args.resume_training_with))
         model, grapher = _set_model_indices(model, grapher, args.resume_training_with, args)
-        lazy_generate_modules(model, data_loaders[0].img_shp)
         if not model.load(): # restore after setting model ind
             raise Exception("model failed to load for resume training...")
 
-        train_loop(data_loaders[args.resume_training_with:], model, fid_model, grapher, args)
+        loop = stream_train_loop if args.streaming else train_loop
+        loop(data_loaders[args.resume_training_with:], model, fid_model, grapher, args)
     elif args.eval_with is not None:                                      # eval the provided model
         print("evaluating model {}...".format(args.eval_with))
         model, grapher = _set_model_indices(model, grapher, args.eval_with, args)
-        lazy_generate_modules(model, data_loaders[0].img_shp)
         if not model.load(): # restore after setting model ind
             raise Exception("model failed to load for resume training...")
 
         if args.eval_with_loader is not None: # only use 1 loader
-            eval_model([data_loaders[args.eval_with_loader]], model, fid_model, args)
+            eval_model(data_loaders[args.eval_with_loader:][0:1],
+                       model, fid_model, args)
         else:
             eval_model(data_loaders, model, fid_model, args)
     else:
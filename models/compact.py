@@ -0,0 +1,69 @@
+from __future__ import print_function
+import torch
+import torch.nn as nn
+
+
+def _cast(value, dtype):
+    ''' casts the floating tensors of a (nested) tuple / list / dict to dtype '''
+    if torch.is_tensor(value):
+        return value.to(dtype) if value.is_floating_point() else value
+    elif isinstance(value, (tuple, list)):
+        return type(value)(_cast(v, dtype) for v in value)
+    elif isinstance(value, dict):
+        return {k: _cast(v, dtype) for k, v in value.items()}
+
+    return value
+
+
+def _parameterized_children(module):
+    ''' the children of module that hold parameters; module lists are
+        unrolled as they are never called themselves '''
+    for child in module.children():
+        if isinstance(child, (nn.ModuleList, nn.ModuleDict)):
+            for grandchild in _parameterized_children(child):
+                yield grandchild
+        elif any(True for _ in child.parameters()):
+            yield child
+
+
+def _to_bf16(model):
+    ''' stores the weights of every parameterized child in bfloat16; its
+        inputs are cast down and its outputs back up to float32, so the
+        callers of the model are unaware of the conversion '''
+    for child in _parameterized_children(model):
+        child.to(torch.bfloat16)
+        child.register_forward_pre_hook(lambda m, inputs: _cast(inputs, torch.bfloat16))
+        child.register_forward_hook(lambda m, inputs, output: _cast(output, torch.float32))
+
+    return model
+
+
+def compact_model(model, mode, cuda=False):
+    ''' converts a frozen model, in place, into a compact form for inference:
+            none : leave the model as is
+            int8 : dynamic int8 quantization of the nn.Linear layers; torch has
+                   no dynamically quantized conv and the kernels are CPU only
+            bf16 : bfloat16 weights with float32 inputs / outputs
+        the model is tagged with compact_mode '''
+    if mode == 'none' or getattr(model, 'compact_mode', 'none') != 'none':
+        return model
+
+    model.eval()
+    if mode == 'int8':
+        if cuda:
+            print("dynamic int8 quantization is CPU only, keeping the float32 model")
+            return model
+
+        model = torch.quantization.quantize_dynamic(model, {nn.Linear},
+                                                    dtype=torch.qint8, inplace=True)
+    elif mode == 'bf16':
+        model = _to_bf16(model)
+    else:
+        raise Exception("unknown compact mode {}".format(mode))
+
+    # the index based decoding reads the (replaced) fp32 weights directly
+    if getattr(model, 'sparse_decoder', None) is not None:
+        model.sparse_decoder = None
+
+    model.compact_mode = mode
+    return model
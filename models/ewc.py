@@ -0,0 +1,153 @@
+from __future__ import print_function
+import torch
+from collections import OrderedDict
+from torch.nn.utils import parameters_to_vector
+
+from helpers.distributions import nll as nll_fn
+
+
+def estimate_fisher(model, loader, max_samples=None, tol=0.0,
+                    chunk_size=32, cuda=False):
+    ''' diagonal fisher of the model's negative ELBO using per-sample grads;
+        torch.func vmaps the grad over a chunk of samples so every chunk
+        is a single batched forward / backward sweep.
+
+        Stops after max_samples (None uses the full train loader) or once
+        the relative change of the running estimate drops below tol. '''
+    from torch.func import functional_call, vmap, grad
+
+    was_training = model.training
+    model.eval()
+    params = OrderedDict((k, v.detach()) for k, v in model.named_parameters())
+    buffers = OrderedDict((k, v.detach()) for k, v in model.named_buffers())
+
+    def _sample_loss(params, x):
+        x = x.unsqueeze(0)
+        x_logits, latent_params = functional_call(model, (params, buffers), (x,))
+        nll = nll_fn(x, x_logits, model.config['nll_type'])
+        kld = model.config['kl_reg'] * model.kld(latent_params)
+        return torch.sum(nll + kld)
+
+    per_sample_grads = vmap(grad(_sample_loss), in_dims=(None, 0),
+                            randomness='different')
+
+    fisher = OrderedDict((k, torch.zeros_like(v)) for k, v in params.items())
+    num_samples, prev_estimate = 0, None
+    for data, _ in loader.train_loader:
+        data = data.cuda() if cuda else data
+        for chunk in torch.split(data, chunk_size):
+            if max_samples is not None and num_samples >= max_samples:
+                break
+
+            chunk = chunk[0:max_samples - num_samples] if max_samples is not None else chunk
+            grads = per_sample_grads(params, chunk)
+            for k, g in grads.items():
+                fisher[k].add_(torch.sum(g.detach() ** 2, 0))
+
+            num_samples += chunk.size(0)
+
+        # check the convergence of the running estimate once per minibatch
+        estimate = torch.cat([f.view(-1) for f in fisher.values()]) / num_samples
+        if prev_estimate is not None and tol > 0:
+            delta = torch.norm(estimate - prev_estimate) / (torch.norm(prev_estimate) + 1e-12)
+            if delta.item() < tol:
+                print("fisher converged after {} samples".format(num_samples))
+                break
+
+        prev_estimate = estimate
+        if max_samples is not None and num_samples >= max_samples:
+            break
+
+    for k in fisher.keys():
+        fisher[k].div_(max(num_samples, 1))
+
+    model.train(was_training)
+    return fisher
+
+
+class ElasticWeightConsolidation(object):
+    ''' keeps the EWC anchor weights and the diagonal fisher as single flat
+        buffers that are computed once per fork, along with per-parameter
+        views into them, so the penalty is a handful of grouped (_foreach)
+        ops over the student's parameter list.
+
+        The fisher can be stored in reduced precision (fisher_dtype); it is
+        then normalized by its max before the cast so that small entries do
+        not underflow to 0 in float16. It is consolidated online across
+        tasks: F_t = online_decay * F_{t-1} + F_new (online_decay=1 sums the
+        fishers of all tasks). '''
+    def __init__(self, ewc_gamma, fisher_dtype='float32', online_decay=1.0):
+        dtype_map = {
+            'float32': torch.float32,
+            'float16': torch.float16,
+            'bfloat16': torch.bfloat16
+        }
+        self.ewc_gamma = ewc_gamma
+        self.fisher_dtype = dtype_map[fisher_dtype]
+        self.online_decay = online_decay
+        self.anchor, self.anchor_views = None, None
+        self.fisher, self.fisher_views, self.fisher_scale = None, None, 1.0
+        self.upcast_fisher_views = {}
+
+    @staticmethod
+    def _flatten_fisher(fisher_matrix):
+        return torch.cat([f.detach().contiguous().view(-1).float()
+                          for f in fisher_matrix.values()])
+
+    @staticmethod
+    def _views(flat, params):
+        return [v.view_as(p) for v, p in zip(torch.split(flat, [p.numel() for p in params]), params)]
+
+    def consolidate(self, model, fisher_matrix):
+        ''' anchors the penalty at the current weights of model (the soon
+            to be teacher) and folds its fisher into the running fisher '''
+        params = list(model.parameters())
+        anchor = parameters_to_vector(params).detach().clone()
+        fisher = ElasticWeightConsolidation._flatten_fisher(fisher_matrix)
+        assert anchor.numel() == fisher.numel(), \
+            "#params [{}] != #fisher params [{}]".format(anchor.numel(), fisher.numel())
+        if self.fisher is not None:
+            assert self.fisher.numel() == fisher.numel(), \
+                "#fisher params [{}] != #new fisher params [{}]".format(self.fisher.numel(),
+                                                                         fisher.numel())
+            fisher.add_(self.fisher.float() * self.fisher_scale, alpha=self.online_decay)
+
+        # reduced precision stores F / max(F), the scale is applied in the penalty
+        self.fisher_scale = 1.0
+        if self.fisher_dtype != torch.float32:
+            self.fisher_scale = max(fisher.max().item(), 1e-30)
+
+        self.anchor = anchor
+        self.fisher = (fisher / self.fisher_scale).to(self.fisher_dtype)
+        self.anchor_views = self._views(self.anchor, params)
+        self.fisher_views = self._views(self.fisher, params)
+        self.upcast_fisher_views = {}
+
+    def _fisher_views_as(self, dtype):
+        ''' the fisher views in the parameters' dtype, cast once per consolidation '''
+        if self.fisher.dtype == dtype:
+            return self.fisher_views
+
+        if dtype not in self.upcast_fisher_views:
+            self.upcast_fisher_views[dtype] = [f.to(dtype) for f in self.fisher_views]
+
+        return self.upcast_fisher_views[dtype]
+
+    def penalty(self, model):
+        ''' (ewc_gamma / 2) * sum_i F_i * (theta_i - theta*_i)^2 '''
+        params = list(model.parameters())
+        fisher = self._fisher_views_as(params[0].dtype)
+        if hasattr(torch, '_foreach_sub'):
+            delta = torch._foreach_sub(params, self.anchor_views)
+            weighted = torch._foreach_mul(torch._foreach_mul(delta, delta), fisher)
+        else:
+            weighted = [f * (p - a) ** 2 for p, a, f in zip(params, self.anchor_views, fisher)]
+
+        # every weighted term is >= 0, so its L1 norm is its sum
+        if hasattr(torch, '_foreach_norm'):
+            partial_sums = torch._foreach_norm(weighted, 1)
+        else:
+            partial_sums = [torch.sum(w) for w in weighted]
+
+        scale = (self.ewc_gamma / 2.0) * self.fisher_scale
+        return scale * torch.stack(partial_sums).sum()
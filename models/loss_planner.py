@@ -0,0 +1,59 @@
+from __future__ import print_function
+from collections import OrderedDict
+
+
+def needs_mutual_info(config):
+    ''' True if the student's loss carries a mutual information term;
+        only the parallel discrete / mixture models compute one and the
+        mixture scales its two terms by their mut-info weights '''
+    if config['vae_type'] != 'parallel' or config['disable_regularizers']:
+        return False
+
+    if config['reparam_type'] == 'discrete':
+        return True
+    elif config['reparam_type'] == 'mixture':
+        return config['discrete_mut_info'] != 0 \
+            or config['continuous_mut_info'] != 0
+
+    return False
+
+
+def needs_teacher_posterior(config):
+    ''' True if the loss reads the teacher's Q(z|x); EWC only uses the
+        teacher's weights and the regularizers can be switched off '''
+    if config['ewc_gamma'] > 0 or config['disable_regularizers']:
+        return False
+
+    return config['consistency_gamma'] != 0 \
+        or config['likelihood_gamma'] > 0
+
+
+def needs_teacher_decoder(config):
+    ''' True if the likelihood regularizer needs the teacher's P(x|z) '''
+    return needs_teacher_posterior(config) \
+        and config['likelihood_gamma'] > 0
+
+
+class LossGraphPlanner(object):
+    ''' reads the config and decides which forward branches of the
+        student-teacher graph are needed by the active loss terms '''
+    def __init__(self, config):
+        self.branches = OrderedDict([
+            # Q(z | \hat{x}) of the student, used by the mutual info
+            ('student_posterior_of_reconstruction', needs_mutual_info(config)),
+            ('teacher_posterior', needs_teacher_posterior(config)),
+            ('teacher_decoder', needs_teacher_decoder(config))
+        ])
+
+    def __getitem__(self, branch):
+        return self.branches[branch]
+
+    def pruned(self):
+        ''' returns the list of branches that are not built '''
+        return [k for k, v in self.branches.items() if not v]
+
+    def __str__(self):
+        pruned = self.pruned()
+        return "loss graph planner pruned: {}".format(
+            ", ".join(pruned) if pruned else "nothing"
+        )
@@ -5,18 +5,24 @@ import torch.optim as optim
 import torch.nn.functional as F
 
 from torch.autograd import Variable
+from torch.utils.checkpoint import checkpoint
 
 from helpers.utils import to_data, expand_dims, \
     int_type, float_type, long_type, add_weight_norm
 
 
 class RelationalNetwork(nn.Module):
-    def __init__(self, hidden_size, output_size, cuda=False, ngpu=1):
+    ''' pair_chunk_size: if set, the pairs are pushed through the relation
+        network pair_chunk_size at a time and summed on the fly, so the
+        [B, F*F, 1, 2C] pair tensor and its activations are never built
+        in one piece (when training, autograd still keeps every chunk). '''
+    def __init__(self, hidden_size, output_size, cuda=False, ngpu=1, pair_chunk_size=None):
         super(RelationalNetwork, self).__init__()
         self.use_cuda = cuda
         self.ngpu = ngpu
         self.hidden_size = hidden_size
         self.output_size = output_size
+        self.pair_chunk_size = pair_chunk_size
 
         # build the final combined projector module
         self.proj = self._build_proj_model()
@@ -61,38 +67,168 @@ class RelationalNetwork(nn.Module):
                 self.rn = self.rn.cuda()
 
 
+    @staticmethod
+    def build_pairs(features, begin=0, end=None):
+        ''' features is [B, C, F]; returns the concatenated feature pairs
+            [B, end - begin, 2C] for the flat pair indices [begin, end),
+            pair p = i * F + j holds [f_i, f_j] '''
+        batch_size, chan_size, num_feat = list(features.size())
+        end = num_feat * num_feat if end is None else end
+        features = features.transpose(1, 2)  # eg: [100, 9, 24]
+        if begin == 0 and end == num_feat * num_feat:
+            pairs = torch.cat([
+                features.unsqueeze(2).expand(batch_size, num_feat, num_feat, chan_size),
+                features.unsqueeze(1).expand(batch_size, num_feat, num_feat, chan_size)
+            ], -1)  # eg: [100, 9, 9, 48]
+            return pairs.view(batch_size, num_feat * num_feat, 2 * chan_size)
+
+        indices = torch.arange(begin, end, device=features.device)
+        return torch.cat([features.index_select(1, indices // num_feat),
+                          features.index_select(1, indices % num_feat)], -1)
+
+    @staticmethod
+    def _batch_norm_channels(bn, x, begin, end, momentum):
+        ''' applies the BatchNorm2d bn to x, which holds its channels [begin, end) '''
+        use_batch_stats = bn.training or bn.running_mean is None
+        return F.batch_norm(
+            x,
+            bn.running_mean[begin:end] if bn.running_mean is not None else None,
+            bn.running_var[begin:end] if bn.running_var is not None else None,
+            bn.weight[begin:end] if bn.affine else None,
+            bn.bias[begin:end] if bn.affine else None,
+            use_batch_stats, momentum, bn.eps
+        )
+
+    def _chunked_rn(self, features):
+        ''' runs the relation network over pair_chunk_size pairs at a time
+            and reduces over the pairs on the fly; returns [B, H] '''
+        num_pairs = features.size(-1) ** 2
+        rn = self.rn.module if isinstance(self.rn, nn.DataParallel) else self.rn
+        batch_norms = [m for m in rn if isinstance(m, nn.BatchNorm2d)]
+
+        # every chunk updates its own slice of the running stats, so the
+        # (cumulative) momentum is decided once per forward pass
+        momentums = []
+        for bn in batch_norms:
+            momentum = 0.0 if bn.momentum is None else bn.momentum
+            if bn.training and bn.track_running_stats:
+                bn.num_batches_tracked.add_(1)
+                if bn.momentum is None:
+                    momentum = 1.0 / float(bn.num_batches_tracked)
+
+            momentums.append(momentum)
+
+        rn_output = None
+        for begin in range(0, num_pairs, self.pair_chunk_size):
+            end = min(begin + self.pair_chunk_size, num_pairs)
+            rbo = expand_dims(self.build_pairs(features, begin, end), 2)  # eg: [100, P, 1, 48]
+            bn_index = 0
+            for layer in rn:
+                if isinstance(layer, nn.BatchNorm2d):
+                    rbo = self._batch_norm_channels(layer, rbo, begin, end,
+                                                    momentums[bn_index])
+                    bn_index += 1
+                else:
+                    rbo = layer(rbo)
+
+            rbo = torch.sum(rbo.squeeze(2), 1)  # eg: [100, 128]
+            rn_output = rbo if rn_output is None else rn_output + rbo
+
+        return rn_output
+
     def forward(self, conv_output):
         batch_size, conv_chan_size, _, _ = list(conv_output.size())
         conv_output = conv_output.view(batch_size, conv_chan_size, -1) # convert to [B, C, -1]
         num_feat = conv_output.size(-1)
 
-        rn_buffer = [] # container to hold the tuples
+        # generate the relational network lazily
+        self._lazy_generate_rn(input_size=2 * conv_chan_size,
+                               latent_size=num_feat * num_feat,  # for BN [uses 2d BN over channels]
+                               output_size=self.hidden_size)
 
-        for i in range(num_feat): # run over all features (the -1 from view above)
-            chunk_i = conv_output[:, :, i].contiguous()
+        if self.pair_chunk_size is not None and self.pair_chunk_size < num_feat * num_feat:
+            return self.proj(self._chunked_rn(conv_output))
 
-            # for j in range(i+1, num_chans):
-            for j in range(num_feat): # run over all features (the -1 from view above)
-                chunk_j = conv_output[:, :, j].contiguous()
+        # build all the [f_i, f_j] pairs at once & expand the second to last dimension
+        rn_buffer = expand_dims(self.build_pairs(conv_output), 2) # eg: [100, 81, 1, 48]
 
-                # flatten the chunks and merge them together
-                chunk_i = chunk_i.view(batch_size, 1, -1)  # eg: [100, 1, 24]
-                chunk_j = chunk_j.view(batch_size, 1, -1)  # eg: [100, 1, 24]
-                merged = torch.cat([chunk_i, chunk_j], -1) # eg: [100, 1, 48]
-                rn_buffer.append(merged)
+        # squeeze, reduce over the concatenations and project
+        rbo = self.rn(rn_buffer).squeeze(2) # eg: [100, 81, 128], does batch-matmul
+        rn_output = torch.sum(rbo, 1) # eg: [100, 128]
+        return self.proj(rn_output) # eg: [100, 2]
 
-        # aggregate the buffer
-        rn_buffer = torch.cat(rn_buffer, 1)
 
-        # expand the second to last dimension
-        rn_buffer = expand_dims(rn_buffer, 2) # eg: [100, 81, 1, 48]
+class StreamingRelationalNetwork(nn.Module):
+    ''' relation network f(sum_{i,j} g([f_i, f_j])) whose memory stays linear
+        in the number of features F instead of quadratic.
+
+        The first layer of g is split into W_i f_i + W_j f_j and the pairs are
+        streamed a (rows x columns) block of about pair_chunk_size pairs at a
+        time: each block projects its own rows / columns, runs g and is summed
+        into the [B, H] output. LayerNorm replaces the per-pair BatchNorm2d
+        since it needs no statistics across pairs, which makes the blocks safe
+        to recompute, so when training each block is checkpointed.
+
+        Memory: the backward pass keeps the [B, F, C] features and one [B, H]
+        partial sum per block, the peak adds the activations of a single
+        block, ie: O(B * (F * C + num_blocks * H + pair_chunk_size * H)).
+        Nothing of size F * H or F * F is ever kept. '''
+    def __init__(self, input_channels, hidden_size, output_size,
+                 cuda=False, ngpu=1, pair_chunk_size=1024):
+        super(StreamingRelationalNetwork, self).__init__()
+        self.use_cuda = cuda
+        self.ngpu = ngpu  # the owning encoder is the one wrapped in DataParallel
+        self.input_channels = input_channels
+        self.hidden_size = hidden_size
+        self.output_size = output_size
+        self.pair_chunk_size = pair_chunk_size
 
-        # generate the relational network lazily
-        self._lazy_generate_rn(input_size=rn_buffer.size(-1),
-                               latent_size=rn_buffer.size(1),  # for BN [uses 2d BN over channels]
-                               output_size=self.hidden_size)
+        self.pair_proj_i = nn.Linear(input_channels, hidden_size)
+        self.pair_proj_j = nn.Linear(input_channels, hidden_size, bias=False)
+        self.rn = nn.Sequential(
+            nn.LayerNorm(hidden_size),
+            nn.ReLU(),
+            nn.Linear(hidden_size, hidden_size),
+            nn.LayerNorm(hidden_size),
+            nn.ReLU(),
+            nn.Linear(hidden_size, hidden_size),
+            nn.ReLU()
+        )
+        self.proj = nn.Sequential(
+            nn.Linear(hidden_size, hidden_size),
+            nn.LayerNorm(hidden_size),
+            nn.ReLU(),
+            nn.Linear(hidden_size, output_size)
+        )
+
+        if self.use_cuda:
+            self.cuda()
+
+    def _reduce_block(self, rows, cols):
+        ''' g over the pairs of the feature blocks rows [B, r, C]
+            and cols [B, c, C], summed to [B, H] '''
+        pairs = self.pair_proj_i(rows).unsqueeze(2) \
+                + self.pair_proj_j(cols).unsqueeze(1) # eg: [100, r, c, 512]
+        return torch.sum(self.rn(pairs), dim=(1, 2))
+
+    def forward(self, conv_output):
+        batch_size, conv_chan_size = conv_output.size(0), conv_output.size(1)
+        features = conv_output.view(batch_size, conv_chan_size, -1).transpose(1, 2) # eg: [100, 81, 24]
+        num_feat = features.size(1)
+
+        cols_per_block = min(num_feat, self.pair_chunk_size)
+        rows_per_block = max(1, self.pair_chunk_size // cols_per_block)
+        recompute = self.training and torch.is_grad_enabled()
+        rn_output = None
+        for row in range(0, num_feat, rows_per_block):
+            rows = features[:, row:row + rows_per_block]
+            for col in range(0, num_feat, cols_per_block):
+                cols = features[:, col:col + cols_per_block]
+                if recompute:
+                    rbo = checkpoint(self._reduce_block, rows, cols, use_reentrant=False)
+                else:
+                    rbo = self._reduce_block(rows, cols)
+
+                rn_output = rbo if rn_output is None else rn_output + rbo
 
-        # squeeze, reduce over the concatenations and project
-        rbo = torch.squeeze(self.rn(rn_buffer)) # eg: [100, 81, 128], does batch-matmul
-        rn_output = torch.sum(rbo, 1) # eg: [100, 128]
         return self.proj(rn_output) # eg: [100, 2]
@@ -8,58 +8,119 @@ import torch.nn.functional as F
 from torch.autograd import Variable
 
 from helpers.utils import float_type, ones_like
-from models.gumbel import GumbelSoftmax
-from models.isotropic_gaussian import IsotropicGaussian
+from models.reparameterizers import divergences
+from models.reparameterizers.gumbel import GumbelSoftmax
+from models.reparameterizers.isotropic_gaussian import IsotropicGaussian
 
 
 class ConcatReparameterizer(nn.Module):
-    ''' takes multiple reparameterizers and concats them to return
-        a list of reparam(f(x)) for each reparam in the list'''
+    ''' packs multiple reparameterizers (heads) into one: the logits hold
+        every head's segment back to back and z concatenates the samples of
+        the heads in the same order (out-of-place, so it works under vmap).
+
+        The params are {'z': z, 'heads': [params of each head]} and the
+        first head of every kind (eg: 'gaussian', 'discrete') is also
+        exposed at the top level, as a single reparameterizer would. '''
     def __init__(self, reparameterizer_list, config):
         super(ConcatReparameterizer, self).__init__()
         assert isinstance(reparameterizer_list, list)
         self.config = config
-        self.reparmeterizers = reparameterizer_list
+        self.reparameterizers = nn.ModuleList(reparameterizer_list)
 
-        # tabulate the input and output sizes
-        self.input_size, self.output_size = 0, 0
+        # tabulate the input and output segments
+        self.input_offsets, self.output_offsets = [0], [0]
         for reparameterizer in reparameterizer_list:
-            self.input_size += reparameterizer.input_size
-            self.output_size += reparameterizer.output_size
-
-    def prior(self, batch_size):
-        return [reparameterizer.prior(batch_size)
-                for reparameterizer in self.reparmeterizers]
-
-    def mutual_info(self, params_list):
-        assert isinstance(params_list, list)
-        mut_info_list = []
-        current_params = 0
-        for reparameterizer in self.reparmeterizers:
-            if isinstance(reparameterizer, GumbelSoftmax):
-                mut_info_list.append(reparameterizer.mutual_info(params_list[current_params]))
-                current_params += 1
-
-        return mut_info_list
-
-    def log_likelihood(self, z_list, params_list):
-        assert len(z_list) == len(params_list) == len(self.reparmeterizers)
-        return [reparameterizer.log_likelihood(z_i, param_i)
-                for reparameterizer, z_i, param_i in zip(self.reparmeterizers, z_list, params_list)]
-
-    def reparmeterize(self, logits_list):
-        assert len(logits_list) == len(self.reparmeterizers)
-        ret_dict = {}
-        for i, (reparameterizer, logits) in enumerate(zip(self.reparmeterizers, logits_list)):
-            z, params = reparameterizer(logits)
-            ret_dict['z_%d'%i] = z
-            ret_dict['params_%d'%i] = params
-
-        return ret_dict
-
-    def kl(self, dist_a_list):
-        return [reparameterizer.kl(dist_a_i)
-                for reparameterizer, dist_a_i in zip(self.reparmeterizers, dist_a_list)]
-
-    def forward(self, logits_list):
-        return self.reparmeterize(logits_list)
+            self.input_offsets.append(self.input_offsets[-1] + reparameterizer.input_size)
+            self.output_offsets.append(self.output_offsets[-1] + reparameterizer.output_size)
+
+        self.input_size = self.input_offsets[-1]
+        self.output_size = self.output_offsets[-1]
+
+        # heads whose KL can be computed on the concatenated params of their kind
+        self.gaussian_heads = [i for i, r in enumerate(reparameterizer_list)
+                               if type(r).kl is IsotropicGaussian.kl]
+        self.discrete_heads = [i for i, r in enumerate(reparameterizer_list)
+                               if type(r).kl is GumbelSoftmax.kl]
+        self.other_heads = [i for i in range(len(reparameterizer_list))
+                            if i not in self.gaussian_heads + self.discrete_heads]
+        self._log_num_categories = {}
+
+    def _input_segment(self, logits, i):
+        return logits[:, self.input_offsets[i]:self.input_offsets[i+1]]
+
+    def _output_segment(self, z, i):
+        return z[:, self.output_offsets[i]:self.output_offsets[i+1]]
+
+    @staticmethod
+    def _head_params(params, i):
+        ''' the params of the i-th head, along with its Q(z|\\hat{x}) if present '''
+        head_params = params['heads'][i]
+        if 'q_z_given_xhat' in params:
+            head_params = dict(head_params)
+            head_params['q_z_given_xhat'] = params['q_z_given_xhat']['heads'][i]
+
+        return head_params
+
+    def prior(self, batch_size, **kwargs):
+        return torch.cat([reparameterizer.prior(batch_size, **kwargs)
+                          for reparameterizer in self.reparameterizers], -1)
+
+    def mutual_info(self, params):
+        ''' returns the list of mutual infos of the discrete heads '''
+        return [reparameterizer.mutual_info(self._head_params(params, i))
+                for i, reparameterizer in enumerate(self.reparameterizers)
+                if isinstance(reparameterizer, GumbelSoftmax)]
+
+    def log_likelihood(self, z, params):
+        return torch.cat([reparameterizer.log_likelihood(self._output_segment(z, i),
+                                                         params['heads'][i])
+                          for i, reparameterizer in enumerate(self.reparameterizers)], 1)
+
+    def reparmeterize(self, logits):
+        assert logits.size(-1) == self.input_size, \
+            "expected {} logits, got {}".format(self.input_size, logits.size(-1))
+        z, params = [], {'heads': []}
+        for i, reparameterizer in enumerate(self.reparameterizers):
+            z_i, params_i = reparameterizer(self._input_segment(logits, i))
+            z.append(z_i)
+            params['heads'].append(params_i)
+            for k, v in params_i.items():
+                if k != 'z' and k not in params:
+                    params[k] = v
+
+        params['z'] = torch.cat(z, -1)
+        return params['z'], params
+
+    def _log_num_categories_like(self, log_q_z, sizes):
+        ''' per-column log K of the concatenated discrete heads, cached per layout '''
+        key = (tuple(sizes), log_q_z.device, log_q_z.dtype)
+        if key not in self._log_num_categories:
+            self._log_num_categories[key] = log_q_z.new_tensor(
+                np.repeat(np.log(sizes), sizes)
+            )
+
+        return self._log_num_categories[key]
+
+    def kl(self, dist_a):
+        ''' KL of every head in one pass: the elementwise terms are computed
+            once per kind on the concatenated params of its heads and all the
+            terms are reduced together into a single [B] tensor '''
+        heads, terms = dist_a['heads'], []
+        if self.gaussian_heads:
+            mu = torch.cat([heads[i]['gaussian']['mu'] for i in self.gaussian_heads], -1)
+            logvar = torch.cat([heads[i]['gaussian']['logvar'] for i in self.gaussian_heads], -1)
+            terms.append(divergences.kl_gaussian_standard_normal(mu, logvar))
+
+        if self.discrete_heads:
+            log_q_z = [heads[i]['discrete']['log_q_z'] for i in self.discrete_heads]
+            sizes = [l.size(-1) for l in log_q_z]
+            log_q_z = torch.cat(log_q_z, -1)
+            terms.append(log_q_z.exp() * (log_q_z + self._log_num_categories_like(log_q_z, sizes)))
+
+        for i in self.other_heads:
+            terms.append(self.reparameterizers[i].kl(heads[i]).unsqueeze(-1))
+
+        return torch.sum(torch.cat(terms, -1), -1)
+
+    def forward(self, logits):
+        return self.reparmeterize(logits)
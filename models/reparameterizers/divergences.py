@@ -0,0 +1,64 @@
+from __future__ import print_function
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+''' Closed-form KL / entropy / cross-entropy kernels shared by the
+    reparameterizers and the student-teacher regularizers. They follow the
+    same formulas as torch.distributions (and therefore have the same
+    gradients) without building distribution objects or constant tensors.
+
+    NB: as in the rest of the code-base the gaussian 'logvar' parameter
+    is used as the scale of the normal. '''
+
+
+def kl_gaussian_gaussian(mu0, scale0, mu1, scale1):
+    ''' elementwise KL(N(mu0, scale0) || N(mu1, scale1)) '''
+    var_ratio = (scale0 / scale1).pow(2)
+    t1 = ((mu0 - mu1) / scale1).pow(2)
+    return 0.5 * (var_ratio + t1 - 1 - var_ratio.log())
+
+
+def kl_gaussian_standard_normal(mu, scale):
+    ''' elementwise KL(N(mu, scale) || N(0, 1)) '''
+    var = scale.pow(2)
+    return 0.5 * (var + mu.pow(2) - 1 - var.log())
+
+
+def categorical_entropy(logits):
+    ''' H[Cat(logits)] reduced over the last dim '''
+    log_p = F.log_softmax(logits, dim=-1)
+    return -torch.sum(log_p.exp() * log_p, dim=-1)
+
+
+def categorical_cross_entropy(logits, targets):
+    ''' -log Cat(targets | logits) for integer targets, per sample '''
+    return F.cross_entropy(input=logits, target=targets, reduction='none')
+
+
+def kl_categorical_uniform(log_q_z):
+    ''' elementwise KL(q || U) given log q (the last dim is the category) '''
+    log_p_z = -np.log(log_q_z.size(-1))
+    return log_q_z.exp() * (log_q_z - log_p_z)
+
+
+def kl_categorical_categorical(logits_a, logits_b):
+    ''' KL(Cat(logits_a) || Cat(logits_b)) reduced over the last dim.
+
+        When the categoricals differ in size the smaller log-softmax is
+        treated as zero padded (as done by zero_pad_smaller_cat), but the
+        padded tensors are never materialized. '''
+    log_a = F.log_softmax(logits_a, dim=-1)
+    log_b = F.log_softmax(logits_b, dim=-1)
+    p_a = log_a.exp()
+    size_a, size_b = log_a.size(-1), log_b.size(-1)
+    if size_a == size_b:
+        return torch.sum(p_a * (log_a - log_b), dim=-1)
+    elif size_a > size_b:
+        # the padded log-probs of b are 0
+        shared = torch.sum(p_a[..., 0:size_b] * (log_a[..., 0:size_b] - log_b), dim=-1)
+        return shared + torch.sum(p_a[..., size_b:] * log_a[..., size_b:], dim=-1)
+
+    # the padded probs of a are 0
+    return torch.sum(p_a * (log_a - log_b[..., 0:size_a]), dim=-1)
@@ -8,6 +8,8 @@ import torch.distributions as D
 from torch.autograd import Variable
 
 from helpers.utils import float_type, long_type, one_hot, ones_like, zeros_like, uniform
+from models.reparameterizers import divergences
+from models.reparameterizers.noise_pool import NoisePool
 
 
 class GumbelSoftmax(nn.Module):
@@ -18,6 +20,9 @@ class GumbelSoftmax(nn.Module):
         self.config = config
         self.input_size = self.config['discrete_size']
         self.output_size = self.config['discrete_size']
+        self.noise_pool = NoisePool('uniform',
+                                    num_steps=self.config['noise_pool_steps'],
+                                    cuda=self.config['cuda'])
 
     def _soft_prior(self, batch_size):
         unif = uniform([batch_size, self.output_size],
@@ -36,6 +41,12 @@ class GumbelSoftmax(nn.Module):
             one_hot(self.output_size, sample, use_cuda=self.config['cuda'])
         ).type(float_type(self.config['cuda']))
 
+    def prior_indices(self, batch_size, **kwargs):
+        ''' samples the (uniform) prior as category indices instead of one-hots;
+            returns (None, indices) as there are no dense latents '''
+        device = torch.device('cuda' if self.config['cuda'] else 'cpu')
+        return None, torch.randint(0, self.output_size, (batch_size,), device=device)
+
     def _setup_anneal_params(self):
         # setup the base gumbel rates
         # TODO: parameterize this
@@ -56,11 +67,17 @@ class GumbelSoftmax(nn.Module):
             # hard annealing
             # self.tau = np.maximum(0.9 * self.tau, self.min_temp)
 
+    def advance_schedule(self):
+        ''' advances the anneal schedule exactly as a forward call would '''
+        self.anneal()
+        self.iteration += 1
+
     def reparmeterize(self, logits):
         log_q_z = F.log_softmax(logits, dim=-1)
         z, z_hard = self.sample_gumbel(logits, self.tau,
                                        hard=True,
-                                       use_cuda=self.config['cuda'])
+                                       use_cuda=self.config['cuda'],
+                                       noise=self.noise_pool.draw(logits.size(), like=logits))
         return z, z_hard, log_q_z
 
     @staticmethod
@@ -75,9 +92,9 @@ class GumbelSoftmax(nn.Module):
         #     params['discrete']['logits'], -1
         # ).type(long_type(self.config['cuda']))
         # targets = torch.argmax(params['discrete']['log_q_z'], -1) # 3rd change, havent tried
-        crossent_loss = -F.cross_entropy(input=params['q_z_given_xhat']['discrete']['logits'],
-                                         target=targets, reduce=False)
-        ent_loss = -torch.sum(D.OneHotCategorical(logits=params['discrete']['z_hard']).entropy(), -1)
+        crossent_loss = -divergences.categorical_cross_entropy(params['q_z_given_xhat']['discrete']['logits'],
+                                                               targets)
+        ent_loss = -torch.sum(divergences.categorical_entropy(params['discrete']['z_hard']), -1)
         return ent_loss + crossent_loss
 
     # def mutual_info_analytic(self, params, eps=1e-9):
@@ -108,11 +125,7 @@ class GumbelSoftmax(nn.Module):
 
     @staticmethod
     def _kld_categorical_uniform(log_q_z, eps=1e-9):
-        latent_size = log_q_z.size(-1)
-        p_z = 1.0 / latent_size
-        log_p_z = np.log(p_z)
-        kld_element = log_q_z.exp() * (log_q_z - log_p_z)
-        return kld_element
+        return divergences.kl_categorical_uniform(log_q_z)
 
 
     def kl(self, dist_a):
@@ -121,29 +134,30 @@ class GumbelSoftmax(nn.Module):
         ), dim=-1)
 
     @staticmethod
-    def _gumbel_softmax(x, tau, eps=1e-9, use_cuda=False):
-        noise = torch.rand(x.size())
+    def _gumbel_softmax(x, tau, eps=1e-9, use_cuda=False, noise=None):
+        ''' noise is an optional (device-resident) U(0, 1) sample
+            of x's size, it is transformed in place '''
+        if noise is None:
+            noise = torch.rand(x.size())
+            if use_cuda:
+                noise = noise.cuda()
+
         # -ln(-ln(U + eps) + eps)
         noise.add_(eps).log_().neg_()
         noise.add_(eps).log_().neg_()
-        if use_cuda:
-            noise = noise.cuda()
 
-        noise = Variable(noise)
         x = (x + noise) / tau
         x = F.softmax(x.view(x.size(0), -1) + eps, dim=-1)
         return x.view_as(x)
 
     @staticmethod
-    def sample_gumbel(x, tau, hard=False, use_cuda=True):
-        y = GumbelSoftmax._gumbel_softmax(x, tau, use_cuda=use_cuda)
+    def sample_gumbel(x, tau, hard=False, use_cuda=True, noise=None):
+        y = GumbelSoftmax._gumbel_softmax(x, tau, use_cuda=use_cuda, noise=noise)
 
         if hard:
             y_max, _ = torch.max(y, dim=y.dim() - 1,
                                  keepdim=True)
-            y_hard = Variable(
-                torch.eq(y_max.data, y.data).type(float_type(use_cuda))
-            )
+            y_hard = torch.eq(y_max, y).type(float_type(use_cuda)).detach()
             y_hard_diff = y_hard - y
             y_hard = y_hard_diff.detach() + y
             return y.view_as(x), y_hard.view_as(x)
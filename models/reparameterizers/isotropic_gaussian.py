@@ -7,6 +7,8 @@ import torch.nn.functional as F
 from torch.autograd import Variable
 
 from helpers.utils import float_type, zeros_like, ones_like
+from models.reparameterizers import divergences
+from models.reparameterizers.noise_pool import NoisePool
 
 
 class IsotropicGaussian(nn.Module):
@@ -17,18 +19,19 @@ class IsotropicGaussian(nn.Module):
         self.input_size = self.config['continuous_size']
         assert self.config['continuous_size'] % 2 == 0
         self.output_size = self.config['continuous_size'] // 2
+        self.noise_pool = NoisePool('normal',
+                                    num_steps=self.config['noise_pool_steps'],
+                                    cuda=self.config['cuda'])
 
     def prior(self, batch_size, **kwargs):
         scale_var = 1.0 if 'scale_var' not in kwargs else kwargs['scale_var']
-        return Variable(
-            float_type(self.config['cuda'])(batch_size, self.output_size).normal_(mean=0, std=scale_var)
-        )
+        z = self.noise_pool.draw((batch_size, self.output_size))
+        return z * scale_var if scale_var != 1.0 else z
 
     def _reparametrize_gaussian(self, mu, logvar):
         if self.training:
             std = logvar.mul(0.5).exp_()
-            eps = float_type(self.config['cuda'])(std.size()).normal_()
-            eps = Variable(eps)
+            eps = self.noise_pool.draw(std.size(), like=std)
             z = eps.mul(std).add_(mu)
             return z, {'z': z, 'mu': mu, 'logvar': logvar}
 
@@ -66,11 +69,13 @@ class IsotropicGaussian(nn.Module):
 
     def mutual_info_analytic(self, params, eps=1e-9):
         # I(z_d; x) ~ H(z_prior, z_d) + H(z_prior)
-        z_true = D.Normal(params['gaussian']['mu'],
-                          params['gaussian']['logvar'])
-        z_match = D.Normal(params['q_z_given_xhat']['gaussian']['mu'],
-                           params['q_z_given_xhat']['gaussian']['logvar'])
-        kl_proxy_to_xent = torch.sum(D.kl_divergence(z_match, z_true), dim=-1)
+        # KL(z_match || z_true)
+        kl_proxy_to_xent = torch.sum(divergences.kl_gaussian_gaussian(
+            params['q_z_given_xhat']['gaussian']['mu'],
+            params['q_z_given_xhat']['gaussian']['logvar'],
+            params['gaussian']['mu'],
+            params['gaussian']['logvar']
+        ), dim=-1)
         return  kl_proxy_to_xent
 
     # def mutual_info_analytic(self, params, eps=1e-9):
@@ -87,9 +92,7 @@ class IsotropicGaussian(nn.Module):
 
     @staticmethod
     def _kld_gaussian_N_0_1(mu, logvar):
-        standard_normal = D.Normal(zeros_like(mu), ones_like(logvar))
-        normal = D.Normal(mu, logvar)
-        return torch.sum(D.kl_divergence(normal, standard_normal), -1)
+        return torch.sum(divergences.kl_gaussian_standard_normal(mu, logvar), -1)
         # return -0.5 * torch.sum(1 + logvar - mu.pow(2) - logvar.exp(), -1)
 
     def kl(self, dist_a):
@@ -0,0 +1,90 @@
+from __future__ import print_function
+import threading
+import numpy as np
+import torch
+
+
+def is_functorch_wrapped(tensor):
+    ''' True if tensor is wrapped by a torch.func transform (vmap / grad) '''
+    try:
+        return torch._C._functorch.is_functorch_wrapped_tensor(tensor)
+    except AttributeError: # torch without functorch
+        return False
+
+
+class NoisePool(object):
+    ''' Device-resident pool of uniform or normal noise that is drawn ahead
+        of time (num_steps draws at once) by a dedicated torch.Generator.
+
+        Draws are handed out as views into the current block. A block is
+        never refilled in place, since a view may still be saved for the
+        backward pass; once exhausted a new block is drawn instead.
+
+        When seed is None it is drawn from the global RNG, so seeding torch
+        makes every pool (and thus every model) reproducible.
+
+        Under a torch.func transform (eg: the vmapped per-sample grads of
+        the fisher) or when grads are disabled the pool is bypassed and the
+        noise is drawn out-of-place, so every vmapped sample gets its own. '''
+    def __init__(self, distribution, num_steps=16, cuda=False, seed=None):
+        assert distribution in ['uniform', 'normal'], \
+            "unknown noise distribution {}".format(distribution)
+        self.distribution = distribution
+        self.num_steps = max(num_steps, 1)
+        self.device = torch.device('cuda' if cuda else 'cpu')
+        if seed is None:
+            seed = int(torch.randint(0, 2**62, (1,)).item())
+
+        self.generator = torch.Generator(device=self.device)
+        self.generator.manual_seed(seed)
+        self.block, self.offset = None, 0
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        ''' generators and locks can't be copied, keep the RNG state instead '''
+        state = self.__dict__.copy()
+        state['generator'] = self.generator.get_state()
+        state['block'], state['offset'] = None, 0
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        generator_state = state.pop('generator')
+        self.__dict__.update(state)
+        self.generator = torch.Generator(device=self.device)
+        self.generator.set_state(generator_state)
+        self.lock = threading.Lock()
+
+    def _draw_block(self, numel):
+        block = torch.empty(numel * self.num_steps, device=self.device)
+        if self.distribution == 'uniform':
+            block.uniform_(generator=self.generator)
+        else:
+            block.normal_(generator=self.generator)
+
+        self.block, self.offset = block, 0
+
+    def _draw_out_of_place(self, size, like=None):
+        if like is not None and tuple(like.size()) == tuple(size):
+            return torch.rand_like(like) if self.distribution == 'uniform' \
+                else torch.randn_like(like)
+
+        draw_fn = torch.rand if self.distribution == 'uniform' else torch.randn
+        return draw_fn(*size, device=self.device)
+
+    def draw(self, size, like=None):
+        ''' returns a fresh tensor of noise of the given size; like is the
+            tensor the noise is combined with, used to detect transforms '''
+        if not torch.is_grad_enabled() \
+           or (like is not None and is_functorch_wrapped(like)):
+            return self._draw_out_of_place(size, like)
+
+        numel = int(np.prod(size))
+        with self.lock:
+            if self.block is None or self.offset + numel > self.block.numel():
+                self._draw_block(numel)
+
+            sample = self.block[self.offset:self.offset + numel].view(*size)
+            self.offset += numel
+
+        return sample
@@ -0,0 +1,148 @@
+from __future__ import print_function
+import threading
+import numpy as np
+import torch
+
+from helpers.utils import float_type
+
+
+class TeacherReplayBuffer(object):
+    ''' Fixed-capacity ring of teacher samples that is filled by a
+        background thread so that generation overlaps the student's
+        forward / backward pass.
+
+        generate_fn(n) must return n samples of shape sample_shape.
+        refresh_policy decides which slots are evicted once the ring is full:
+            fifo   : overwrite the oldest samples
+            random : overwrite uniformly random slots
+        reuse is the (expected) number of times a sample is drawn before
+        the worker refreshes it; a new chunk of generation_batch_size
+        samples is produced every generation_batch_size * reuse draws. '''
+    def __init__(self, generate_fn, capacity, sample_shape,
+                 generation_batch_size=None, refresh_policy='fifo',
+                 reuse=1.0, cuda=False):
+        assert refresh_policy in ['fifo', 'random'], \
+            "unknown replay refresh policy {}".format(refresh_policy)
+        self.generate_fn = generate_fn
+        self.capacity = capacity
+        self.sample_shape = sample_shape
+        self.generation_batch_size = min(generation_batch_size or capacity, capacity)
+        self.refresh_policy = refresh_policy
+        self.reuse = reuse
+        self.cuda = cuda
+
+        # the ring and its bookkeeping, all guarded by the condition
+        self.ring = float_type(cuda)(capacity, *sample_shape).zero_()
+        self.num_filled = 0
+        self.write_index = 0
+        self.num_drawn = 0
+        self.cv = threading.Condition()
+        self.worker = None
+        self.stop_event = threading.Event()
+        self.worker_exception = None
+
+    def __deepcopy__(self, memo):
+        ''' threads and locks can't be copied, return a fresh (stopped) buffer '''
+        return TeacherReplayBuffer(self.generate_fn, self.capacity, self.sample_shape,
+                                   generation_batch_size=self.generation_batch_size,
+                                   refresh_policy=self.refresh_policy,
+                                   reuse=self.reuse, cuda=self.cuda)
+
+    def start(self):
+        ''' spawn the background generation thread '''
+        if self.worker is None:
+            self.stop_event.clear()
+            self.worker = threading.Thread(target=self._worker_loop, daemon=True)
+            self.worker.start()
+
+    def stop(self):
+        ''' stop the background thread and wait for it to finish '''
+        if self.worker is not None:
+            self.stop_event.set()
+            with self.cv:
+                self.cv.notify_all()
+
+            self.worker.join()
+            self.worker = None
+
+    def _needs_refresh(self):
+        if self.num_filled < self.capacity:
+            return True
+
+        return self.num_drawn >= self.generation_batch_size * self.reuse
+
+    def _write(self, samples):
+        ''' writes a chunk of samples into the ring, must hold the lock '''
+        num_samples = samples.size(0)
+        if self.num_filled < self.capacity or self.refresh_policy == 'fifo':
+            indices = (np.arange(num_samples) + self.write_index) % self.capacity
+            self.write_index = (self.write_index + num_samples) % self.capacity
+        else:
+            indices = np.random.choice(self.capacity, size=num_samples, replace=False)
+
+        indices = torch.from_numpy(indices).type(torch.LongTensor)
+        if self.cuda:
+            indices = indices.cuda()
+
+        self.ring.index_copy_(0, indices, samples)
+        self.num_filled = min(self.num_filled + num_samples, self.capacity)
+        self.num_drawn = max(self.num_drawn - int(num_samples * self.reuse), 0)
+
+    def _generate(self):
+        with torch.no_grad():
+            return self.generate_fn(self.generation_batch_size).detach() \
+                                                               .contiguous() \
+                                                               .view(-1, *self.sample_shape)
+
+    def _worker_loop(self):
+        # use a side stream so that generation overlaps the main stream
+        stream = torch.cuda.Stream() if self.cuda else None
+        try:
+            while not self.stop_event.is_set():
+                with self.cv:
+                    while not self._needs_refresh() and not self.stop_event.is_set():
+                        self.cv.wait()
+
+                if self.stop_event.is_set():
+                    break
+
+                if stream is not None:
+                    with torch.cuda.stream(stream):
+                        samples = self._generate()
+
+                    stream.synchronize()
+                else:
+                    samples = self._generate()
+
+                with self.cv:
+                    self._write(samples)
+                    self.cv.notify_all()
+
+        except Exception as e: # surface the exception in the consumer thread
+            with self.cv:
+                self.worker_exception = e
+                self.cv.notify_all()
+
+    def sample(self, num_samples):
+        ''' draws num_samples from the ring; blocks until enough are available '''
+        assert num_samples <= self.capacity, \
+            "requested {} samples from a ring of size {}".format(num_samples, self.capacity)
+        if self.worker is None:
+            self.start()
+
+        with self.cv:
+            while self.num_filled < num_samples and self.worker_exception is None:
+                self.cv.wait()
+
+            if self.worker_exception is not None:
+                raise self.worker_exception
+
+            indices = torch.randperm(self.num_filled)[0:num_samples]
+            if self.cuda:
+                indices = indices.cuda()
+
+            samples = self.ring.index_select(0, indices)
+            self.num_drawn += num_samples
+            self.cv.notify_all()
+
+        return samples
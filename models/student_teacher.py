@@ -1,5 +1,6 @@
 from __future__ import print_function
 import os
+import json
 import torch
 import numpy as np
 import torch.nn as nn
@@ -11,9 +12,14 @@ from copy import deepcopy
 from helpers.distributions import nll
 from helpers.utils import expand_dims, long_type, squeeze_expand_dim, \
     ones_like, float_type, pad, inv_perm, one_hot_np, \
-    zero_pad_smaller_cat, check_or_create_dir
+    check_or_create_dir
 from models.vae.parallelly_reparameterized_vae import ParallellyReparameterizedVAE
 from models.vae.sequentially_reparameterized_vae import SequentiallyReparameterizedVAE
+from models.replay_buffer import TeacherReplayBuffer
+from models.reparameterizers.gumbel import GumbelSoftmax
+from models.loss_planner import LossGraphPlanner
+from models.reparameterizers import divergences
+from models.compact import compact_model
 
 
 def detach_from_graph(param_map):
@@ -24,51 +30,31 @@ def detach_from_graph(param_map):
             v = v.detach_()
 
 
-def kl_categorical_categorical(dist_a, dist_b, rnd_perm, from_index=0):
-    # invert the shuffle for the KL calculation
+def _unshuffled_rows(tensor, rnd_perm, from_index=0):
+    ''' inverts the minibatch shuffle and returns the rows from from_index on '''
     if rnd_perm is not None:
-        dist_a_logits, dist_b_logits = [inv_perm(dist_a['logits'], rnd_perm),
-                                        inv_perm(dist_b['logits'], rnd_perm)]
-    else:
-        dist_a_logits, dist_b_logits = dist_a['logits'], dist_b['logits']
+        tensor = inv_perm(tensor, rnd_perm)
 
-    # https://github.com/tensorflow/tensorflow/blob/r1.1/tensorflow/contrib/distributions/python/ops/categorical.py
-    dist_a_log_softmax = F.log_softmax(dist_a_logits[from_index:], dim=-1)
-    dist_a_softmax = F.softmax(dist_a_logits[from_index:], dim=-1)
-    dist_b_log_softmax = F.log_softmax(dist_b_logits[from_index:], dim=-1)
+    return tensor[from_index:]
 
-    # zero pad the smaller categorical
-    dist_a_log_softmax, dist_b_log_softmax \
-        = zero_pad_smaller_cat(dist_a_log_softmax,
-                               dist_b_log_softmax)
-    dist_a_softmax, dist_b_log_softmax \
-        = zero_pad_smaller_cat(dist_a_softmax,
-                               dist_b_log_softmax)
 
-    delta_log_probs1 = dist_a_log_softmax - dist_b_log_softmax
-    return torch.sum(dist_a_softmax * delta_log_probs1, dim=-1)
+def kl_categorical_categorical(dist_a, dist_b, rnd_perm, from_index=0):
+    ''' dist_a is over the (shuffled) minibatch; dist_b, the teacher's,
+        only holds its un-shuffled rows from from_index on '''
+    # the smaller categorical is (virtually) zero padded
+    return divergences.kl_categorical_categorical(
+        _unshuffled_rows(dist_a['logits'], rnd_perm, from_index),
+        dist_b['logits']
+    )
 
 
 def kl_isotropic_gauss_gauss(dist_a, dist_b, rnd_perm, from_index=0):
-    if rnd_perm is not None:
-        mu0, logvar0 = [inv_perm(dist_a['mu'], rnd_perm)[from_index:],
-                        inv_perm(dist_a['logvar'], rnd_perm)[from_index:]]
-        mu1, logvar1 = [inv_perm(dist_b['mu'], rnd_perm)[from_index:],
-                        inv_perm(dist_b['logvar'], rnd_perm)[from_index:]]
-    else:
-         mu0, logvar0 = dist_a['mu'][from_index:], dist_a['logvar'][from_index:]
-         mu1, logvar1 = dist_b['mu'][from_index:], dist_b['logvar'][from_index:]
-
-    n0 = D.Normal(mu0, logvar0)
-    n1 = D.Normal(mu1, logvar1)
-    return torch.sum(D.kl_divergence(n0, n1), dim=-1)
-
-
-def lazy_generate_modules(model, img_shp, batch_size, cuda):
-    ''' Super hax, but needed for building lazy modules '''
-    model.eval()
-    data = float_type(cuda)(batch_size, *img_shp).normal_()
-    model(Variable(data))
+    ''' dist_a is over the (shuffled) minibatch; dist_b, the teacher's,
+        only holds its un-shuffled rows from from_index on '''
+    mu0, logvar0 = [_unshuffled_rows(dist_a['mu'], rnd_perm, from_index),
+                    _unshuffled_rows(dist_a['logvar'], rnd_perm, from_index)]
+    return torch.sum(divergences.kl_gaussian_gaussian(mu0, logvar0,
+                                                      dist_b['mu'], dist_b['logvar']), dim=-1)
 
 
 class StudentTeacher(nn.Module):
@@ -82,20 +68,47 @@ class StudentTeacher(nn.Module):
         self.rnd_perm = None
         self.num_teacher_samples = None
         self.num_student_samples = None
+        self.replay_buffer = None
+
+        # #real and #synthetic samples trained on in the current task
+        self.num_real_seen, self.num_synthetic_seen = 0, 0
+
+        # per-sample activations of the student's frozen encoder prefix
+        self.prefix_cache, self.prefix_cached, self.prefix_cache_size = None, None, None
 
         # grab the meta config and print for
         self.config = kwargs['kwargs']
 
+        # only build the forward branches the loss needs
+        self.plan = LossGraphPlanner(self.config)
+        print(self.plan)
+
+        # a step must be able to draw its teacher samples from the replay ring
+        if self.config['replay_buffer_size'] > 0:
+            max_teacher_samples = self.config['replay_batch_size'] \
+                or self.config['real_batch_size'] or self.config['batch_size']
+            if max_teacher_samples > self.config['replay_buffer_size']:
+                raise ValueError("a step draws up to {} teacher samples but --replay-buffer-size is {}".format(
+                    max_teacher_samples, self.config['replay_buffer_size']))
+
+    def train(self, mode=True):
+        ''' the teacher is never trained, so keep it in eval mode;
+            this also keeps the replay worker from seeing train-mode BN '''
+        super(StudentTeacher, self).train(mode)
+        if self.teacher is not None:
+            self.teacher.eval()
+
+        return self
+
     def load(self):
         # load the model if it exists
         if os.path.isdir(self.config['model_dir']):
             model_filename = os.path.join(self.config['model_dir'], self.get_name() + ".th")
             if os.path.isfile(model_filename):
                 print("loading existing student-teacher model: {}".format(model_filename))
-                lazy_generate_modules(self, self.student.input_shape,
-                                      self.config['batch_size'],
-                                      self.config['cuda'])
+                self.compact_teacher() # the saved teacher is already compact
                 self.load_state_dict(torch.load(model_filename), strict=True)
+                self.freeze_teacher()
                 return True
             else:
                 print("{} does not exist...".format(model_filename))
@@ -109,6 +122,32 @@ class StudentTeacher(nn.Module):
         if not os.path.isfile(model_filename) or overwrite:
             print("saving existing student-teacher model...")
             torch.save(self.state_dict(), model_filename)
+            self._save_discrete_sizes()
+
+    @staticmethod
+    def discrete_sizes_filename(config):
+        return os.path.join(config['model_dir'], "{}_discrete_sizes.json".format(config['uid']))
+
+    @staticmethod
+    def load_discrete_sizes(config):
+        ''' the {model index: discrete size} map saved with the checkpoints, or {} '''
+        filename = StudentTeacher.discrete_sizes_filename(config)
+        if not os.path.isfile(filename):
+            return {}
+
+        with open(filename, 'r') as f:
+            return {int(k): v for k, v in json.load(f).items()}
+
+    def _save_discrete_sizes(self):
+        ''' pruned forks grow the discrete latent by less than discrete_size,
+            so the size of every saved model index is kept for resuming '''
+        sizes = self.load_discrete_sizes(self.config)
+        sizes[self.current_model] = self.student.config['discrete_size']
+        if self.teacher is not None:
+            sizes[self.current_model - 1] = self.teacher.config['discrete_size']
+
+        with open(self.discrete_sizes_filename(self.config), 'w') as f:
+            json.dump({str(k): v for k, v in sorted(sizes.items())}, f)
 
     def get_name(self):
         return "{}{}_cg{}_s{}{}".format(
@@ -162,13 +201,11 @@ class StudentTeacher(nn.Module):
         return posterior_fn_map[self.config['vae_type']](q_z_given_x_t, q_z_given_x_s)
 
     def likelihood_regularizer(self, p_x_given_z_t_activated, p_x_given_z_s_logits):
-        if self.rnd_perm is not None:
-            p_x_given_z_s_logits = inv_perm(p_x_given_z_s_logits, self.rnd_perm)
-            p_x_given_z_t_activated = inv_perm(p_x_given_z_t_activated, self.rnd_perm)
-
+        ''' the teacher's reconstructions only hold the synthetic rows '''
         img_unrolled = int(np.prod(self.config['img_shp']))
-        p_x_given_z_s_logits = p_x_given_z_s_logits[self.num_student_samples:].view(-1, img_unrolled)
-        p_x_given_z_t_activated = p_x_given_z_t_activated[self.num_student_samples:].view(-1, img_unrolled)
+        p_x_given_z_s_logits = _unshuffled_rows(p_x_given_z_s_logits, self.rnd_perm,
+                                                self.num_student_samples).view(-1, img_unrolled)
+        p_x_given_z_t_activated = p_x_given_z_t_activated.view(-1, img_unrolled)
         # return torch.sum(D.kl_divergence(D.Bernoulli(logits=p_x_given_z_s_logits),
         #                                  D.Bernoulli(logits=p_x_given_z_s_logits)), -1)
         return nll(p_x_given_z_t_activated, p_x_given_z_s_logits, self.config['nll_type'])
@@ -188,13 +225,18 @@ class StudentTeacher(nn.Module):
                                         dim=0,
                                         prepend=True)
 
-            # add the likelihood regularizer and multiply it by the const
-            likelihood_regularizer = self.likelihood_regularizer(output_map['teacher']['x_reconstr'],
-                                                                 output_map['student']['x_reconstr_logits'])
-            likelihood_regularizer = pad(likelihood_regularizer,
-                                         diff,
-                                         dim=0,
-                                         prepend=True)
+            # add the likelihood regularizer and multiply it by the const;
+            # the teacher decoder is only run when this is enabled
+            if self.plan['teacher_decoder']:
+                likelihood_regularizer = self.likelihood_regularizer(output_map['teacher']['x_reconstr'],
+                                                                     output_map['student']['x_reconstr_logits'])
+                likelihood_regularizer = pad(likelihood_regularizer,
+                                             diff,
+                                             dim=0,
+                                             prepend=True)
+            else:
+                likelihood_regularizer = torch.zeros_like(posterior_regularizer)
+
             if self.rnd_perm is not None: # re-shuffle
                 posterior_regularizer = posterior_regularizer[self.rnd_perm]
                 likelihood_regularizer = likelihood_regularizer[self.rnd_perm]
@@ -208,33 +250,15 @@ class StudentTeacher(nn.Module):
         return vae_loss
 
     def _ewc(self, fisher_matrix):
-        losses = []
-        assert len(list(self.teacher.named_parameters())) \
-            == len(list(self.student.named_parameters())) \
-            == len(fisher_matrix), "#student params != #teacher params != #fisher params"
-        for (nt, pt), (ns, ps), (nf, fish) in zip(self.teacher.named_parameters(),
-                                                  self.student.named_parameters(),
-                                                  fisher_matrix.items()):
-            # print("f {} * (t {} - s {})".format(nf, nt, ns))
-            # print("f {} * (t {} - s {})".format(fish.size(), pt.size(), ps.size()))
-            # print("f {} * (t {} - s {})".format(fish.type(), pt.type(), ps.type()))
-            if pt.size() != ps.size() != fish.size():
-                raise Exception("""teacher param [{}] does not match student
-                param[{}] does not match fisher info param[{}]""".format(
-                    pt.size(), ps.size(), fish.size()
-                ))
-
-            losses.append(torch.sum(fish * (ps - pt)**2))
-
-        return (self.config['ewc_gamma'] / 2.0) * sum(losses)
-
+        ''' fisher_matrix is the consolidated (flat) EWC state, see models/ewc.py '''
+        return fisher_matrix.penalty(self.student)
 
     def _ewc_loss_function(self, output_map, fisher_matrix):
         ''' returns a combined loss of the VAE loss + EWC '''
         vae_loss = self.student.loss_function(output_map['student']['x_reconstr_logits'],
                                               output_map['augmented']['data'],
                                               output_map['student']['params'])
-        if 'teacher' in output_map and fisher_matrix is not None:
+        if self.teacher is not None and fisher_matrix is not None:
             ewc = self._ewc(fisher_matrix)
             vae_loss['ewc_mean'] = ewc
             vae_loss['loss_mean'] = torch.mean(vae_loss['loss']) + ewc
@@ -248,6 +272,25 @@ class StudentTeacher(nn.Module):
 
         return self._lifelong_loss_function(output_map)
 
+    def compact_teacher(self):
+        ''' converts the frozen teacher to its --compact-teacher form '''
+        if self.teacher is not None and self.config['compact_teacher'] != 'none':
+            self._release_replay_buffer() # the replay worker holds the old teacher
+            self.teacher = compact_model(self.teacher, self.config['compact_teacher'],
+                                         cuda=self.config['cuda'])
+
+        return self.teacher
+
+    def freeze_teacher(self):
+        ''' the teacher is never optimized: drop its grads and
+            stop autograd from tracking its parameters '''
+        if self.teacher is not None:
+            for p in self.teacher.parameters():
+                p.requires_grad = False
+                p.grad = None
+
+            self.teacher.eval()
+
     @staticmethod
     def disable_bn(module):
         for layer in module.children():
@@ -258,29 +301,149 @@ class StudentTeacher(nn.Module):
                 layer.reset_parameters()
 
     @staticmethod
-    def copy_model(src, dest, disable_dst_grads=False, reset_dest_bn=True):
-        src_params = list(src.parameters())
-        dest_params = list(dest.parameters())
-        for i in range(len(src_params)):
-            if src_params[i].size() == dest_params[i].size():
-                dest_params[i].data[:] = src_params[i].data[:].clone()
+    def overlapping_slices(src, dest):
+        ''' returns the slices of the leading block shared by src and dest
+            (eg: the latent-facing layers grow with discrete_size) or
+            None if the tensors can't be aligned '''
+        if src.dim() != dest.dim():
+            return None
+
+        return tuple(slice(0, min(s, d)) for s, d in zip(src.size(), dest.size()))
 
-            if disable_dst_grads:
-                dest_params[i].requires_grad = False
+    @staticmethod
+    def copy_model(src, dest, disable_dst_grads=False, reset_dest_bn=True):
+        ''' copies the src parameters into dest in bulk, grown parameters
+            receive the overlapping slice of the src parameter.
+            Returns a list of (src_param, dest_param, slices) '''
+        src_params = dict(src.named_parameters())
+        param_map, same_src, same_dest = [], [], []
+        with torch.no_grad():
+            for name, dest_param in dest.named_parameters():
+                if disable_dst_grads:
+                    dest_param.requires_grad = False
+
+                src_param = src_params.get(name, None)
+                slices = StudentTeacher.overlapping_slices(src_param, dest_param) \
+                         if src_param is not None else None
+                if slices is None:
+                    continue
+
+                param_map.append((src_param, dest_param, slices))
+                if src_param.size() == dest_param.size():
+                    same_src.append(src_param)
+                    same_dest.append(dest_param)
+                else:
+                    dest_param[slices].copy_(src_param[slices])
+
+            # the unchanged parameters are copied in one grouped call
+            if hasattr(torch, '_foreach_copy_'):
+                torch._foreach_copy_(same_dest, same_src)
+            else:
+                for src_param, dest_param in zip(same_src, same_dest):
+                    dest_param.copy_(src_param)
 
         # reset batch norm layers
         if reset_dest_bn:
             StudentTeacher.disable_bn(dest)
 
-        return [src, dest]
+        return param_map
+
+    def freeze_student_encoder_prefix(self, num_blocks):
+        ''' freezes the student's encoder prefix as a copy of the teacher's:
+            copy_model only transfers parameters and resets batch norms, so
+            the frozen blocks also take the teacher's norm params & buffers
+            (eg: the running stats), they never get to re-estimate them '''
+        num_frozen = self.student.freeze_encoder_prefix(num_blocks)
+        teacher_blocks = self.teacher._encoder_blocks()[0:num_frozen]
+        student_blocks = self.student._encoder_blocks()[0:num_frozen]
+        for teacher_block, student_block in zip(teacher_blocks, student_blocks):
+            student_block.load_state_dict(teacher_block.state_dict())
+
+        return num_frozen
+
+    def category_usage(self, data_loader):
+        ''' histogram of the student's hard posterior categories, argmax of
+            Q(z|x), over every task seen so far: the real samples of the
+            loader and as many teacher (replay) samples per earlier task, as
+            the earlier tasks only reach the student through replay.
+            Returns None if the model has no (parallel) discrete latent or
+            if there is nothing to measure. '''
+        if self.config['vae_type'] != 'parallel' or not self.student.has_discrete():
+            return None
+
+        def _counts(data):
+            _, params = self.student.posterior(data)
+            logits = params['discrete']['logits']
+            return torch.bincount(torch.argmax(logits, dim=-1),
+                                  minlength=logits.size(-1))
+
+        was_training = self.student.training
+        self.student.eval()
+        usage, num_real = None, 0
+        with torch.no_grad():
+            for minibatch in data_loader:
+                data = minibatch[0].cuda() if self.config['cuda'] else minibatch[0]
+                counts = _counts(data)
+                usage = counts if usage is None else usage + counts
+                num_real += data.size(0)
+
+            # the earlier tasks, weighted like the current one
+            num_replay = num_real * self.current_model if self.teacher is not None else 0
+            batch_size = self.config['batch_size']
+            for begin in range(0, num_replay, batch_size):
+                replay = self.generate_synthetic_samples(self.teacher,
+                                                         min(batch_size, num_replay - begin))
+                counts = _counts(replay)
+                usage = counts if usage is None else usage + counts
+
+        self.student.train(was_training)
+        return usage.cpu() if usage is not None else None
+
+    def _dead_categories(self, category_usage):
+        ''' the categories picked for less than dead_category_threshold
+            of the samples (of all the tasks seen so far) '''
+        usage = category_usage.float() / max(category_usage.sum().item(), 1.0)
+        dead = torch.nonzero(usage < self.config['dead_category_threshold']).view(-1)
+        print("category usage: ", np.round(usage.numpy(), 4).tolist())
+        return dead
+
+    def _num_new_categories(self, num_dead):
+        ''' the dead categories are re-initialized and reused by the new
+            student, so the latent only grows by discrete_size minus #dead '''
+        num_new = max(0, self.config['discrete_size'] - num_dead)
+        print("{} categories are dead, growing the discrete latent by {}".format(
+            num_dead, num_new))
+        return num_new
+
+    def fork(self, category_usage=None):
+        ''' moves the student into the teacher role and spawns a new student;
+            returns the (teacher_param, student_param, slices) mapping
+            of the transferred weights.
+
+            category_usage (see category_usage()) caps the growth of the
+            discrete latent when dead-category pruning is enabled and
+            max_discrete_size bounds its total size. '''
+        # the replay samples belong to the old teacher
+        self._release_replay_buffer()
 
-    def fork(self):
         # copy the old student into the teacher
         # dont increase discrete dim for ewc
+        num_new_categories = 0 if self.config['ewc_gamma'] > 0 else self.config['discrete_size']
+        recycled = []
+        if num_new_categories > 0 and category_usage is not None \
+           and self.config['prune_dead_categories']:
+            dead = self._dead_categories(category_usage)
+            recycled = dead[0:self.config['discrete_size']].tolist()
+            num_new_categories = self._num_new_categories(len(recycled))
+
+        # an optional cap on the discrete latent, eg: for unbounded task streams
+        if self.config['max_discrete_size'] is not None:
+            num_new_categories = max(0, min(num_new_categories,
+                                            self.config['max_discrete_size'] - self.student.config['discrete_size']))
+
         config_copy = deepcopy(self.student.config)
-        config_copy['discrete_size'] += 0 if self.config['ewc_gamma'] > 0 else self.config['discrete_size']
-        self.teacher = deepcopy(self.student)
-        del self.student
+        config_copy['discrete_size'] += num_new_categories
+        self.teacher = self.student # the old student is frozen, so no copy is needed
 
         # create a new student
         if self.config['vae_type'] == 'sequential':
@@ -297,30 +460,51 @@ class StudentTeacher(nn.Module):
         else:
             raise Exception("unknown vae type requested")
 
+        # copy teacher params into student, the grown
+        # latent-facing layers receive the overlapping slice
+        param_map = self.copy_model(self.teacher, self.student, disable_dst_grads=False)
+        if recycled: # the dead slots start afresh instead of as copies
+            self.student.reinit_categories(recycled)
+        self.freeze_teacher()
+        if self.config['freeze_encoder_blocks'] > 0:
+            self.freeze_student_encoder_prefix(self.config['freeze_encoder_blocks'])
 
-        # forward pass once to build lazy modules
-        data = float_type(self.config['cuda'])(self.student.config['batch_size'],
-                                               *self.student.input_shape).normal_()
-        self.student(Variable(data))
-
-        # copy teacher params into student while
-        # omitting the projection weights
-        self.teacher, self.student \
-            = self.copy_model(self.teacher, self.student, disable_dst_grads=False)
+        self.reset_encoder_prefix_cache(None) # the cache belongs to the previous task
+        self.compact_teacher()
 
         # update the current model's ratio
         self.current_model += 1
         self.ratio = self.current_model / (self.current_model + 1.0)
-        num_teacher_samples = int(self.config['batch_size'] * self.ratio)
-        num_student_samples = max(self.config['batch_size'] - num_teacher_samples, 1)
+        num_student_samples, num_teacher_samples = self.samples_per_step(
+            self.config['real_batch_size'] or self.config['batch_size']
+        )
         print("#teacher_samples: ", num_teacher_samples,
               " | #student_samples: ", num_student_samples)
+        return param_map
+
+    def reset_sample_counts(self):
+        ''' resets the #real / #synthetic samples seen, called per task '''
+        self.num_real_seen, self.num_synthetic_seen = 0, 0
+
+    def samples_per_step(self, batch_size):
+        ''' returns the (#real, #synthetic) samples of a step for a real minibatch
+            of batch_size. By default the minibatch is split by the ratio; if
+            --real-batch-size or --replay-batch-size are set the real samples
+            are all kept and the current_model synthetic samples per real
+            sample are appended, capped at --replay-batch-size (which
+            defaults to the real minibatch size) '''
+        if self.config['real_batch_size'] is None \
+           and self.config['replay_batch_size'] is None:
+            num_teacher_samples = int(batch_size * self.ratio)
+            return max(batch_size - num_teacher_samples, 1), num_teacher_samples
+
+        max_teacher_samples = self.config['replay_batch_size'] or batch_size
+        return batch_size, min(batch_size * self.current_model, max_teacher_samples)
 
     def generate_synthetic_samples(self, model, batch_size, **kwargs):
-        z_samples = model.reparameterizer.prior(
+        return model.nll_activation(model.generate_from_prior(
             batch_size, scale_var=self.config['generative_scale_var'], **kwargs
-        )
-        return model.nll_activation(model.generate(z_samples))
+        ))
 
     def generate_synthetic_sequential_samples(self, model, num_rows=8):
         assert model.has_discrete()
@@ -335,29 +519,129 @@ class StudentTeacher(nn.Module):
                                                self.config['discrete_size']))])
         discrete_indices = discrete_indices.reshape(-1)
         with torch.no_grad():
+            if getattr(model, 'sparse_decoder', None) is not None:
+                # decode by category index, with the gaussian prior for the mixture
+                indices = torch.from_numpy(discrete_indices).type(long_type(self.config['cuda']))
+                z_gauss = model.reparameterizer.gaussian.prior(indices.size(0)) \
+                    if self.config['reparam_type'] == 'mixture' else None
+                return model.nll_activation(model.decode_sparse(z_gauss, indices))
+
             z_samples = Variable(torch.from_numpy(one_hot_np(model.reparameterizer.config['discrete_size'],
                                                              discrete_indices)))
             z_samples = z_samples.type(float_type(self.config['cuda']))
 
             if self.config['reparam_type'] == 'mixture' and self.config['vae_type'] != 'sequential':
-                ''' add in the gaussian prior '''
+                # add in the gaussian prior
                 z_gauss = model.reparameterizer.gaussian.prior(z_samples.size(0))
                 z_samples = torch.cat([z_gauss, z_samples], dim=-1)
 
             return model.nll_activation(model.generate(z_samples))
 
-    def _augment_data(self, x):
+    def _release_replay_buffer(self):
+        ''' stops the background generation thread (if any) '''
+        if self.replay_buffer is not None:
+            self.replay_buffer.stop()
+            self.replay_buffer = None
+
+    @staticmethod
+    def _generation_snapshot(model):
+        ''' a copy of the (frozen) model for the replay worker: it shares the
+            parameters & buffers but owns its module state, eg: the gumbel
+            tau / iteration, so the worker generates with a snapshot of tau
+            and never mutates modules that the training thread runs '''
+        memo = {id(t): t for t in list(model.parameters()) + list(model.buffers())}
+        return deepcopy(model, memo).eval()
+
+    def _get_replay_buffer(self):
+        ''' lazily spawns the teacher replay buffer; returns None if disabled '''
+        if self.config['replay_buffer_size'] <= 0:
+            return None
+
+        if self.replay_buffer is None:
+            teacher = self._generation_snapshot(self.teacher)
+            self.replay_buffer = TeacherReplayBuffer(
+                lambda n: self.generate_synthetic_samples(teacher, n),
+                capacity=self.config['replay_buffer_size'],
+                sample_shape=self.student.input_shape,
+                generation_batch_size=self.config['replay_generation_batch_size'] \
+                                      or self.config['batch_size'],
+                refresh_policy=self.config['replay_refresh_policy'],
+                reuse=self.config['replay_reuse'],
+                cuda=self.config['cuda'])
+            self.replay_buffer.start()
+
+        return self.replay_buffer
+
+    def reset_encoder_prefix_cache(self, num_samples):
+        ''' drops the cached frozen-prefix activations; the new cache holds
+            num_samples (ie: the train set size) samples, None disables it.
+            A cache larger than encoder_prefix_cache_mb is never allocated. '''
+        self.prefix_cache, self.prefix_cached = None, None
+        self.prefix_cache_size = num_samples
+
+    def _encoder_prefix(self, x, indices):
+        ''' returns the activations of the student's frozen encoder prefix
+            for the real samples x with dataset indices, computing only the
+            ones that are not cached yet; None if there is nothing to cache '''
+        if indices is None or self.prefix_cache_size is None or not self.training \
+           or self.config['vae_type'] != 'parallel' \
+           or self.student.num_frozen_encoder_blocks == 0:
+            return None
+
+        indices = indices.to(x.device)
+        if self.prefix_cache is None:
+            activations = self.student.encode_prefix(x)
+            cache_mb = self.prefix_cache_size * activations[0].numel() \
+                * activations.element_size() / 2**20
+            if cache_mb > self.config['encoder_prefix_cache_mb']:
+                print("encoder prefix cache needs {:.1f}MB > {}MB, recomputing the prefix instead".format(
+                    cache_mb, self.config['encoder_prefix_cache_mb']))
+                self.prefix_cache_size = None
+                return activations
+
+            self.prefix_cache = activations.new_empty((self.prefix_cache_size,) + activations.size()[1:])
+            self.prefix_cached = torch.zeros(self.prefix_cache_size, dtype=torch.bool, device=x.device)
+            self.prefix_cache[indices] = activations
+            self.prefix_cached[indices] = True
+            return activations
+
+        missing = ~self.prefix_cached[indices]
+        if missing.any():
+            self.prefix_cache[indices[missing]] = self.student.encode_prefix(x[missing])
+            self.prefix_cached[indices[missing]] = True
+
+        return self.prefix_cache[indices]
+
+    def _augment_data(self, x, x_prefix=None):
         ''' return batch_size worth of samples that are augmented
-            from the teacher model '''
+            from the teacher model; x_prefix are the optional (cached)
+            frozen encoder prefix activations of x which are merged and
+            shuffled alongside, returns (augmented, augmented_prefix) '''
         if self.ratio == 1.0 or not self.training or self.config['disable_augmentation']:
-            return x   # base case
+            # every row is real: reset the split so that the regularizers
+            # never read the counts / permutation of a previous train step
+            self.num_student_samples, self.num_teacher_samples = x.size(0), 0
+            self.rnd_perm = None
+            self.num_real_seen += x.size(0) if self.training else 0
+            return x, x_prefix   # base case
+
+        self.num_student_samples, self.num_teacher_samples = self.samples_per_step(x.size(0))
+        self.num_real_seen += self.num_student_samples
+        self.num_synthetic_seen += self.num_teacher_samples
+        replay_buffer = self._get_replay_buffer()
+        if replay_buffer is not None:
+            generated_teacher_samples = replay_buffer.sample(self.num_teacher_samples)
+        else:
+            generated_teacher_samples = self.generate_synthetic_samples(self.teacher,
+                                                                        self.num_teacher_samples)
 
-        batch_size = x.size(0)
-        self.num_teacher_samples = int(batch_size * self.ratio)
-        self.num_student_samples = max(batch_size - self.num_teacher_samples, 1)
-        generated_teacher_samples = self.generate_synthetic_samples(self.teacher, batch_size)
         merged =  torch.cat([x[0:self.num_student_samples],
                              generated_teacher_samples[0:self.num_teacher_samples]], 0)
+        if x_prefix is not None:
+            x_prefix = torch.cat([x_prefix[0:self.num_student_samples],
+                                  self.student.encode_prefix(
+                                      generated_teacher_samples[0:self.num_teacher_samples]
+                                  )], 0)
 
         # workaround for batchnorm on multiple GPUs
         # we shuffle the data and unshuffle it later for
@@ -367,22 +651,41 @@ class StudentTeacher(nn.Module):
             if self.config['cuda']:
                 self.rnd_perm = self.rnd_perm.cuda()
 
-            return merged[self.rnd_perm]
+            return merged[self.rnd_perm], \
+                x_prefix[self.rnd_perm] if x_prefix is not None else None
         else:
-            return merged
-
+            return merged, x_prefix
+
+    def _advance_anneal_schedule(self):
+        ''' steps every gumbel of the student as one posterior pass would, so
+            pruning a pass does not slow down the annealing of tau '''
+        for module in self.student.modules():
+            if isinstance(module, GumbelSoftmax):
+                module.advance_schedule()
+
+    def forward(self, x, indices=None):
+        ''' indices are the optional dataset indices of x,
+            used to cache the student's frozen encoder prefix '''
+        x_augmented, prefix_augmented = self._augment_data(x, self._encoder_prefix(x, indices))
+        x_augmented = x_augmented.contiguous()
+        if prefix_augmented is not None:
+            x_recon_student, params_student = self.student(x_augmented,
+                                                           encoder_prefix=prefix_augmented)
+        else:
+            x_recon_student, params_student = self.student(x_augmented)
 
-    def forward(self, x):
-        x_augmented = self._augment_data(x).contiguous()
-        x_recon_student, params_student = self.student(x_augmented)
         x_reconstr_student_activated = self.student.nll_activation(x_recon_student)
-        _, q_z_given_xhat = self.student.posterior(x_reconstr_student_activated)
-        params_student['q_z_given_xhat'] = q_z_given_xhat
+        if self.plan['student_posterior_of_reconstruction']:
+            _, q_z_given_xhat = self.student.posterior(x_reconstr_student_activated)
+            params_student['q_z_given_xhat'] = q_z_given_xhat
+        else:
+            # the pruned pass also stepped the gumbel anneal schedule
+            self._advance_anneal_schedule()
 
         ret_map = {
             'student':{
                 'params': params_student,
-                'x_reconstr': self.student.nll_activation(x_recon_student),
+                'x_reconstr': x_reconstr_student_activated,
                 'x_reconstr_logits': x_recon_student
             },
             'augmented': {
@@ -392,17 +695,29 @@ class StudentTeacher(nn.Module):
             }
         }
 
-        # encode teacher with synthetic data
-        if self.teacher is not None:
-            # only teacher Q(z|x) is needed, so dont run decode step
+        # encode teacher with synthetic data; the teacher is frozen
+        # so there is no need to build a graph through it. The regularizers
+        # only read the (un-shuffled) synthetic rows and the teacher treats
+        # every row independently in eval mode, so the real rows are skipped;
+        # without synthetic rows (eg: at test time) there is nothing to regularize.
+        if self.teacher is not None and self.plan['teacher_posterior'] \
+           and self.num_teacher_samples > 0:
             self.teacher.eval()
-            #_, params_teacher = self.teacher.posterior(x_augmented)
-            x_recon_teacher, params_teacher = self.teacher(x_augmented)
-            # detach_from_graph(params_teacher)
-            ret_map['teacher']= {
-                'params': params_teacher,
-                'x_reconstr': self.teacher.nll_activation(x_recon_teacher),
-                'x_reconstr_logits': x_recon_teacher
-            }
+            x_synthetic = _unshuffled_rows(x_augmented, self.rnd_perm,
+                                           self.num_student_samples)
+            with torch.no_grad():
+                if self.plan['teacher_decoder']:
+                    x_recon_teacher, params_teacher = self.teacher(x_synthetic)
+                    ret_map['teacher']= {
+                        'params': params_teacher,
+                        'x_reconstr': self.teacher.nll_activation(x_recon_teacher),
+                        'x_reconstr_logits': x_recon_teacher
+                    }
+                else:
+                    # only teacher Q(z|x) is needed, so dont run decode step
+                    _, params_teacher = self.teacher.posterior(x_synthetic)
+                    ret_map['teacher']= {
+                        'params': params_teacher
+                    }
 
         return ret_map
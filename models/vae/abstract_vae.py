@@ -7,12 +7,12 @@ from torch.autograd import Variable
 from collections import OrderedDict, Counter
 
 from helpers.utils import float_type
-from models.relational_network import RelationalNetwork
 from helpers.layers import View, flatten_layers, Identity, \
     build_gated_conv_encoder, build_conv_encoder, build_dense_encoder, build_relational_conv_encoder, \
     build_gated_conv_decoder, build_conv_decoder, build_dense_decoder, build_pixelcnn_decoder, str_to_activ_module
 from helpers.distributions import nll_activation as nll_activation_fn
 from helpers.distributions import nll as nll_fn
+from models.relational_network import StreamingRelationalNetwork
 
 
 class AbstractVAE(nn.Module):
@@ -34,6 +34,9 @@ class AbstractVAE(nn.Module):
         # placeholder in order to sequentialize model
         self.full_model = None
 
+        # the first blocks of the encoder can be frozen after a fork
+        self.num_frozen_encoder_blocks = 0
+
     def get_name(self, reparam_str):
         ''' helper to get the name of the model '''
         es_str = "es" + str(int(self.config['early_stop'])) if self.config['early_stop'] \
@@ -91,14 +94,106 @@ class AbstractVAE(nn.Module):
 
         return task_str
 
+    def _encoder_blocks(self):
+        ''' the top-level blocks of the encoder, in order '''
+        encoder = self.encoder.module if isinstance(self.encoder, nn.DataParallel) else self.encoder
+        return list(encoder.children()) if isinstance(encoder, nn.Sequential) else [encoder]
+
+    def freeze_encoder_prefix(self, num_blocks):
+        ''' freezes the first num_blocks of the encoder (at least one block is
+            kept trainable); the frozen blocks always run in eval mode '''
+        blocks = self._encoder_blocks()
+        self.num_frozen_encoder_blocks = max(min(num_blocks, len(blocks) - 1), 0)
+        for block in blocks[0:self.num_frozen_encoder_blocks]:
+            for p in block.parameters():
+                p.requires_grad = False
+
+            block.eval()
+
+        print("froze {} of {} encoder blocks".format(self.num_frozen_encoder_blocks, len(blocks)))
+        return self.num_frozen_encoder_blocks
+
+    def train(self, mode=True):
+        ''' keeps the frozen encoder prefix in eval mode '''
+        super(AbstractVAE, self).train(mode)
+        if self.num_frozen_encoder_blocks > 0:
+            for block in self._encoder_blocks()[0:self.num_frozen_encoder_blocks]:
+                block.eval()
+
+        return self
+
+    def encode_prefix(self, x):
+        ''' runs the frozen encoder prefix, no graph is needed through it '''
+        with torch.no_grad():
+            for block in self._encoder_blocks()[0:self.num_frozen_encoder_blocks]:
+                x = block(x)
+
+        return x
+
+    def encode_suffix(self, encoder_prefix):
+        ''' runs the trainable encoder blocks on the frozen prefix's activations '''
+        for block in self._encoder_blocks()[self.num_frozen_encoder_blocks:]:
+            encoder_prefix = block(encoder_prefix)
+
+        return encoder_prefix
+
+    @staticmethod
+    def _conv_output_shape(module, input_shape):
+        ''' [C, H, W] produced by the conv / pooling layers of module for a
+            [C, H, W] input, computed from the layer hyper-parameters '''
+        def _pair(value):
+            return tuple(value) if isinstance(value, (tuple, list)) else (value, value)
+
+        def _size(size, kernel, stride, padding, dilation=1):
+            return (size + 2 * padding - dilation * (kernel - 1) - 1) // stride + 1
+
+        def _walk(layer):
+            children = list(layer.children())
+            if hasattr(layer, 'h') and hasattr(layer, 'g'):
+                yield layer.h  # gated layer: h & g share the same geometry
+            elif len(children) == 0:
+                yield layer
+            else:
+                for child in children:
+                    for leaf in _walk(child):
+                        yield leaf
+
+        chans, height, width = input_shape
+        for layer in _walk(module):
+            if isinstance(layer, (nn.Conv2d, nn.MaxPool2d, nn.AvgPool2d)):
+                kernel, stride, padding = _pair(layer.kernel_size), \
+                                          _pair(layer.stride), _pair(layer.padding)
+                dilation = _pair(getattr(layer, 'dilation', 1))
+                height = _size(height, kernel[0], stride[0], padding[0], dilation[0])
+                width = _size(width, kernel[1], stride[1], padding[1], dilation[1])
+                if isinstance(layer, nn.Conv2d):
+                    chans = layer.out_channels
+            elif isinstance(layer, (nn.AdaptiveAvgPool2d, nn.AdaptiveMaxPool2d)):
+                out_height, out_width = _pair(layer.output_size)
+                height = height if out_height is None else out_height
+                width = width if out_width is None else out_width
+            elif isinstance(layer, (nn.Linear, nn.ConvTranspose2d, nn.Conv1d, View)):
+                raise Exception("cannot infer the conv map shape through {}".format(layer))
+
+        return [chans, height, width]
+
     def build_encoder(self):
         ''' helper function to build convolutional or dense encoder '''
         if self.config['layer_type'] == 'conv':
             if self.config['use_relational_encoder']:
-                encoder = build_relational_conv_encoder(input_shape=self.input_shape,
-                                                        filter_depth=self.config['filter_depth'],
-                                                        activation_fn=self.activation_fn)
-                raise NotImplementedError
+                conv = build_relational_conv_encoder(input_shape=self.input_shape,
+                                                     filter_depth=self.config['filter_depth'],
+                                                     activation_fn=self.activation_fn)
+                conv_output_shape = self._conv_output_shape(conv, self.input_shape)
+                encoder = nn.Sequential(
+                    conv,
+                    StreamingRelationalNetwork(input_channels=conv_output_shape[0],
+                                               hidden_size=self.config['relational_hidden_size'],
+                                               output_size=self.reparameterizer.input_size,
+                                               cuda=self.config['cuda'],
+                                               ngpu=self.config['ngpu'],
+                                               pair_chunk_size=self.config['relational_pair_chunk'])
+                )
             else:
                 conv_builder = build_gated_conv_encoder \
                            if self.config['disable_gated_conv'] is False else build_conv_encoder
@@ -161,68 +256,55 @@ class AbstractVAE(nn.Module):
 
         return decoder
 
-    def _lazy_init_dense(self, input_size, output_size, name='enc_proj'):
-        '''initialize the dense linear projection lazily
-           because determining convolutional output size
-           is annoying '''
-        if not hasattr(self, name):
-            # build a simple linear projector
-            setattr(self, name, nn.Sequential(
-                View([-1, input_size]),
-                nn.Linear(input_size, output_size)
-            ))
-
-            if self.config['ngpu'] > 1:
-                setattr(self, name,
-                        nn.DataParallel(getattr(self, name))
-                )
+    def _build_dense_projector(self, input_size, output_size):
+        ''' helper to build a simple linear projector; the sizes
+            are known at construction so no dummy forward is needed '''
+        projector = nn.Sequential(
+            View([-1, input_size]),
+            nn.Linear(input_size, output_size)
+        )
 
-            if self.config['cuda']:
-                setattr(self, name, getattr(self, name).cuda())
-
-    def _lazy_init_relational(self, output_size, name='enc_proj'):
-        '''initialize a relational network lazily
-           because determining convolutional output size
-           is annoying '''
-        if not hasattr(self, name):
-            setattr(self, name, RelationalNetwork(hidden_size=512, #XXX
-                                                  output_size=output_size,
-                                                  cuda=self.config['cuda'],
-                                                  ngpu=self.config['ngpu']))
-
-            if self.config['ngpu'] > 1:
-                setattr(self, name,
-                        nn.DataParallel(getattr(self, name))
-                )
+        if self.config['ngpu'] > 1:
+            projector = nn.DataParallel(projector)
+
+        if self.config['cuda']:
+            projector = projector.cuda()
+
+        return projector
+
+    def build_decoder_projector(self):
+        ''' if we have a nll with variance then build a projector to
+            the required dimensions, returns None for bernoulli '''
+        if self.config['nll_type'] != 'gaussian' \
+           and self.config['nll_type'] != 'clamp':
+            return None
+
+        disable_batchnorm = self.config.get('disable_batchnorm', False)
+        if self.config['layer_type'] == 'conv':
+            decoder_projector = nn.Sequential(
+                nn.BatchNorm2d(self.chans) if not disable_batchnorm else Identity(),
+                self.activation_fn(inplace=True),
+                nn.ConvTranspose2d(self.chans, self.chans*2, 1, stride=1, bias=False)
+            )
+        else:
+            input_flat = int(np.prod(self.input_shape))
+            decoder_projector = nn.Sequential(
+                View([-1, input_flat]),
+                nn.BatchNorm1d(input_flat) if not disable_batchnorm else Identity(),
+                self.activation_fn(inplace=True),
+                nn.Linear(input_flat, input_flat*2, bias=True),
+                View([-1, self.chans*2, *self.input_shape[1:]])
+            )
 
-            if self.config['cuda']:
-                setattr(self, name, getattr(self, name).cuda())
+        if self.config['cuda']:
+            decoder_projector = decoder_projector.cuda()
+
+        return decoder_projector
 
     def _project_decoder_for_variance(self, logits):
         ''' if we have a nll with variance
             then project it to the required dimensions '''
-        if self.config['nll_type'] == 'gaussian' \
-           or self.config['nll_type'] == 'clamp':
-            if not hasattr(self, 'decoder_projector'):
-                if self.config['layer_type'] == 'conv':
-                    self.decoder_projector = nn.Sequential(
-                        nn.BatchNorm2d(self.chans) if not self.config['disable_batchnorm'] else Identity(),
-                        self.activation_fn(inplace=True),
-                        nn.ConvTranspose2d(self.chans, self.chans*2, 1, stride=1, bias=False)
-                    )
-                else:
-                    input_flat = int(np.prod(self.input_shape))
-                    self.decoder_projector = nn.Sequential(
-                        View([-1, input_flat]),
-                        nn.BatchNorm1d(input_flat) if not self.config['disable_batchnorm'] else Identity(),
-                        self.activation_fn(inplace=True),
-                        nn.Linear(input_flat, input_flat*2, bias=True),
-                        View([-1, self.chans*2, *self.input_shape[1:]])
-                    )
-
-                if self.config['cuda']:
-                    self.decoder_projector.cuda()
-
+        if self.decoder_projector is not None:
             return self.decoder_projector(logits)
 
         # bernoulli reconstruction
@@ -307,6 +389,10 @@ class AbstractVAE(nn.Module):
         ''' returns a generation for a given z '''
         raise NotImplementedError("generate not implemented")
 
+    def generate_from_prior(self, batch_size, **kwargs):
+        ''' returns a generation for a sample of the prior '''
+        return self.generate(self.reparameterizer.prior(batch_size, **kwargs))
+
     def kld(self, dist_params):
         ''' KL divergence between dist_a and prior '''
         raise NotImplementedError("kld not implemented")
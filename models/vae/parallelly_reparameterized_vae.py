@@ -2,11 +2,24 @@ from __future__ import print_function
 import numpy as np
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+from copy import deepcopy
 
+from helpers.layers import View, Identity
 from models.reparameterizers.gumbel import GumbelSoftmax
 from models.reparameterizers.mixture import Mixture
 from models.reparameterizers.isotropic_gaussian import IsotropicGaussian
 from models.vae.abstract_vae import AbstractVAE
+from models.loss_planner import needs_mutual_info
+
+
+def _flatten_sequential(module):
+    ''' unrolls nested nn.Sequential containers into a flat list of layers '''
+    if isinstance(module, nn.Sequential):
+        return [layer for child in module.children()
+                for layer in _flatten_sequential(child)]
+
+    return [module]
 
 
 class ParallellyReparameterizedVAE(AbstractVAE):
@@ -36,6 +49,8 @@ class ParallellyReparameterizedVAE(AbstractVAE):
         # build the encoder and decoder
         self.encoder = self.build_encoder()
         self.decoder = self.build_decoder()
+        self.decoder_projector = self.build_decoder_projector()
+        self.sparse_decoder = self.build_sparse_decoder()
 
     def get_name(self):
         if self.config['reparam_type'] == "mixture":
@@ -73,32 +88,218 @@ class ParallellyReparameterizedVAE(AbstractVAE):
         logits = self.decoder(z.contiguous())
         return self._project_decoder_for_variance(logits)
 
-    def posterior(self, x):
-        z_logits = self.encode(x)
+    def _discrete_offset(self):
+        ''' offset of the one-hot segment within z, None if there is none '''
+        if isinstance(self.reparameterizer, GumbelSoftmax):
+            return 0
+        elif isinstance(self.reparameterizer, Mixture):
+            return self.reparameterizer.gaussian.output_size
+
+        return None
+
+    def _discrete_input_offset(self):
+        ''' offset of the discrete logits within the encoder's output '''
+        if isinstance(self.reparameterizer, Mixture):
+            return self.reparameterizer.gaussian.input_size
+
+        return 0
+
+    def _encoder_output_layers(self):
+        ''' the layer(s) producing the reparameterizer's logits: the last
+            Linear / Conv of the encoder with that many outputs (and its
+            sibling for a gated h / g pair) '''
+        named = [(name, m) for name, m in self.encoder.named_modules()
+                 if isinstance(m, (nn.Linear, nn.Conv1d, nn.Conv2d))
+                 and m.weight.size(0) == self.reparameterizer.input_size]
+        if not named:
+            return []
+
+        name, layer = named[-1]
+        if name.endswith('.h') or name.endswith('.g'):
+            return [m for n, m in named if n[0:-2] == name[0:-2]]
+
+        return [layer]
+
+    def _decoder_input_layers(self):
+        ''' the first (non view) layer(s) of the decoder, both halves if gated '''
+        layers = [l for l in _flatten_sequential(self.decoder) if not isinstance(l, (View, Identity))]
+        if not layers:
+            return []
+
+        return [layers[0].h, layers[0].g] if self._is_gated(layers[0]) else [layers[0]]
+
+    def reinit_categories(self, categories):
+        ''' re-initializes the encoder outputs & decoder inputs of the given
+            discrete categories, eg: the dead categories that are recycled;
+            the slices are copied from freshly initialized layers '''
+        if len(categories) == 0 or self._discrete_offset() is None:
+            return
+
+        categories = torch.as_tensor(categories, dtype=torch.long)
+        in_idx = categories + self._discrete_input_offset()
+        out_idx = categories + self._discrete_offset()
+        with torch.no_grad():
+            for layer in self._encoder_output_layers():
+                fresh = deepcopy(layer)
+                fresh.reset_parameters()
+                idx = in_idx.to(layer.weight.device)
+                layer.weight[idx] = fresh.weight[idx]
+                if layer.bias is not None:
+                    layer.bias[idx] = fresh.bias[idx]
+
+            for layer in self._decoder_input_layers():
+                if not isinstance(layer, (nn.Linear, nn.Conv2d, nn.ConvTranspose2d)):
+                    print("can't re-initialize the latent inputs of {}".format(layer))
+                    continue
+
+                fresh = deepcopy(layer)
+                fresh.reset_parameters()
+                idx = out_idx.to(layer.weight.device)
+                # ConvTranspose2d weights are [in, out, ...], the others [out, in, ...]
+                if isinstance(layer, nn.ConvTranspose2d):
+                    layer.weight[idx] = fresh.weight[idx]
+                else:
+                    layer.weight[:, idx] = fresh.weight[:, idx]
+
+    @staticmethod
+    def _is_gated(layer):
+        ''' the gated layers of helpers.layers: activation(h(x)) * sigmoid(g(x)) '''
+        return isinstance(getattr(layer, 'h', None), (nn.Linear, nn.ConvTranspose2d)) \
+            and type(getattr(layer, 'g', None)) is type(layer.h)
+
+    @staticmethod
+    def _gatherable(layer, probe_shape, latent_size):
+        ''' True if layer can be evaluated by gathering its weights: a Linear
+            on a [B, latent] z or a ConvTranspose2d on a [B, latent, 1, 1] z '''
+        if isinstance(layer, nn.Linear):
+            return probe_shape == [1, latent_size]
+        elif isinstance(layer, nn.ConvTranspose2d):
+            return probe_shape == [1, latent_size, 1, 1] \
+                and layer.padding == (0, 0) \
+                and layer.output_padding == (0, 0) \
+                and layer.dilation == (1, 1) \
+                and layer.groups == 1
+
+        return False
+
+    def build_sparse_decoder(self):
+        ''' splits the decoder into its first layer and the rest so that
+            hard one-hot latents can gather the first layer's weights by
+            category index; returns None if disabled or if the decoder does
+            not start with (views and) a Linear or a 1x1-input ConvTranspose2d,
+            or a gated (h / g) pair of them such as the default gated decoders '''
+        if not self.config['sparse_latent_decoding'] \
+           or self._discrete_offset() is None \
+           or isinstance(self.decoder, nn.DataParallel):
+            return None
+
+        layers = _flatten_sequential(self.decoder)
+        num_views = 0
+        while num_views < len(layers) and isinstance(layers[num_views], (View, Identity)):
+            num_views += 1
+
+        if num_views == len(layers):
+            return None
+
+        # the views must hand the first layer a [B, latent] or [B, latent, 1, 1] z
+        latent_size = self.reparameterizer.output_size
+        with torch.no_grad():
+            probe = torch.zeros(1, latent_size)
+            for layer in layers[0:num_views]:
+                probe = layer(probe)
+
+        first_layer = layers[num_views]
+        probe_shape = list(probe.size())
+        if self._is_gated(first_layer):
+            if self._gatherable(first_layer.h, probe_shape, latent_size) \
+               and self._gatherable(first_layer.g, probe_shape, latent_size):
+                return first_layer, layers[num_views + 1:]
+        elif self._gatherable(first_layer, probe_shape, latent_size):
+            return first_layer, layers[num_views + 1:]
+
+        print("sparse latent decoding unsupported for {}, decoding densely".format(first_layer))
+        return None
+
+    @staticmethod
+    def _gather_layer(layer, z_dense, indices, offset):
+        ''' layer([z_dense, one_hot(indices)]) through a view of its weight '''
+        weight = layer.weight
+        if isinstance(layer, nn.Linear):
+            # weight is [out, in]
+            logits = F.embedding(indices + offset, weight.t())
+            if z_dense is not None:
+                logits = logits + F.linear(z_dense, weight[:, 0:offset])
+
+            bias = layer.bias
+        else:
+            # weight is [in, out, kH, kW] and a 1x1 input yields [out, kH, kW]
+            flat_weight = weight.view(weight.size(0), -1)
+            logits = F.embedding(indices + offset, flat_weight)
+            if z_dense is not None:
+                logits = logits + torch.mm(z_dense, flat_weight[0:offset])
+
+            logits = logits.view(-1, *weight.size()[1:])
+            bias = layer.bias.view(1, -1, 1, 1) if layer.bias is not None else None
+
+        return logits + bias if bias is not None else logits
+
+    def decode_sparse(self, z_dense, indices):
+        ''' decodes [z_dense, one_hot(indices)] without building the one-hot:
+            the first layer's weights of the active categories are gathered
+            (through a view of the dense layer's weight) instead of a matmul.
+            z_dense holds the latents before the discrete segment or is None '''
+        first_layer, layers = self.sparse_decoder
+        offset = 0 if z_dense is None else z_dense.size(-1)
+        if self._is_gated(first_layer):
+            h = self._gather_layer(first_layer.h, z_dense, indices, offset)
+            activation = getattr(first_layer, 'activation', None)
+            h = activation(h) if activation is not None else h
+            g = self._gather_layer(first_layer.g, z_dense, indices, offset)
+            logits = h * torch.sigmoid(g)
+        else:
+            logits = self._gather_layer(first_layer, z_dense, indices, offset)
+
+        for layer in layers:
+            logits = layer(logits)
+
+        return self._project_decoder_for_variance(logits)
+
+    def generate_from_prior(self, batch_size, **kwargs):
+        ''' decodes a sample of the prior, by index if possible '''
+        if self.sparse_decoder is None or kwargs.get('soft_prior', False):
+            return super(ParallellyReparameterizedVAE, self).generate_from_prior(batch_size, **kwargs)
+
+        z_dense, indices = self.reparameterizer.prior_indices(batch_size, **kwargs)
+        return self.decode_sparse(z_dense, indices)
+
+    def forward(self, x, encoder_prefix=None):
+        ''' params is a map of the latent variable's parameters;
+            hard latents are decoded by index when no grads are needed '''
+        z, params = self.posterior(x, encoder_prefix=encoder_prefix)
+        if self.sparse_decoder is not None \
+           and not self.training and not torch.is_grad_enabled():
+            offset = self._discrete_offset()
+            indices = torch.argmax(params['discrete']['z_hard'], dim=-1)
+            return self.decode_sparse(z[:, 0:offset] if offset > 0 else None, indices), params
+
+        return self.decode(z), params
+
+    def posterior(self, x, encoder_prefix=None):
+        z_logits = self.encode(x, encoder_prefix=encoder_prefix)
         return self.reparameterize(z_logits)
 
     def reparameterize(self, logits):
         ''' reparameterizes the latent logits appropriately '''
         return self.reparameterizer(logits)
 
-    def encode(self, x):
-        ''' encodes via a convolution
-            and lazy init's a dense projector'''
-        conv = self.encoder(x)         # do the convolution
-        return conv
-
-        # if self.config['use_relational_encoder']:
-        #     # build a relational net as the encoder projection
-        #     self._lazy_init_relational(self.reparameterizer.input_size, name='enc_proj')
-        # else:
-        #     # project via linear layer [if necessary!]
-        #     conv_output_shp = int(np.prod(conv.size()[1:]))
-        #     self._lazy_init_dense(conv_output_shp,
-        #                           self.reparameterizer.input_size,
-        #                           name='enc_proj')
-
-        # # return projected units
-        # return self.enc_proj(conv)
+    def encode(self, x, encoder_prefix=None):
+        ''' encodes via a convolution (optionally followed by
+            a relational network) into the reparameterizer's logits;
+            encoder_prefix are the (cached) activations of the frozen blocks '''
+        if encoder_prefix is not None:
+            return self.encode_suffix(encoder_prefix)
+
+        return self.encoder(x)
 
     def generate(self, z):
         ''' reparameterizer for sequential is different '''
@@ -111,9 +312,7 @@ class ParallellyReparameterizedVAE(AbstractVAE):
     def mut_info(self, dist_params):
         ''' helper to get mutual info '''
         mut_info = None
-        if (self.config['reparam_type'] == 'mixture' \
-           or self.config['reparam_type'] == 'discrete')\
-           and not self.config['disable_regularizers']:
+        if needs_mutual_info(self.config):
             mut_info = self.reparameterizer.mutual_info(dist_params)
 
         return mut_info
@@ -4,7 +4,6 @@ import torch
 import torch.nn as nn
 from torch.autograd import Variable
 
-from helpers.utils import float_type
 from models.reparameterizers.gumbel import GumbelSoftmax
 from models.reparameterizers.mixture import Mixture
 from models.reparameterizers.isotropic_gaussian import IsotropicGaussian
@@ -41,6 +40,17 @@ class SequentiallyReparameterizedVAE(AbstractVAE):
         # build the encoder and decoder
         self.encoder = self.build_encoder()
         self.decoder = self.build_decoder()
+        self.decoder_projector = self.build_decoder_projector()
+
+        # build the residual skips from the encoder logits into
+        # each subsequent reparameterizer and the decoder projection
+        for i in range(1, len(self.reparameterizers)):
+            setattr(self, "residual_%d"%i,
+                    self._build_dense_projector(self.reparameterizer.input_size,
+                                                self.reparameterizers[i-1][-1].output_size))
+
+        self.dec_proj = self._build_dense_projector(self.reparameterizers[-1][-1].output_size,
+                                                    self.reparameterizer.output_size)
 
     def _build_sequential_reparameterizers(self, reparam_str_list):
         ''' helper to build all the reparameterizers '''
@@ -127,8 +137,6 @@ class SequentiallyReparameterizedVAE(AbstractVAE):
         z_logits = z.clone().view(batch_size, -1)
         for i, reparameterizer in enumerate(self.reparameterizers):
             if i > 0: # add a residual connection
-                self._lazy_init_dense(z_logits.size(-1), z.size(-1),
-                                      name="residual_%d"%i)
                 z = z + getattr(self, "residual_%d"%i)(z_logits)
 
             z, params = reparameterizer(z.contiguous().view(batch_size, -1))
@@ -139,17 +147,6 @@ class SequentiallyReparameterizedVAE(AbstractVAE):
 
     def decode(self, z):
         '''returns logits '''
-        if self.config['use_relational_encoder']:
-            # build a relational net as the encoder projection
-            self._lazy_init_relational(self.reparameterizer.input_size,
-                                       name='dec_proj')
-        else:
-            # project via linear layer [if necessary!]
-            z_output_shp = int(np.prod(z.size()[1:]))
-            self._lazy_init_dense(z_output_shp,
-                                  self.reparameterizer.output_size,
-                                  name='dec_proj')
-
         # project via decoder
         logits = self.decoder(self.dec_proj(z.contiguous()))
         return self._project_decoder_for_variance(logits)
@@ -173,12 +170,9 @@ class SequentiallyReparameterizedVAE(AbstractVAE):
 
     def kld(self, dists):
         ''' does the KL divergence between the posterior and the prior '''
-        batch_size = dists['z_0'].size(0)
-        kl = Variable(float_type(self.config['cuda'])(batch_size).zero_())
-        for i, reparameterizer in enumerate(self.reparameterizers):
-            kl += reparameterizer[-1].kl(dists['params_%d'%i])
-
-        return kl
+        # summed out-of-place so that it also works under vmap
+        return sum(reparameterizer[-1].kl(dists['params_%d'%i])
+                   for i, reparameterizer in enumerate(self.reparameterizers))
 
     def loss_function(self, recon_x, x, params):
         return super(SequentiallyReparameterizedVAE, self).loss_function(recon_x, x, params)
@@ -21,15 +21,21 @@ class AdamNormGrad(Optimizer):
         eps (float, optional): term added to the denominator to improve
             numerical stability (default: 1e-8)
         weight_decay (float, optional): weight decay (L2 penalty) (default: 0)
+        foreach (bool, optional): use the multi-tensor (foreach) implementation
+            which normalizes and updates all the tensors of a group with
+            grouped ops; None picks it when available (default: None)
 
     .. _Adam\: A Method for Stochastic Optimization:
         https://arxiv.org/abs/1412.6980
     """
 
     def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8,
-                 weight_decay=0):
+                 weight_decay=0, foreach=None):
+        if foreach is None:
+            foreach = hasattr(torch, '_foreach_norm')
+
         defaults = dict(lr=lr, betas=betas, eps=eps,
-                        weight_decay=weight_decay)
+                        weight_decay=weight_decay, foreach=foreach)
         super(AdamNormGrad, self).__init__(params, defaults)
 
     def step(self, closure=None):
@@ -44,43 +50,102 @@ class AdamNormGrad(Optimizer):
             loss = closure()
 
         for group in self.param_groups:
-            for p in group['params']:
-                if p.grad is None:
-                    continue
-                grad = p.grad.data
-                #############################################
-                # normalize grdients
-                grad = grad / ( torch.norm(grad,2) + 1.e-7 )
-                #############################################
-
-                state = self.state[p]
+            if group['foreach']:
+                self._multi_tensor_step(group)
+            else:
+                self._single_tensor_step(group)
 
-                # State initialization
-                if len(state) == 0:
-                    state['step'] = 0
-                    # Exponential moving average of gradient values
-                    state['exp_avg'] = grad.new().resize_as_(grad).zero_()
-                    # Exponential moving average of squared gradient values
-                    state['exp_avg_sq'] = grad.new().resize_as_(grad).zero_()
+        return loss
 
-                exp_avg, exp_avg_sq = state['exp_avg'], state['exp_avg_sq']
-                beta1, beta2 = group['betas']
+    def _init_state(self, p):
+        state = self.state[p]
+        if len(state) == 0:
+            state['step'] = 0
+            # Exponential moving average of gradient values
+            state['exp_avg'] = torch.zeros_like(p.data)
+            # Exponential moving average of squared gradient values
+            state['exp_avg_sq'] = torch.zeros_like(p.data)
+
+        return state
+
+    def _multi_tensor_step(self, group):
+        ''' same update as _single_tensor_step but every op is applied
+            to all the tensors of the group at once '''
+        params = [p for p in group['params'] if p.grad is not None]
+        if len(params) == 0:
+            return
+
+        # params that received a grad in different steps have different
+        # bias corrections, so bucket them by their step count
+        buckets = {}
+        for p in params:
+            state = self._init_state(p)
+            state['step'] += 1
+            buckets.setdefault(state['step'], []).append(p)
+
+        beta1, beta2 = group['betas']
+        for step, bucket in buckets.items():
+            with torch.no_grad():
+                grads = [p.grad.data for p in bucket]
+                exp_avgs = [self.state[p]['exp_avg'] for p in bucket]
+                exp_avg_sqs = [self.state[p]['exp_avg_sq'] for p in bucket]
 
-                state['step'] += 1
+                #############################################
+                # normalize grdients, all norms in one call
+                norms = torch._foreach_add(torch._foreach_norm(grads, 2), 1.e-7)
+                grads = torch._foreach_div(grads, norms)
+                #############################################
 
                 if group['weight_decay'] != 0:
-                    grad = grad.add(group['weight_decay'], p.data)
+                    grads = torch._foreach_add(grads, [p.data for p in bucket],
+                                               alpha=group['weight_decay'])
 
                 # Decay the first and second moment running average coefficient
-                exp_avg.mul_(beta1).add_(1 - beta1, grad)
-                exp_avg_sq.mul_(beta2).addcmul_(1 - beta2, grad, grad)
+                torch._foreach_mul_(exp_avgs, beta1)
+                torch._foreach_add_(exp_avgs, grads, alpha=1 - beta1)
+                torch._foreach_mul_(exp_avg_sqs, beta2)
+                torch._foreach_addcmul_(exp_avg_sqs, grads, grads, value=1 - beta2)
 
-                denom = exp_avg_sq.sqrt().add_(group['eps'])
+                denom = torch._foreach_sqrt(exp_avg_sqs)
+                torch._foreach_add_(denom, group['eps'])
 
-                bias_correction1 = 1 - beta1 ** state['step']
-                bias_correction2 = 1 - beta2 ** state['step']
+                bias_correction1 = 1 - beta1 ** step
+                bias_correction2 = 1 - beta2 ** step
                 step_size = group['lr'] * math.sqrt(bias_correction2) / bias_correction1
 
-                p.data.addcdiv_(-step_size, exp_avg, denom)
+                torch._foreach_addcdiv_([p.data for p in bucket], exp_avgs, denom,
+                                        value=-step_size)
 
-        return loss
+    def _single_tensor_step(self, group):
+        ''' reference implementation, loops over every parameter '''
+        for p in group['params']:
+            if p.grad is None:
+                continue
+            grad = p.grad.data
+            #############################################
+            # normalize grdients
+            grad = grad / ( torch.norm(grad,2) + 1.e-7 )
+            #############################################
+
+            # State initialization
+            state = self._init_state(p)
+
+            exp_avg, exp_avg_sq = state['exp_avg'], state['exp_avg_sq']
+            beta1, beta2 = group['betas']
+
+            state['step'] += 1
+
+            if group['weight_decay'] != 0:
+                grad = grad.add(p.data, alpha=group['weight_decay'])
+
+            # Decay the first and second moment running average coefficient
+            exp_avg.mul_(beta1).add_(grad, alpha=1 - beta1)
+            exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+
+            denom = exp_avg_sq.sqrt().add_(group['eps'])
+
+            bias_correction1 = 1 - beta1 ** state['step']
+            bias_correction2 = 1 - beta2 ** state['step']
+            step_size = group['lr'] * math.sqrt(bias_correction2) / bias_correction1
+
+            p.data.addcdiv_(exp_avg, denom, value=-step_size)
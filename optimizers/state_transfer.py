@@ -0,0 +1,69 @@
+from __future__ import print_function
+import torch
+import torch.optim as optim
+from copy import deepcopy
+
+
+# the adam second moments, they set the scale of the steps
+SECOND_MOMENTS = ['exp_avg_sq', 'max_exp_avg_sq']
+
+
+def _warm_grown_state(dest_state, slices):
+    ''' the step count is per parameter, so a grown parameter keeps the warm
+        one along with the moments of its overlapping slice. The new slices
+        keep a zero first moment and take the mean second moment of the
+        overlap: with a warm (bias correction ~1) step count a zero second
+        moment would blow their first updates up by ~1 / sqrt(1 - beta2) '''
+    for k in SECOND_MOMENTS:
+        if k in dest_state:
+            overlap = dest_state[k][slices].clone()
+            dest_state[k].fill_(overlap.mean().item())
+            dest_state[k][slices].copy_(overlap)
+
+    return dest_state
+
+
+def _transfer_param_state(src_param, dest_param, slices, src_state):
+    ''' maps a single parameter's state, returns None if some
+        tensor in the state can't be aligned with the parameter '''
+    dest_state = {}
+    for k, v in src_state.items():
+        if torch.is_tensor(v) and v.size() == src_param.size():
+            dest_state[k] = torch.zeros_like(dest_param, dtype=v.dtype)
+            dest_state[k][slices].copy_(v[slices])
+        elif torch.is_tensor(v) and v.dim() == 0:
+            dest_state[k] = v.clone()    # eg: the step count in newer torch
+        elif not torch.is_tensor(v):
+            dest_state[k] = deepcopy(v)  # eg: the step count
+        else:
+            return None
+
+    if src_param.size() != dest_param.size():
+        dest_state = _warm_grown_state(dest_state, slices)
+
+    return dest_state
+
+
+def transfer_optimizer_state(src_optimizer, dest_optimizer, param_map):
+    ''' moves the per-parameter state (eg: exp_avg / exp_avg_sq of adam)
+        from src_optimizer to dest_optimizer. param_map is the list of
+        (src_param, dest_param, slices) returned by StudentTeacher.fork();
+        grown parameters keep their step count and the state of the
+        overlapping slice, see _warm_grown_state for the new slices. '''
+    if isinstance(src_optimizer, optim.LBFGS) \
+       or isinstance(dest_optimizer, optim.LBFGS):
+        return 0 # LBFGS keeps one flat history for all params
+
+    num_transferred = 0
+    with torch.no_grad():
+        for src_param, dest_param, slices in param_map:
+            src_state = src_optimizer.state.get(src_param, None)
+            if not src_state:
+                continue
+
+            dest_state = _transfer_param_state(src_param, dest_param, slices, src_state)
+            if dest_state is not None:
+                dest_optimizer.state[dest_param] = dest_state
+                num_transferred += 1
+
+    return num_transferred
@@ -0,0 +1,64 @@
+import pytest
+
+
+# the defaults of main.py's parser for a tiny dense model on cpu
+TINY_CONFIG = {
+    'uid': 'test', 'task': 'mnist', 'epochs': 1, 'lr': 1e-3,
+    'batch_size': 4, 'real_batch_size': None, 'replay_batch_size': None,
+    'continuous_size': 4, 'discrete_size': 3, 'filter_depth': 4,
+    'reparam_type': 'mixture', 'vae_type': 'parallel',
+    'layer_type': 'dense', 'nll_type': 'bernoulli',
+    'normalization': 'groupnorm', 'activation': 'elu',
+    'disable_gated_conv': False, 'use_relational_encoder': False,
+    'relational_pair_chunk': 1024, 'relational_hidden_size': 32,
+    'use_pixel_cnn_decoder': False,
+    'sparse_latent_decoding': False, 'disable_student_teacher': False,
+    'disable_augmentation': False, 'disable_regularizers': False,
+    'shuffle_minibatches': False, 'monte_carlo_infogain': False,
+    'continuous_mut_info': 0.0, 'discrete_mut_info': 0.0, 'kl_reg': 1.0,
+    'generative_scale_var': 1.0, 'consistency_gamma': 1.0,
+    'likelihood_gamma': 0.0, 'mut_clamp_strategy': 'clamp',
+    'mut_clamp_value': 100.0, 'prune_dead_categories': False,
+    'dead_category_threshold': 1e-3, 'max_discrete_size': None, 'ewc_gamma': 0,
+    'replay_buffer_size': 0, 'replay_generation_batch_size': None,
+    'replay_refresh_policy': 'fifo', 'replay_reuse': 1.0,
+    'freeze_encoder_blocks': 0, 'encoder_prefix_cache_mb': 1024,
+    'compact_teacher': 'none',
+    'noise_pool_steps': 16, 'early_stop': False, 'model_dir': '.models',
+    'ngpu': 1, 'cuda': False, 'img_shp': [1, 8, 8]
+}
+
+
+@pytest.fixture
+def make_config():
+    def _make_config(**overrides):
+        config = dict(TINY_CONFIG)
+        config.update(overrides)
+        return config
+
+    return _make_config
+
+
+@pytest.fixture
+def make_vae(make_config):
+    ''' builds the tiny VAE of the config's vae_type '''
+    def _make_vae(**overrides):
+        from models.vae.parallelly_reparameterized_vae import ParallellyReparameterizedVAE
+        from models.vae.sequentially_reparameterized_vae import SequentiallyReparameterizedVAE
+        config = make_config(**overrides)
+        vae_cls = ParallellyReparameterizedVAE if config['vae_type'] == 'parallel' \
+            else SequentiallyReparameterizedVAE
+        return vae_cls(config['img_shp'], kwargs=config)
+
+    return _make_vae
+
+
+@pytest.fixture
+def make_student_teacher(make_vae):
+    ''' wraps a tiny VAE in a StudentTeacher, as main.py does '''
+    def _make_student_teacher(**overrides):
+        from models.student_teacher import StudentTeacher
+        vae = make_vae(**overrides)
+        return StudentTeacher(vae, kwargs=vae.config)
+
+    return _make_student_teacher
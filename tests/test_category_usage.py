@@ -0,0 +1,79 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('helpers.layers')
+
+import torch.nn as nn
+from helpers.layers import View
+
+
+def _loader(num_samples=6, batch_size=4, img_shp=(1, 8, 8)):
+    x = torch.rand(num_samples, *img_shp)
+    return list(zip(torch.split(x, batch_size),
+                    torch.split(torch.zeros(num_samples).long(), batch_size)))
+
+
+def test_category_usage_is_deterministic(make_student_teacher):
+    torch.manual_seed(0)
+    model = make_student_teacher(reparam_type='discrete')
+    model.train()
+    loader = _loader()
+
+    usage = model.category_usage(loader)
+    assert usage.size(0) == model.config['discrete_size']
+    assert usage.sum().item() == 6
+    assert torch.equal(model.category_usage(loader), usage)
+    assert model.student.training, "category_usage must restore the train mode"
+
+
+def test_category_usage_of_an_empty_loader(make_student_teacher):
+    model = make_student_teacher(reparam_type='discrete')
+    assert model.category_usage([]) is None
+
+
+def test_dead_categories(make_student_teacher):
+    model = make_student_teacher(reparam_type='discrete', dead_category_threshold=0.05)
+    dead = model._dead_categories(torch.tensor([60, 1, 39]))
+    assert dead.tolist() == [1]
+    assert model._num_new_categories(len(dead)) == model.config['discrete_size'] - 1
+    assert model._num_new_categories(5) == 0
+
+
+@pytest.mark.parametrize('reparam_type', ['discrete', 'mixture'])
+def test_reinit_categories_only_touches_the_recycled_slots(make_vae, reparam_type):
+    torch.manual_seed(0)
+    vae = make_vae(reparam_type=reparam_type)
+    latent_size = vae.reparameterizer.output_size
+    vae.decoder = nn.Sequential(View([-1, latent_size]), nn.Linear(latent_size, 64),
+                                View([-1, 1, 8, 8]))
+
+    encoder_layers, decoder_layers = vae._encoder_output_layers(), vae._decoder_input_layers()
+    assert len(encoder_layers) > 0 and len(decoder_layers) == 1
+    encoder_before = [l.weight.detach().clone() for l in encoder_layers]
+    decoder_before = decoder_layers[0].weight.detach().clone()
+
+    vae.reinit_categories([1])
+    in_idx = 1 + vae._discrete_input_offset()
+    out_idx = 1 + vae._discrete_offset()
+    for layer, before in zip(encoder_layers, encoder_before):
+        changed = (layer.weight != before).flatten(1).any(1)
+        assert changed.nonzero().flatten().tolist() == [in_idx]
+
+    changed = (decoder_layers[0].weight != decoder_before).any(0)
+    assert changed.nonzero().flatten().tolist() == [out_idx]
+
+
+def test_pruned_fork_recycles_the_dead_categories(make_student_teacher):
+    torch.manual_seed(0)
+    model = make_student_teacher(reparam_type='discrete', prune_dead_categories=True,
+                                 dead_category_threshold=0.05)
+    discrete_size = model.config['discrete_size']
+    model.fork(category_usage=torch.tensor([60, 1, 39]))
+
+    # one dead category is reused, so the latent grows by one less
+    assert model.student.config['discrete_size'] == 2 * discrete_size - 1
+    teacher_layer = model.teacher._encoder_output_layers()[0]
+    student_layer = model.student._encoder_output_layers()[0]
+    assert torch.equal(student_layer.weight[0], teacher_layer.weight[0])
+    assert torch.equal(student_layer.weight[2], teacher_layer.weight[2])
+    assert not torch.equal(student_layer.weight[1], teacher_layer.weight[1])
@@ -0,0 +1,24 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('helpers.utils')
+
+from models.reparameterizers.concat_reparameterizer import ConcatReparameterizer
+from models.reparameterizers.gumbel import GumbelSoftmax
+from models.reparameterizers.isotropic_gaussian import IsotropicGaussian
+
+
+def test_batched_kl_matches_the_sum_over_heads(make_config):
+    torch.manual_seed(0)
+    config = make_config(continuous_size=4, discrete_size=3)
+    heads = [IsotropicGaussian(config), GumbelSoftmax(config),
+             IsotropicGaussian(config), GumbelSoftmax(make_config(discrete_size=5))]
+    reparameterizer = ConcatReparameterizer(heads, config).train()
+
+    z, params = reparameterizer(torch.randn(6, reparameterizer.input_size))
+    assert z.size() == (6, reparameterizer.output_size)
+
+    expected = sum(head.kl(params['heads'][i]) for i, head in enumerate(heads))
+    kl = reparameterizer.kl(params)
+    assert kl.size() == (6,)
+    assert torch.allclose(kl, expected, atol=1e-5)
@@ -0,0 +1,66 @@
+import argparse
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from torch.utils.data import DataLoader, TensorDataset, SubsetRandomSampler
+from loaders.dataset_cache import cache_key, cached_loaders
+
+
+class _SplitLoader(object):
+    ''' two class splits sharing one dataset, as get_split_data_loaders builds them '''
+    def __init__(self, dataset, train_indices, test_indices):
+        self.img_shp = [1, 2, 2]
+        self.output_size = 2
+        self.train_loader = DataLoader(dataset, batch_size=2, drop_last=True,
+                                       sampler=SubsetRandomSampler(train_indices))
+        self.test_loader = DataLoader(dataset, batch_size=2,
+                                      sampler=SubsetRandomSampler(test_indices))
+
+
+def _args(tmpdir, **kwargs):
+    args = dict(task='mnist', disable_sequential=False, seed=1, data_dir=str(tmpdir),
+                batch_size=2, cuda=False, rotation_step=10)
+    args.update(kwargs)
+    return argparse.Namespace(**args)
+
+
+def test_cache_round_trip(tmpdir):
+    # every sample holds its own index, stored as uint8 in the cache
+    x = torch.arange(8).float().view(8, 1, 1, 1).expand(8, 1, 2, 2) / 255.0
+    dataset = TensorDataset(x, torch.arange(8) % 2)
+    splits = [_SplitLoader(dataset, [0, 2, 4], [6]), _SplitLoader(dataset, [1, 3, 5], [7])]
+
+    num_builds = []
+    def _build():
+        num_builds.append(1)
+        return splits
+
+    args = _args(tmpdir)
+    for _ in range(2):  # a miss that writes the cache, then a hit
+        loaders = cached_loaders(args, _build)
+
+    assert len(num_builds) == 1
+    assert len(loaders) == 2
+    for cached, split in zip(loaders, splits):
+        assert cached.img_shp == split.img_shp and cached.output_size == split.output_size
+        assert sorted(cached.train_indices.tolist()) == sorted(split.train_loader.sampler.indices)
+        assert cached.train_loader.drop_last and not cached.test_loader.drop_last
+        seen = []
+        for data, labels in cached.train_loader:
+            indices = torch.round(data[:, 0, 0, 0] * 255).long()
+            assert torch.equal(labels, indices % 2)
+            seen += indices.tolist()
+
+        assert set(seen) <= set(split.train_loader.sampler.indices) and len(seen) == 2
+
+
+def test_cache_key_follows_the_loader_args(tmpdir):
+    args = _args(tmpdir)
+    names = ['task', 'data_dir', 'rotation_step', 'batch_size', 'cuda']
+    key = cache_key(args, arg_names=names)
+
+    # the batch size / device only change how the cache is iterated
+    assert cache_key(_args(tmpdir, batch_size=64, cuda=True), arg_names=names) == key
+    assert cache_key(_args(tmpdir, rotation_step=20), arg_names=names) != key
+    assert cache_key(_args(tmpdir, seed=2), arg_names=names) != key
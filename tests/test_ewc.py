@@ -0,0 +1,67 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('torch.func')
+pytest.importorskip('helpers.layers')
+
+from models.ewc import estimate_fisher
+from models.vae.parallelly_reparameterized_vae import ParallellyReparameterizedVAE
+from models.vae.sequentially_reparameterized_vae import SequentiallyReparameterizedVAE
+
+
+class _Loader(object):
+    ''' the train_loader interface of the task loaders '''
+    def __init__(self, num_samples=6, batch_size=3, img_shp=(1, 8, 8)):
+        x = torch.rand(num_samples, *img_shp)
+        y = torch.zeros(num_samples).long()
+        self.train_loader = list(zip(torch.split(x, batch_size),
+                                     torch.split(y, batch_size)))
+
+
+@pytest.mark.parametrize('vae_type, vae_cls', [
+    ('parallel', ParallellyReparameterizedVAE),
+    ('sequential', SequentiallyReparameterizedVAE),
+])
+def test_estimate_fisher(make_config, vae_type, vae_cls):
+    torch.manual_seed(0)
+    config = make_config(vae_type=vae_type, reparam_type='mixture'
+                         if vae_type == 'parallel' else 'discrete')
+    model = vae_cls(config['img_shp'], kwargs=config)
+    model.train()
+
+    fisher = estimate_fisher(model, _Loader(), chunk_size=2)
+    assert model.training, "estimate_fisher must restore the train mode"
+    assert list(fisher.keys()) == [k for k, _ in model.named_parameters()]
+    for k, p in model.named_parameters():
+        assert fisher[k].shape == p.shape
+        assert torch.isfinite(fisher[k]).all()
+        assert (fisher[k] >= 0).all()
+
+    assert sum(f.sum().item() for f in fisher.values()) > 0
+
+
+@pytest.mark.parametrize('fisher_dtype', ['float32', 'float16', 'bfloat16'])
+def test_penalty_matches_dense_formula(fisher_dtype):
+    from collections import OrderedDict
+    from models.ewc import ElasticWeightConsolidation
+
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(torch.nn.Linear(4, 3), torch.nn.Linear(3, 2))
+    # tiny fisher values would underflow to 0 in a plain float16 cast
+    fisher = OrderedDict((k, torch.rand_like(p) * 1e-9) for k, p in model.named_parameters())
+    ewc = ElasticWeightConsolidation(2.0, fisher_dtype=fisher_dtype)
+    ewc.consolidate(model, fisher)
+
+    anchor = [p.detach().clone() for p in model.parameters()]
+    with torch.no_grad():
+        for p in model.parameters():
+            p.add_(torch.randn_like(p))
+
+    expected = sum(torch.sum(f * (p - a) ** 2) for f, p, a
+                   in zip(fisher.values(), model.parameters(), anchor))
+    penalty = ewc.penalty(model)
+    assert penalty.item() > 0
+    assert torch.allclose(penalty, expected, rtol=1e-2 if fisher_dtype != 'float32' else 1e-5)
+
+    penalty.backward()
+    assert all(p.grad is not None for p in model.parameters())
@@ -0,0 +1,74 @@
+import pytest
+
+from loaders.lazy import LazyLoaderList
+
+
+class _Loader(object):
+    def __init__(self, name):
+        self.name = name
+
+
+def test_tasks_are_built_on_first_use_and_rebuilt_after_release():
+    num_builds, built = [], []
+    def _build(i):
+        num_builds.append(i)
+        return _Loader(i)
+
+    loaders = LazyLoaderList([lambda i=i: _build(i) for i in range(3)],
+                             on_build=lambda i, l: built.append(i))
+    assert len(loaders) == 3 and num_builds == []
+
+    first = loaders[1]
+    assert loaders[1] is first and loaders[-2] is first
+    assert num_builds == [1] and built == [1]
+
+    loaders.release(1)
+    assert 1 not in loaders.built
+    assert loaders[1] is not first and num_builds == [1, 1]
+
+    with pytest.raises(IndexError):
+        loaders[3]
+
+
+def test_group_is_built_lazily_once():
+    num_groups = []
+    def _build_group():
+        num_groups.append(1)
+        return [_Loader(i) for i in range(3)]
+
+    built = []
+    loaders = LazyLoaderList.from_group_builder(_build_group,
+                                                on_build=lambda i, l: built.append(i))
+    assert num_groups == []  # nothing is built at construction
+
+    assert len(loaders) == 3 and num_groups == [1]
+    assert [l.name for l in loaders] == [0, 1, 2]
+    assert num_groups == [1] and built == [0, 1, 2]
+
+
+def test_released_group_task_is_dropped_and_rebuilt():
+    groups = []
+    def _build_group():
+        groups.append([_Loader(i) for i in range(3)])
+        return groups[-1]
+
+    loaders = LazyLoaderList.from_group_builder(_build_group)
+    task = loaders[0]
+    loaders.release(0)
+    loaders.release(2)  # never used: its pending loader is dropped as well
+    assert 0 not in loaders.built
+    assert set(loaders.group_pending.keys()) == {1}
+
+    rebuilt = loaders[0]
+    assert rebuilt is not task and rebuilt.name == 0 and len(groups) == 2
+    assert loaders[1] is groups[0][1]  # still handed out from the first build
+
+
+def test_slices_build_and_release_through_the_root():
+    loaders = LazyLoaderList([lambda i=i: _Loader(i) for i in range(4)])
+    tail = loaders[1:]
+    assert len(tail) == 3 and tail[0].name == 1
+    assert 1 in loaders.built
+
+    tail.release(0)
+    assert 1 not in loaders.built
@@ -0,0 +1,55 @@
+import pytest
+
+from models.loss_planner import LossGraphPlanner
+
+
+def test_mixture_without_mutual_info_prunes_the_student_posterior(make_config):
+    plan = LossGraphPlanner(make_config(reparam_type='mixture', discrete_mut_info=0.0,
+                                        continuous_mut_info=0.0))
+    assert not plan['student_posterior_of_reconstruction']
+    assert plan['teacher_posterior'] and not plan['teacher_decoder']
+
+    plan = LossGraphPlanner(make_config(reparam_type='mixture', discrete_mut_info=1.0))
+    assert plan['student_posterior_of_reconstruction']
+
+
+def test_discrete_always_needs_the_student_posterior(make_config):
+    assert LossGraphPlanner(make_config(reparam_type='discrete'))['student_posterior_of_reconstruction']
+    assert not LossGraphPlanner(make_config(reparam_type='discrete', vae_type='sequential'))[
+        'student_posterior_of_reconstruction']
+
+
+@pytest.mark.parametrize('overrides, teacher_posterior, teacher_decoder', [
+    ({}, True, False),
+    ({'likelihood_gamma': 1.0}, True, True),
+    ({'ewc_gamma': 1.0, 'likelihood_gamma': 1.0}, False, False),
+    ({'disable_regularizers': True}, False, False),
+    ({'consistency_gamma': 0.0}, False, False),
+])
+def test_teacher_branches(make_config, overrides, teacher_posterior, teacher_decoder):
+    plan = LossGraphPlanner(make_config(**overrides))
+    assert plan['teacher_posterior'] == teacher_posterior
+    assert plan['teacher_decoder'] == teacher_decoder
+    assert set(plan.pruned()) == set(k for k, v in plan.branches.items() if not v)
+
+
+def test_pruned_posterior_keeps_the_anneal_schedule(make_student_teacher):
+    torch = pytest.importorskip('torch')
+    pytest.importorskip('helpers.layers')
+
+    torch.manual_seed(0)
+    pruned = make_student_teacher(discrete_mut_info=0.0)
+    full = make_student_teacher(discrete_mut_info=1.0)
+    assert not pruned.plan['student_posterior_of_reconstruction']
+    assert full.plan['student_posterior_of_reconstruction']
+
+    x = torch.rand(4, *pruned.config['img_shp'])
+    for model in [pruned, full]:
+        model.train()
+        for _ in range(25):  # crosses a few anneal intervals
+            model(x)
+
+    pruned_gumbel = pruned.student.reparameterizer.discrete
+    full_gumbel = full.student.reparameterizer.discrete
+    assert pruned_gumbel.iteration == full_gumbel.iteration == 50
+    assert pruned_gumbel.tau == full_gumbel.tau < 1.0
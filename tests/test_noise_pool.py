@@ -0,0 +1,46 @@
+from copy import deepcopy
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from models.reparameterizers.noise_pool import NoisePool
+
+
+def _draws(pool, num_draws, size=(3, 2)):
+    return [pool.draw(size).clone() for _ in range(num_draws)]
+
+
+@pytest.mark.parametrize('distribution', ['uniform', 'normal'])
+def test_seeded_pools_are_reproducible(distribution):
+    torch.manual_seed(0)
+    first = _draws(NoisePool(distribution, num_steps=2), 5)
+    torch.manual_seed(0)
+    second = _draws(NoisePool(distribution, num_steps=2), 5)
+    assert all(torch.equal(a, b) for a, b in zip(first, second))
+    assert not torch.equal(first[0], first[1])
+
+
+def test_draws_are_never_overwritten():
+    pool = NoisePool('uniform', num_steps=2)
+    sample = pool.draw((4,))
+    kept = sample.clone()
+    _draws(pool, 6, size=(4,))  # exhausts a few blocks
+    assert torch.equal(sample, kept)
+
+
+def test_copied_pool_continues_the_stream():
+    pool = NoisePool('normal', num_steps=2, seed=3)
+    pool.draw((4,))
+    copy = deepcopy(pool)  # drops the current block, keeps the RNG state
+
+    pool.draw((4,))  # the rest of the current block
+    assert torch.equal(copy.draw((4,)), pool.draw((4,)))
+
+
+def test_no_grad_draws_bypass_the_pool():
+    pool = NoisePool('uniform', num_steps=4, seed=0)
+    with torch.no_grad():
+        sample = pool.draw((2, 3))
+
+    assert sample.size() == (2, 3)
+    assert pool.block is None
@@ -0,0 +1,39 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('helpers.utils')
+
+import torch.nn as nn
+from models.relational_network import StreamingRelationalNetwork
+
+
+def _dense_relations(model, conv_output):
+    ''' g over all the [F, F] pairs at once, the quadratic reference '''
+    features = conv_output.flatten(2).transpose(1, 2)
+    pairs = model.pair_proj_i(features).unsqueeze(2) + model.pair_proj_j(features).unsqueeze(1)
+    return model.proj(torch.sum(model.rn(pairs), dim=(1, 2)))
+
+
+@pytest.mark.parametrize('pair_chunk_size', [1, 7, 16, 1024])
+def test_streamed_blocks_match_the_dense_relations(pair_chunk_size):
+    torch.manual_seed(0)
+    model = StreamingRelationalNetwork(input_channels=3, hidden_size=8, output_size=5,
+                                       pair_chunk_size=pair_chunk_size)
+    conv_output = torch.randn(2, 3, 3, 3)  # 9 features, 81 pairs
+    model.eval()
+    with torch.no_grad():
+        assert torch.allclose(model(conv_output), _dense_relations(model, conv_output), atol=1e-5)
+
+    model.train()
+    model(conv_output).sum().backward()  # the checkpointed blocks
+    assert all(p.grad is not None for p in model.parameters())
+
+
+def test_conv_output_shape_is_computed_from_the_layers():
+    pytest.importorskip('helpers.layers')
+    from models.vae.abstract_vae import AbstractVAE
+
+    conv = nn.Sequential(nn.Conv2d(1, 4, 3, stride=2, padding=1), nn.ELU(),
+                         nn.MaxPool2d(2), nn.Conv2d(4, 6, (3, 1)))
+    expected = list(conv(torch.zeros(1, 1, 28, 28)).size())[1:]
+    assert AbstractVAE._conv_output_shape(conv, [1, 28, 28]) == expected
@@ -0,0 +1,75 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('helpers.layers')
+
+import torch.nn as nn
+import torch.nn.functional as F
+from helpers.layers import View
+from models.vae.parallelly_reparameterized_vae import ParallellyReparameterizedVAE
+
+
+class _GatedDense(nn.Module):
+    ''' the h / g layout of the gated layers in helpers.layers '''
+    def __init__(self, input_size, output_size, activation=None):
+        super(_GatedDense, self).__init__()
+        self.activation = activation
+        self.h = nn.Linear(input_size, output_size)
+        self.g = nn.Linear(input_size, output_size)
+
+    def forward(self, x):
+        h = self.h(x) if self.activation is None else self.activation(self.h(x))
+        return h * torch.sigmoid(self.g(x))
+
+
+class _GatedConvTranspose2d(nn.Module):
+    def __init__(self, input_size, output_size, kernel_size, activation=None):
+        super(_GatedConvTranspose2d, self).__init__()
+        self.activation = activation
+        self.h = nn.ConvTranspose2d(input_size, output_size, kernel_size)
+        self.g = nn.ConvTranspose2d(input_size, output_size, kernel_size)
+
+    def forward(self, x):
+        h = self.h(x) if self.activation is None else self.activation(self.h(x))
+        return h * torch.sigmoid(self.g(x))
+
+
+def _first_layers(latent_size):
+    return {
+        'linear': [View([-1, latent_size]), nn.Linear(latent_size, 64), View([-1, 1, 8, 8])],
+        'conv_transpose': [View([-1, latent_size, 1, 1]), nn.ConvTranspose2d(latent_size, 1, 8)],
+        'gated_dense': [View([-1, latent_size]), _GatedDense(latent_size, 64, nn.ELU()),
+                        View([-1, 1, 8, 8])],
+        'gated_conv_transpose': [View([-1, latent_size, 1, 1]),
+                                 _GatedConvTranspose2d(latent_size, 1, 8, nn.ELU())],
+    }
+
+
+@pytest.mark.parametrize('reparam_type', ['discrete', 'mixture'])
+@pytest.mark.parametrize('first_layer', ['linear', 'conv_transpose',
+                                         'gated_dense', 'gated_conv_transpose'])
+def test_sparse_decoding_matches_dense(make_config, reparam_type, first_layer):
+    torch.manual_seed(0)
+    config = make_config(reparam_type=reparam_type, sparse_latent_decoding=True)
+    vae = ParallellyReparameterizedVAE(config['img_shp'], kwargs=config).eval()
+    latent_size = vae.reparameterizer.output_size
+    vae.decoder = nn.Sequential(*_first_layers(latent_size)[first_layer])
+    vae.sparse_decoder = vae.build_sparse_decoder()
+    assert vae.sparse_decoder is not None, "{} should decode sparsely".format(first_layer)
+
+    offset = vae._discrete_offset()
+    indices = torch.randint(0, latent_size - offset, (5,))
+    z_dense = torch.randn(5, offset) if offset > 0 else None
+    one_hot = F.one_hot(indices, latent_size - offset).float()
+    z = torch.cat([z_dense, one_hot], -1) if z_dense is not None else one_hot
+    with torch.no_grad():
+        assert torch.allclose(vae.decode_sparse(z_dense, indices), vae.decode(z), atol=1e-5)
+
+
+def test_unsupported_first_layer_decodes_densely(make_config):
+    config = make_config(reparam_type='discrete', sparse_latent_decoding=True)
+    vae = ParallellyReparameterizedVAE(config['img_shp'], kwargs=config)
+    latent_size = vae.reparameterizer.output_size
+    vae.decoder = nn.Sequential(View([-1, latent_size, 1, 1]),
+                                nn.ConvTranspose2d(latent_size, 1, 8, padding=1))
+    assert vae.build_sparse_decoder() is None
@@ -0,0 +1,68 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from optimizers.state_transfer import transfer_optimizer_state
+
+
+def _warm_adam(param, num_steps=500):
+    optimizer = torch.optim.Adam([param], lr=1e-3)
+    for _ in range(num_steps):
+        param.grad = torch.randn_like(param)
+        optimizer.step()
+
+    return optimizer
+
+
+def test_grown_parameter_keeps_the_warm_state_of_its_overlap():
+    torch.manual_seed(0)
+    src = torch.nn.Parameter(torch.randn(3, 4))
+    src_optimizer = _warm_adam(src)
+
+    # the parameter grows by two rows, eg: two new categories
+    dest = torch.nn.Parameter(torch.randn(5, 4))
+    with torch.no_grad():
+        dest[0:3].copy_(src)
+
+    slices = (slice(0, 3), slice(0, 4))
+    dest_optimizer = torch.optim.Adam([dest], lr=1e-3)
+    assert transfer_optimizer_state(src_optimizer, dest_optimizer,
+                                    [(src, dest, slices)]) == 1
+
+    src_state, dest_state = src_optimizer.state[src], dest_optimizer.state[dest]
+    assert int(dest_state['step']) == int(src_state['step'])
+    assert torch.equal(dest_state['exp_avg'][0:3], src_state['exp_avg'])
+    assert torch.equal(dest_state['exp_avg_sq'][0:3], src_state['exp_avg_sq'])
+    assert (dest_state['exp_avg'][3:5] == 0).all()
+    assert torch.allclose(dest_state['exp_avg_sq'][3:5],
+                          src_state['exp_avg_sq'].mean().expand(2, 4))
+
+    # the overlap steps exactly as the warm optimizer would
+    warm = torch.nn.Parameter(src.detach().clone())
+    warm_optimizer = torch.optim.Adam([warm], lr=1e-3)
+    warm_optimizer.load_state_dict(src_optimizer.state_dict())
+    for _ in range(3):
+        grad = torch.randn(5, 4)
+        dest.grad, warm.grad = grad.clone(), grad[0:3].clone()
+        dest_before = dest.detach().clone()
+        dest_optimizer.step()
+        warm_optimizer.step()
+
+        assert torch.allclose(dest[0:3], warm, atol=1e-6)
+        # the new rows take lr sized steps, not ones blown up by ~1 / sqrt(1 - beta2)
+        assert (dest[3:5] - dest_before[3:5]).abs().max().item() < 3e-3
+
+
+def test_unchanged_parameter_keeps_its_state():
+    torch.manual_seed(0)
+    src = torch.nn.Parameter(torch.randn(3))
+    src_optimizer = _warm_adam(src, num_steps=10)
+    dest = torch.nn.Parameter(src.detach().clone())
+    dest_optimizer = torch.optim.Adam([dest], lr=1e-3)
+    transfer_optimizer_state(src_optimizer, dest_optimizer,
+                             [(src, dest, (slice(0, 3),))])
+
+    src_state, dest_state = src_optimizer.state[src], dest_optimizer.state[dest]
+    assert int(dest_state['step']) == int(src_state['step'])
+    assert torch.equal(dest_state['exp_avg'], src_state['exp_avg'])
+    assert torch.equal(dest_state['exp_avg_sq'], src_state['exp_avg_sq'])
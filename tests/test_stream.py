@@ -0,0 +1,32 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from loaders.lazy import LazyLoaderList
+from loaders.stream import task_stream
+
+
+class _Loader(object):
+    def __init__(self, num_samples=4, batch_size=2):
+        x = torch.rand(num_samples, 1, 2, 2)
+        self.train_loader = torch.utils.data.DataLoader(
+            torch.utils.data.TensorDataset(x, torch.zeros(num_samples).long()),
+            batch_size=batch_size)
+
+
+def test_stream_releases_the_finished_tasks():
+    loaders = LazyLoaderList([_Loader for _ in range(2)])
+    seen = []
+    for task in task_stream(loaders, num_passes=2, cycle=True, max_tasks=4):
+        assert task.num_samples == 4
+        assert len(list(task.train_loader())) == 4  # 2 passes of 2 minibatches
+        task.release()
+        assert task.task_index not in loaders.built
+        seen.append(task.task_index)
+
+    assert seen == [0, 1, 0, 1]
+
+
+def test_stream_needs_lazy_loaders():
+    with pytest.raises(Exception):
+        next(task_stream([_Loader(), _Loader()]))
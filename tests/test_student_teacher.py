@@ -0,0 +1,25 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('helpers.layers')
+
+
+def test_eval_forward_resets_the_train_split(make_student_teacher):
+    torch.manual_seed(0)
+    model = make_student_teacher(reparam_type='discrete', shuffle_minibatches=True)
+    model.fork()
+    x = torch.rand(4, *model.config['img_shp'])
+
+    model.train()
+    output = model(x)
+    assert 'teacher' in output and model.rnd_perm is not None
+    assert 0 < model.num_teacher_samples and model.num_student_samples < output['augmented']['data'].size(0)
+
+    model.eval()
+    with torch.no_grad():
+        output = model(x)
+
+    assert 'teacher' not in output and model.rnd_perm is None
+    assert (model.num_student_samples, model.num_teacher_samples) == (4, 0)
+    loss = model.loss_function(output)
+    assert 'posterior_regularizer_mean' not in loss